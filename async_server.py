@@ -0,0 +1,493 @@
+"""Game server running every connection and game as coroutines on one asyncio event loop
+
+Matchmaking and the rounds of a game follow ServerProgram and Game in server.py, only the waiting
+is done by the event loop instead of a thread per game and per receive
+
+python server.py --mode asyncio
+"""
+import asyncio
+import socket
+import time
+
+from game_objects import Board
+from game_record import GameRecordWriter
+from matchmaking import Lobby
+from metrics import ServerMetrics, serve_metrics
+from registry import Registry
+from sessions import Sessions
+from validation import IllegalMove, check_pick, check_place
+from protocol import (NO_GAME, NO_SESSION, FrameReader, ProtocolError, encode, encode_error,
+                      encode_many, read_hello, resumed_session, snapshot, spectated_game)
+from spectators import SpectatorHub
+from server import (ConnectionState, load_config, setup_logging, pick_starter, parse_loc,
+                    get_other)
+
+
+class AsyncConnection:
+    """Represents a connection to the server, see server.Connection"""
+    def __init__(self, server, reader, writer, state, frames=None):
+        self.server = server
+        self.logger = server.logger
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.state = ConnectionState(state)
+        self.connected = True
+        self.rating = None
+        self.frames = frames or FrameReader()
+        # Reads the stream while the player is in the lobby, see watch_lobby
+        self.lobby_task = None
+
+    def initialize(self):
+        """If a connection was waiting then this is called to tell it that an opponent was found"""
+        self.state = ConnectionState(2)
+        if self.lobby_task is not None:
+            self.lobby_task.cancel()
+            self.lobby_task = None
+
+    async def send(self, *data):
+        """Send the given messages to the client, several are framed into one write"""
+        await self.send_frames(encode_many(data))
+
+    async def send_frames(self, data):
+        """Send messages that are already framed"""
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            self.connected = False
+        else:
+            self.connected = True
+
+    async def recieve(self):
+        """Recieve the next message from the connection"""
+        if not self.connected:
+            return None
+        data = self.frames.pop()
+        while data is None:
+            try:
+                recieved = await self.reader.read(4096)
+                if recieved:
+                    self.frames.feed(recieved)
+            except ConnectionError:
+                recieved = b""
+            except ProtocolError as error:
+                self.logger.warning("Bad data from %s: %s", self.address, error)
+                recieved = b""
+            if recieved == b"":
+                self.connected = False
+                return None
+            data = self.frames.pop()
+        return data
+
+    async def watch_lobby(self):
+        """Read the stream while the player is in the lobby, it is taken out when it hangs up
+
+        Anything the player sends is kept in frames for recieve, the task is cancelled by
+        initialize once an opponent is found
+        """
+        while True:
+            try:
+                recieved = await self.reader.read(4096)
+                if recieved:
+                    self.frames.feed(recieved)
+            except (ConnectionError, ProtocolError):
+                recieved = b""
+            if not recieved:
+                break
+        self.lobby_task = None
+        if self.server.lobby.cancel(self):
+            self.logger.info("%s left the lobby", self.address)
+            self.close()
+
+    def abort(self):
+        """Abort the connected client connection"""
+        self.logger.warning("A player disconnected, finding the other player a new game")
+        if self.connected:
+            self.server.connection_game_sort(self)
+
+    def close(self):
+        """close connection"""
+        self.connected = False
+        self.logger.info("Closing connection from %s", self.address)
+        self.writer.close()
+        self.server.registry.reap_connection(self)
+
+
+class AsyncGame:
+    """Hosts the game elements, see server.Game"""
+    def __init__(self, server, player1, player2):
+        self.server = server
+        self.board = Board()
+        self.play_state = pick_starter()
+        self.first = int(self.play_state[0])
+        self.players = [player1, player2]
+        # The piece picked and not placed yet, sent in snapshots
+        self.hand = None
+        self.finished = False
+        self.game_id = server.registry.add_game(self)
+        self.tokens = [server.sessions.issue(self, i) for i in range(0, 2)]
+        # (index, connection) of players that reconnected, put back in by the game's task
+        self.resumes = []
+        self.resumed = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.start())
+
+    async def wait_for_responses(self, indexes=(0, 1)):
+        """Waits for responses from the players at the indexes, both by default
+
+        Returns None when the server stops, or after the server's turn_timeout when the players
+        that did not respond are closed. A player that disconnects has the server's resume_grace
+        to resume, it is then waited on for this step again
+        """
+        indexes = set(indexes)
+        pending = {asyncio.ensure_future(self.players[i].recieve()): i for i in indexes}
+        stopping = asyncio.ensure_future(self.server.stopped.wait())
+        loop = asyncio.get_running_loop()
+        timeout = self.server.turn_timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        grace_deadline = None
+        start = time.perf_counter()
+        responses = {}
+        try:
+            while True:
+                await self.apply_resumes(indexes, pending, responses)
+                if all(i in responses for i in indexes):
+                    break
+                if self.check_connections():
+                    grace_deadline = None
+                    until = deadline
+                else:
+                    if not self.server.resume_grace:
+                        return None
+                    if grace_deadline is None:
+                        self.server.logger.info("Waiting %ss for a player of game %s to resume",
+                                                self.server.resume_grace, self.game_id)
+                        grace_deadline = loop.time() + self.server.resume_grace
+                    until = grace_deadline
+                remaining = None if until is None else max(0, until - loop.time())
+                resumed = asyncio.ensure_future(self.resumed.wait())
+                try:
+                    done, _ = await asyncio.wait(list(pending) + [stopping, resumed],
+                                                 timeout=remaining,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    resumed.cancel()
+                if stopping in done:
+                    return None
+                if not done:
+                    if grace_deadline is not None:
+                        self.server.logger.warning("No player resumed game %s in time",
+                                                   self.game_id)
+                        return None
+                    for i in pending.values():
+                        self.server.logger.warning("%s took too long to respond",
+                                                   self.players[i].address)
+                        self.players[i].close()
+                    return None
+                for task in done:
+                    if task in pending:
+                        i = pending.pop(task)
+                        # None is a disconnect, noticed by check_connections
+                        if task.result() is not None:
+                            responses[i] = task.result()
+        finally:
+            stopping.cancel()
+            for task in pending:
+                task.cancel()
+        self.server.metrics.turn_wait.observe(time.perf_counter() - start)
+        return responses[int(self.play_state[0])-1]
+
+    def request_resume(self, index, connection):
+        """Queue a reconnected player to be put back in the game, False if the game is over"""
+        if self.finished:
+            return False
+        self.resumes.append((index, connection))
+        self.resumed.set()
+        return True
+
+    async def apply_resumes(self, indexes, pending, responses):
+        """Swap reconnected players in for their old connections, see Game.apply_resumes"""
+        while self.resumes:
+            index, connection = self.resumes.pop(0)
+            for task, i in list(pending.items()):
+                if i == index:
+                    task.cancel()
+                    del pending[task]
+            old = self.players[index]
+            self.players[index] = connection
+            old.close()
+            responses.pop(index, None)
+            await connection.send_frames(encode(snapshot(self.board, self.play_state, self.hand)))
+            self.server.metrics.resumes.inc()
+            self.server.logger.info("%s resumed game %s", connection.address, self.game_id)
+            indexes.add(index)
+            pending[asyncio.ensure_future(connection.recieve())] = index
+        self.resumed.clear()
+
+    async def wait_for_move(self, check):
+        """Wait for the pick or placement of the player whose turn it is, see Game.wait_for_move"""
+        mover = int(self.play_state[0])-1
+        response = await self.wait_for_responses()
+        while response is not None:
+            try:
+                check(self.board, response)
+                return response
+            except IllegalMove as error:
+                self.server.metrics.refused.inc()
+                self.server.logger.warning("Refused move from %s: %s",
+                                           self.players[mover].address, error)
+                await self.players[mover].send(f"error,{error.code}")
+                response = await self.wait_for_responses((mover,))
+        return None
+
+    async def start(self):
+        """Start the game running"""
+        for i, player in enumerate(self.players):
+            await player.send(f"{i+1},{self.play_state[0]}", f"token,{self.tokens[i]}")
+
+        if not self.check_connections():
+            self.abort_game()
+            return
+
+        # A player that disconnects is waited for at the next step
+        while not self.server.stopped.is_set() and not self.finished:
+            await self.play_round()
+
+    async def play_round(self):
+        """Play a round between the two connected clients"""
+        picked_piece = await self.wait_for_move(check_pick)
+        if picked_piece is None:
+            if not self.server.stopped.is_set():
+                self.abort_game()
+            return
+
+        # Send both players confirmation of the piece chosen, then the other player places it
+        data = await self.send_to_players(picked_piece)
+        self.hand = picked_piece
+        self.play_state = f"{get_other(self.play_state[0])}p"
+        self.server.spectators.publish(self.game_id, data)
+
+        picked_location = await self.wait_for_move(check_place)
+        if picked_location is None:
+            if not self.server.stopped.is_set():
+                self.abort_game()
+            return
+
+        data = await self.send_to_players(picked_location)
+        i, j = parse_loc(picked_location)
+        won = self.board.play_move(i, j, picked_piece)
+        self.hand = None
+        self.play_state = f"{self.play_state[0]}c"
+        self.server.spectators.publish(self.game_id, data)
+        self.server.metrics.moves.inc()
+
+        if won:
+            self.end_game()
+        elif not self.board.unplayed_pieces:
+            self.end_game(draw=True)
+
+    def end_game(self, draw=False):
+        """End the connections between the server and players"""
+        self.finish()
+        self.record_game(0 if draw else int(self.play_state[0]))
+        for player in self.players:
+            player.close()
+        self.server.registry.reap_game(self.game_id, self)
+
+    def record_game(self, winner, aborted=False):
+        """Write the game's moves to the server's game records if it keeps them"""
+        if self.server.recorder is None or not self.board.undo_stack:
+            return
+        moves = [(cell, piece) for cell, piece, _ in self.board.undo_stack]
+        self.server.recorder.write_game(moves, winner, self.first, aborted)
+
+    async def send_to_players(self, data):
+        """Send the data to both players in the game, returns it framed for the spectators"""
+        start = time.perf_counter()
+        data = encode(data)
+        await asyncio.gather(*(player.send_frames(data) for player in self.players))
+        self.server.metrics.send_time.observe(time.perf_counter() - start)
+        return data
+
+    def add_spectator(self, conn, address):
+        """Start sending the game to a spectator, returns False if the game is over"""
+        if self.finished:
+            return False
+        self.server.spectators.watch(conn, address, self.game_id,
+                                     encode(snapshot(self.board, self.play_state, self.hand)))
+        return True
+
+    def finish(self):
+        """Stop the game taking spectators and resumes
+
+        Its spectators are closed once they have been sent every move and its tokens stop working
+        """
+        if self.finished:
+            return
+        self.finished = True
+        resumes = self.resumes
+        self.resumes = []
+        self.server.spectators.end(self.game_id)
+        self.server.sessions.end(self.tokens)
+        for _, connection in resumes:
+            connection.writer.write(encode_error(NO_SESSION))
+            connection.close()
+
+    def check_connections(self):
+        """tests if all players are connectd"""
+        return all(player.connected for player in self.players)
+
+    def abort_game(self):
+        """aborts all connected players"""
+        self.finish()
+        self.record_game(0, aborted=True)
+        for player in self.players:
+            if player.connected:
+                player.abort()
+            else:
+                player.close()
+        self.server.registry.reap_game(self.game_id, self)
+
+
+class AsyncServerProgram:
+    """Server program on an asyncio event loop, see server.ServerProgram"""
+    def __init__(self):
+        self.logger = setup_logging()
+        config = load_config()
+        self.host = config["host"]
+        self.port = int(config["port"])
+        record_file = config.get("record_file")
+        self.turn_timeout = config.get("turn_timeout")
+        self.resume_grace = config.get("resume_grace")
+        self.hello_timeout = config.get("hello_timeout", 10)
+        self.config = config
+        self.registry = Registry()
+        self.sessions = Sessions()
+        self.metrics = ServerMetrics(self)
+        self.lobby = Lobby(config.get("rating_bucket"), pair_wait=self.metrics.pair_wait)
+        self.spectators = SpectatorHub(self.logger, config.get("spectator_buffer", 65536))
+        self.stopped = asyncio.Event()
+        self.recorder = GameRecordWriter(record_file) if record_file else None
+
+    async def serve(self):
+        """Accept connections until a stop command is recieved"""
+        server = await asyncio.start_server(self.accept_conn, self.host, self.port)
+        metrics_server = serve_metrics(self.metrics, self.config)
+        self.logger.info("Started listening")
+        async with server:
+            await self.stopped.wait()
+        for conn in self.registry.live_connections():
+            conn.close()
+        self.spectators.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    async def accept_conn(self, reader, writer):
+        """Handle a new connection to the server"""
+        address = writer.get_extra_info("peername")
+        self.logger.info("Connection from: %s", str(address))
+        frames = FrameReader()
+        try:
+            conn_type = await asyncio.wait_for(recv_hello(reader, frames), self.hello_timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning("Refused %s: no HELLO in time", str(address))
+            writer.close()
+            return
+        except (ProtocolError, ConnectionError) as error:
+            self.logger.warning("Refused %s: %s", str(address), error)
+            writer.close()
+            return
+        if conn_type == "testing":
+            self.logger.warning("STOP COMMAND RECIEVED")
+            self.stopped.set()
+            writer.close()
+            return
+        if conn_type == "testing2":
+            self.logger.warning("RESETING SERVER GAMES")
+            for conn in self.registry.live_connections():
+                conn.close()
+            self.registry.clear()
+            self.sessions.clear()
+            self.lobby.clear()
+            writer.close()
+            return
+        token = resumed_session(conn_type)
+        if token is not None:
+            self.resume(reader, writer, frames, token)
+            return
+        game_id = spectated_game(conn_type)
+        if game_id is not None:
+            self.add_spectator(writer, address, game_id)
+            return
+        if conn_type != "client":
+            self.logger.warning("Refused %s, unknown connection type %r", str(address), conn_type)
+            writer.close()
+            return
+        new_connection = AsyncConnection(self, reader, writer, 1, frames)
+        self.registry.add_connection(new_connection)
+        self.connection_game_sort(new_connection)
+
+    def connection_game_sort(self, connection):
+        """Sort connections into games, pairing with a waiting player or joining the lobby"""
+        opponent = self.lobby.join(connection, connection.rating)
+        if opponent is not None:
+            opponent.initialize()
+            self.logger.info("Creating new game")
+            AsyncGame(self, opponent, connection)
+        else:
+            connection.lobby_task = asyncio.ensure_future(connection.watch_lobby())
+
+    def resume(self, reader, writer, frames, token):
+        """Put a reconnected player back in its game, it is refused if the game is over"""
+        connection = AsyncConnection(self, reader, writer, 3, frames)
+        self.registry.add_connection(connection)
+        game, index = self.sessions.find(token)
+        if game is None or not game.request_resume(index, connection):
+            self.logger.warning("Refused resume from %s, its game is over",
+                                str(connection.address))
+            writer.write(encode_error(NO_SESSION))
+            connection.close()
+
+    def add_spectator(self, writer, address, game_id):
+        """Let a connection watch a game, it is refused if the game is not being played
+
+        The spectator hub writes from its own thread, so it is given a copy of the socket and
+        the stream is closed
+        """
+        game = self.registry.get_game(game_id)
+        if game is None or game.finished:
+            self.logger.warning("Refused spectator %s, no game %s", str(address), game_id)
+            writer.write(encode_error(NO_GAME))
+            writer.close()
+            return
+        transport_socket = writer.get_extra_info("socket")
+        conn = socket.fromfd(transport_socket.fileno(), transport_socket.family,
+                             transport_socket.type)
+        writer.close()
+        game.add_spectator(conn, address)
+
+
+async def recv_hello(reader, frames):
+    """Read a stream until its HELLO is complete, returns the role, see server.recv_hello"""
+    data = b""
+    role = None
+    while role is None:
+        recieved = await reader.read(1024)
+        if not recieved:
+            raise ProtocolError("connection closed before its HELLO")
+        data += recieved
+        role = read_hello(data, frames)
+    return role
+
+
+def run_async_server():
+    """Run the asyncio server until it is told to stop"""
+    async def serve():
+        await AsyncServerProgram().serve()
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    run_async_server()
@@ -0,0 +1,76 @@
+"""Score many boards at once with numpy
+
+Boards are rows of an N x 16 array of piece ids in the order of Board.to_array, with EMPTY for
+cells that have no piece
+"""
+import time
+
+import numpy as np
+
+from game_objects import Board, EMPTY, LINES
+
+LINE_CELLS = np.array(LINES, dtype=np.intp)
+LINE_BITS = (1 << np.arange(len(LINES), dtype=np.uint16)).astype(np.uint16)
+PIECE_BITS = np.array([1 << piece for piece in range(0, 16)] + [0], dtype=np.uint16)
+
+
+def boards_to_array(boards):
+    """Stack the array form of many Boards into one N x 16 array"""
+    return np.array([board.to_array() for board in boards], dtype=np.uint8).reshape(-1, 16)
+
+
+def array_to_boards(array):
+    """Make a Board from each row of an N x 16 array"""
+    return [Board.from_array(row) for row in np.asarray(array)]
+
+
+def evaluate_boards(boards, chunk_size=1 << 16):
+    """Check every board for a win
+
+    Returns 3 arrays of length N, if the board is won, a uint16 mask of the winning lines (bit k is
+    LINES[k]) and a uint16 mask of the pieces that have not been played. The boards are worked
+    through in chunks to bound the size of the temporary arrays
+    """
+    boards = np.asarray(boards, dtype=np.uint8).reshape(-1, 16)
+    count = boards.shape[0]
+    wins = np.empty(count, dtype=bool)
+    winning_lines = np.empty(count, dtype=np.uint16)
+    remaining = np.empty(count, dtype=np.uint16)
+    for start in range(0, count, chunk_size):
+        chunk = boards[start:start+chunk_size]
+        # N x 10 x 4 piece ids of every line
+        lines = chunk[:, LINE_CELLS]
+        full = (lines != EMPTY).all(axis=2)
+        # A full line wins if some attr bit is set in all 4 (AND) or in none of them (NOR)
+        shared = np.bitwise_and.reduce(lines, axis=2)
+        either = np.bitwise_or.reduce(lines, axis=2)
+        won = full & ((shared != 0) | (either != 0xF))
+        line_mask = np.bitwise_or.reduce(np.where(won, LINE_BITS, 0).astype(np.uint16), axis=1)
+        winning_lines[start:start+chunk_size] = line_mask
+        wins[start:start+chunk_size] = line_mask != 0
+        played = np.bitwise_or.reduce(PIECE_BITS[chunk], axis=1)
+        remaining[start:start+chunk_size] = ~played
+    return wins, winning_lines, remaining
+
+
+def random_boards(count, rng=None):
+    """Make an N x 16 array of random positions, not all of them reachable in a real game"""
+    rng = np.random.default_rng() if rng is None else rng
+    boards = np.argsort(rng.random((count, 16)), axis=1).astype(np.uint8)
+    filled = rng.integers(0, 17, size=(count, 1))
+    boards[np.arange(16) >= filled] = EMPTY
+    return boards
+
+
+def main():
+    """Report how many boards can be scored per second"""
+    boards = random_boards(1_000_000, np.random.default_rng(1))
+    start = time.perf_counter()
+    wins, _, _ = evaluate_boards(boards)
+    elapsed = time.perf_counter() - start
+    print(f"{len(boards)} boards in {elapsed:.3f}s, {len(boards)/elapsed:.0f} boards/s, "
+          f"{int(wins.sum())} won")
+
+
+if __name__ == '__main__':
+    main()
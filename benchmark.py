@@ -0,0 +1,381 @@
+"""Benchmarks for the engine, server and display hot paths
+
+Each benchmark is repeated and the median time per operation is kept. Results are saved as json
+and can be compared with an earlier run, anything slower by more than the threshold is flagged
+and the exit code is 1
+
+python benchmark.py --output bench.json
+python benchmark.py --compare bench.json --threshold 0.1
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import socket
+import statistics
+import sys
+import time
+
+from logging.handlers import QueueListener
+
+from game_objects import Board, Piece, PIECE_BINS, CELLS, R_LEN
+from logs import LOG_FORMAT, DeferredQueueHandler, FieldsFormatter, event
+from protocol import FrameReader, encode, snapshot
+from metrics import ServerMetrics
+from registry import Registry
+from sessions import Sessions
+from spectators import SpectatorHub
+from server import Connection, Game
+from validation import check_pick, check_place
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a function that returns (operations done, seconds taken)"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def random_games(count, seed=1):
+    """Make lists of (x, y, bin_rep) moves for random games that stop at the first win"""
+    rng = random.Random(seed)
+    games = []
+    for _ in range(0, count):
+        board = Board()
+        moves = []
+        for cell, piece in zip(rng.sample(range(0, CELLS), CELLS), rng.sample(range(0, 16), 16)):
+            move = (cell % R_LEN, cell // R_LEN, PIECE_BINS[piece])
+            moves.append(move)
+            if board.play_move(*move):
+                break
+        games.append(moves)
+    return games
+
+
+@benchmark("board.play_move")
+def bench_play_move():
+    """Time playing every move of random games through Board.play_move"""
+    games = random_games(2000)
+    board = Board()
+    moves = 0
+    start = time.perf_counter()
+    for game in games:
+        board.reset()
+        for move in game:
+            board.play_move(*move)
+        moves += len(game)
+    return moves, time.perf_counter() - start
+
+
+@benchmark("board.check_win")
+def bench_check_win():
+    """Time the win check of a move, the line tallies BitBoard.place updates and tests"""
+    moves = []
+    for game in random_games(500):
+        board = Board()
+        for x, y, piece in game:
+            # A board of its own for every position, each one is played on once
+            moves.append((Board.from_array(board.to_array()).bit_board, y*R_LEN + x,
+                          int(piece, 2)))
+            board.play_move(x, y, piece)
+    start = time.perf_counter()
+    for bit_board, cell, piece_id in moves:
+        bit_board.place(cell, piece_id)
+    return len(moves), time.perf_counter() - start
+
+
+@benchmark("piece.construct")
+def bench_piece():
+    """Time getting a piece from its binary string"""
+    count = 100000
+    start = time.perf_counter()
+    for i in range(0, count):
+        Piece(PIECE_BINS[i & 0xF])
+    return count, time.perf_counter() - start
+
+
+@benchmark("registry.add_game")
+def bench_registry():
+    """Time adding and reaping a game with many live games, as on a long running server"""
+    registry = Registry()
+    game = object()
+    for _ in range(0, 10000):
+        registry.add_game(game)
+    for game_id in range(1, 100):
+        registry.reap_game(game_id, game)
+    count = 200
+    start = time.perf_counter()
+    for _ in range(0, count):
+        registry.reap_game(registry.add_game(game), game)
+    return count, time.perf_counter() - start
+
+
+@benchmark("validation.check_move")
+def bench_validation():
+    """Time checking the last pick and place of random games"""
+    boards = []
+    for game in random_games(500):
+        board = Board()
+        for x, y, piece in game[:-1]:
+            board.play_move(x, y, piece)
+        x, y, piece = game[-1]
+        boards.append((board, piece, str((x, y))))
+    start = time.perf_counter()
+    for board, piece, location in boards:
+        check_pick(board, piece)
+        check_place(board, location)
+    return len(boards), time.perf_counter() - start
+
+
+@benchmark("logs.debug_disabled")
+def bench_debug_disabled():
+    """Time a debug event on the hot path with the logger at the default INFO level"""
+    logger = logging.getLogger("benchmark.disabled")
+    logger.setLevel(logging.INFO)
+    count = 100000
+    start = time.perf_counter()
+    for i in range(0, count):
+        event(logger, logging.DEBUG, "Recieved", address=("127.0.0.1", 5000), data=i)
+    return count, time.perf_counter() - start
+
+
+@benchmark("logs.info_queued")
+def bench_info_queued():
+    """Time for the caller to queue a record, the listener formats and writes it to devnull"""
+    logger = logging.getLogger("benchmark.queued")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    null_handler = logging.FileHandler(os.devnull)
+    null_handler.setFormatter(FieldsFormatter(LOG_FORMAT, style='{'))
+    listener = QueueListener(records, null_handler)
+    listener.start()
+    logger.addHandler(handler)
+    count = 20000
+    try:
+        start = time.perf_counter()
+        for i in range(0, count):
+            event(logger, logging.INFO, "Game started", game=i, starter="1")
+        elapsed = time.perf_counter() - start
+    finally:
+        logger.removeHandler(handler)
+        listener.stop()
+        null_handler.close()
+    return count, elapsed
+
+
+@benchmark("spectators.fan_out")
+def bench_fan_out():
+    """Time sending a game's moves to many spectators, per move sent to one spectator"""
+    hub = SpectatorHub(logging.getLogger("benchmark"))
+    start_frame = encode(snapshot(Board(), "1c"))
+    clients = []
+    for i in range(0, 500):
+        client, server_end = socket.socketpair()
+        hub.watch(server_end, f"pair-{i}", 1, start_frame)
+        clients.append(client)
+    frames = [encode(piece) for piece in PIECE_BINS]
+    expected = len(start_frame) + sum(map(len, frames))
+    start = time.perf_counter()
+    for data in frames:
+        hub.publish(1, data)
+    for client in clients:
+        remaining = expected
+        while remaining:
+            remaining -= len(client.recv(remaining))
+    elapsed = time.perf_counter() - start
+    hub.stop()
+    for client in clients:
+        client.close()
+    return len(clients)*len(frames), elapsed
+
+
+class BenchServer:
+    """Just enough of ServerProgram for a Game to run against"""
+    def __init__(self):
+        self.stop = False
+        self.turn_timeout = None
+        self.resume_grace = None
+        self.recorder = None
+        self.registry = Registry()
+        self.sessions = Sessions()
+        self.metrics = ServerMetrics(self)
+        self.logger = logging.getLogger("benchmark.server")
+        if not self.logger.handlers:
+            # The game warns as the benchmark's players leave, keep that off the console
+            self.logger.addHandler(logging.NullHandler())
+            self.logger.propagate = False
+        self.spectators = SpectatorHub(self.logger)
+
+    def connection_game_sort(self, connection):
+        """Players are not re-paired in the benchmark"""
+
+
+def read_message(client, reader):
+    """Block until the next whole message from the server arrives"""
+    message = reader.pop()
+    while message is None:
+        reader.feed(client.recv(1024))
+        message = reader.pop()
+    return message
+
+
+def loopback_game(listener, server, rng, rounds):
+    """Play up to rounds rounds of a game over loopback, returns the time of each round"""
+    clients = []
+    connections = []
+    for _ in range(0, 2):
+        client = socket.create_connection(listener.getsockname())
+        conn, address = listener.accept()
+        clients.append(client)
+        connections.append(Connection(server, conn, address, 1))
+    Game(server, *connections)
+    readers = [FrameReader() for _ in clients]
+    starts = [read_message(client, reader) for client, reader in zip(clients, readers)]
+    # Each player's session token follows its start
+    for client, reader in zip(clients, readers):
+        read_message(client, reader)
+    picker = int(starts[0].split(",")[1]) - 1
+    board = Board()
+    times = []
+    try:
+        for _ in range(0, rounds):
+            placer = 1 - picker
+            piece = rng.choice(list(board.unplayed_pieces.bins()))
+            occupied = board.bit_board.occupied
+            cell = rng.choice([cell for cell in range(0, CELLS) if not occupied >> cell & 1])
+            x, y = cell % R_LEN, cell // R_LEN
+            start = time.perf_counter()
+            clients[picker].send(encode(piece))
+            clients[placer].send(encode("waiting"))
+            for client, reader in zip(clients, readers):
+                read_message(client, reader)
+            clients[placer].send(encode((x, y)))
+            clients[picker].send(encode("waiting"))
+            for client, reader in zip(clients, readers):
+                read_message(client, reader)
+            times.append(time.perf_counter() - start)
+            if board.play_move(x, y, piece):
+                break
+            picker = placer
+    finally:
+        for client in clients:
+            client.close()
+    return times
+
+
+@benchmark("server.play_round")
+def bench_play_round():
+    """Time rounds of games played over loopback against a threaded Game"""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(2)
+    server = BenchServer()
+    rng = random.Random(1)
+    times = []
+    try:
+        for _ in range(0, 20):
+            times.extend(loopback_game(listener, server, rng, 6))
+    finally:
+        server.stop = True
+        server.spectators.stop()
+        listener.close()
+    return len(times), sum(times)
+
+
+@benchmark("display.update")
+def bench_display():
+    """Time redrawing the window after every move of random games"""
+    try:
+        from display import Display
+        display = Display(None, Board())
+    except Exception:  # pylint: disable=broad-except
+        # No tkinter or no screen to open a root on
+        return None
+    display.root.withdraw()
+    count = 0
+    start = time.perf_counter()
+    for game in random_games(20):
+        display.board.reset()
+        for move in game:
+            display.board.play_move(*move)
+            display.canvas.delete("avaliable", "player")
+            display.display_avaliable()
+            display.update_board()
+            count += 1
+    elapsed = time.perf_counter() - start
+    display.root.destroy()
+    return count, elapsed
+
+
+def run(names, repeats):
+    """Run the benchmarks, returns the results dict"""
+    results = {}
+    for name in names:
+        per_op = []
+        ops = 0
+        for _ in range(0, repeats):
+            outcome = BENCHMARKS[name]()
+            if outcome is None:
+                break
+            ops, elapsed = outcome
+            per_op.append(elapsed/ops)
+        if not per_op:
+            print(f"{name:<20} skipped")
+            continue
+        median = statistics.median(per_op)
+        results[name] = {"median": median, "min": min(per_op), "ops": ops,
+                         "ops_per_second": 1/median}
+        print(f"{name:<20} {median*1e6:>12.3f} us/op {1/median:>14.0f} ops/s")
+    return {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+            "results": results}
+
+
+def compare(current, baseline, threshold):
+    """Print each benchmark's change from the baseline, returns the names that regressed"""
+    regressed = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        change = result["median"]/base["median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressed.append(name)
+        print(f"{name:<20} {change:>+8.1%}{flag}")
+    return regressed
+
+
+def main():
+    """Run the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmark the quatro hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="json file to save the results to")
+    parser.add_argument("--compare", help="json file of earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fraction slower that counts as a regression")
+    args = parser.parse_args()
+
+    current = run(args.names or list(BENCHMARKS), args.repeats)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
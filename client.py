@@ -4,14 +4,15 @@ Finish time = 02:10 Tuesday 4th December 2022
 """
 import random
 import socket
-import os  # For logging
 import logging
 import json
-from logging.handlers import RotatingFileHandler
-from icecream import ic
+import time
 
-from game_objects import Board
+from game_objects import Board, CELLS, R_LEN
+from logs import event, setup_queue_logging
 from display import Display
+from protocol import (FrameReader, ProtocolError, encode, encode_hello, encode_resume,
+                      missed_move)
 from server import get_other, parse_loc
 
 
@@ -30,7 +31,6 @@ class Client:
 
     def close(self):
         """Close online game client connection"""
-        ic(self.game_client)
         if self.game_client:
             self.game_client.close()
         self.game_client = None
@@ -38,9 +38,7 @@ class Client:
     def set_mode(self, mode):
         """Sets this clients mode to either local or online"""
         # Key bind pressed when game already in progress
-        ic(mode)
-        ic(self.game_client)
-        ic(self)
+        event(self.logger, logging.DEBUG, "Mode chosen", mode=mode, playing=self.game_client)
         if self.game_client is not None:
             return
         if mode == "Local":
@@ -52,14 +50,12 @@ class Client:
         """Play a local game"""
         self.game_client = LocalPlay(self)
         self.game_client.play_game()
-        print("revoked display to main client Local")
         self.display.set_client(self)
 
     def online_play(self):
         """Play an online game"""
         self.game_client = OnlinePlay(self)
         self.game_client.play_game()
-        print("revoked display to main client Online")
         self.display.set_client(self)
 
 
@@ -148,8 +144,6 @@ class LocalPlay:
                 self.display.set_player_info(f"Player {p} wins!")
             self.game_vars["play_state"] = "Finished"
             self.client.game_client = None
-            ic(self.client.game_client)
-            ic(self.client)
             self.display.display_menu_input()
             self.board.reset()
             return True
@@ -180,7 +174,6 @@ class LocalPlay:
     def piece_clicked(self, tag):
         """A piece was clicked"""
         state = self.game_vars["play_state"]
-        ic(state)
         if state[1] == "c" and self.check_selecting():
             self.display.mark_piece(tag)
             self.game_vars["chosen_piece"] = tag
@@ -199,7 +192,6 @@ class LocalPlay:
         """Place the previously chosen piece onto the chosen location on the board"""
         i, j = map(int, tag.split("_")[-1].split(","))
         state = self.game_vars["play_state"]
-        ic(state)
         if state[1] == "p":
             self.game_vars["chosen_loc"] = (i, j)
             self.game_vars["play_state"] = f"{state[0]}c"
@@ -211,11 +203,16 @@ class OnlinePlay(LocalPlay):
     def __init__(self, client):
         super().__init__(client)
         self.client_socket = None
+        self.frame_reader = FrameReader()
         with open("config.json", "r") as f:
             config = json.load(f)
         self.conn_vars = {"host": config["host"],
                           "port": int(config["port"]),
-                          "connected": False}
+                          "connected": False,
+                          # Sent after START, lets a lost connection resume the game
+                          "token": None,
+                          "resume_grace": config.get("resume_grace")}
+        self.last_sent = None
 
     def play_game(self):
         # Create a TCP/IP socket
@@ -227,8 +224,7 @@ class OnlinePlay(LocalPlay):
         """Run the online program"""
         initial_data = self.recv()
         # Game closed if data is none so return this thread to stop error
-        print(f"initial_data {initial_data}")
-        ic(initial_data)
+        event(self.logger, logging.DEBUG, "Game started", data=initial_data)
         if not initial_data or not self.game_vars["window_open"]:
             return
         split_data = initial_data.split(",")
@@ -248,7 +244,6 @@ class OnlinePlay(LocalPlay):
         # delete possible pieces from previous game
         self.display.canvas.delete("player")
         # Update the displayed avaliable pieces
-        ic("1online_round", self.game_vars["player"], self.game_vars["play_state"])
         self.piece_selection()
         if not self.game_vars["window_open"]:
             return
@@ -256,7 +251,6 @@ class OnlinePlay(LocalPlay):
         while self.game_vars["play_state"] != "Finished" and self.game_vars["window_open"]:
             # loop till done
             # play piece
-            ic("2online_round", self.game_vars["player"], self.game_vars["play_state"])
             self.play_piece()
 
             if self.check_win(self.game_vars["play_state"][0], online=True):
@@ -265,7 +259,6 @@ class OnlinePlay(LocalPlay):
             if not self.game_vars["window_open"]:
                 return
             # pick piece
-            ic("3online_round", self.game_vars["player"], self.game_vars["play_state"])
             self.display.setup_binds()
             self.piece_selection()
             if not self.game_vars["window_open"]:
@@ -273,7 +266,8 @@ class OnlinePlay(LocalPlay):
 
     def play_piece(self):
         """Selected piece needs to be played"""
-        ic("play_piece", self.game_vars["player"], self.game_vars["play_state"])
+        event(self.logger, logging.DEBUG, "Playing piece", player=self.game_vars["player"],
+              state=self.game_vars["play_state"])
         if self.game_vars["player"] == self.game_vars["play_state"][0]:
             self.player_plays_piece()
         else:
@@ -293,7 +287,7 @@ class OnlinePlay(LocalPlay):
         # Send some random data to tell the server that wait is ready
         self.send("waiting")
 
-        location = self.recv()
+        location = self.recv("location")
         if not self.game_vars["window_open"]:
             return
         self.game_vars["chosen_loc"] = parse_loc(location)
@@ -307,12 +301,9 @@ class OnlinePlay(LocalPlay):
             return
         loc = self.game_vars["chosen_loc"]
         self.send(loc)
-        print("send loc")
         # Wait for the server to confirm
-        loc = self.recv()
-        print("recieved loc back")
+        loc = self.recv("location")
         loc = parse_loc(loc)
-        ic(loc, self.game_vars["chosen_loc"])
         if loc != self.game_vars["chosen_loc"]:
             self.logger.warning("Mismatch of sent and recieved piece!!")
 
@@ -337,7 +328,6 @@ class OnlinePlay(LocalPlay):
             return
         state = f"{get_other(state[0])}p"
         self.game_vars["play_state"] = state
-        print(f"Changed state to {state}")
 
     def player_picks(self):
         """This player is picking the piece"""
@@ -350,12 +340,8 @@ class OnlinePlay(LocalPlay):
         if not self.game_vars["window_open"]:
             return
         self.send(self.game_vars["chosen_piece"])
-        print("sent choice")
         # Even if the player picked need to have both clients send and recieve synced
-        piece = self.recv()
-        print("recieved confirm")
-        print("piece", piece)
-        print("saved piece", self.game_vars["chosen_piece"])
+        piece = self.recv("piece")
         if piece != self.game_vars["chosen_piece"]:
             self.logger.warning("Mismatch of sent and recieved piece!!")
 
@@ -367,27 +353,86 @@ class OnlinePlay(LocalPlay):
         # Send some random data to tell the server that wait is ready
         self.send("waiting")
 
-        piece = self.recv()
+        piece = self.recv("piece")
         if not self.game_vars["window_open"]:
             return
         self.game_vars["chosen_piece"] = piece
         self.display.mark_piece(piece)
 
-    def recv(self):
-        """Recieve data from the server"""
-        data = None
-        while not data and self.game_vars["window_open"]:
+    def recv(self, expecting=None):
+        """Recieve data from the server
+
+        expecting is "piece" or "location" during a game, if the connection is lost then the game
+        is resumed and the step's message is still returned
+        """
+        data = self.frame_reader.pop()
+        while (data is None or data.startswith("token,")) and self.game_vars["window_open"]:
+            if data is not None:
+                self.conn_vars["token"] = data[6:]
+                data = self.frame_reader.pop()
+                continue
             try:
-                data = self.client_socket.recv(1024).decode()
+                recieved = self.client_socket.recv(4096)
+                if recieved:
+                    self.frame_reader.feed(recieved)
             except socket.timeout:
-                data = None
+                recieved = None
+            except OSError:
+                recieved = b""
+            except ProtocolError as error:
+                # Treated like a lost connection
+                self.logger.warning("Bad data from the server: %s", error)
+                recieved = b""
+            if recieved:
+                data = self.frame_reader.pop()
+            elif recieved == b"" and expecting is not None and not self.resume(expecting):
+                # Only try to resume once
+                expecting = None
             self.display.root.update()
         return data
 
+    def resume(self, expecting):
+        """Reconnect with the session token after losing the connection, False if it failed
+
+        If the snapshot the server sends shows the step was played while away its move is
+        queued for recv, otherwise the last message is sent again
+        """
+        token = self.conn_vars["token"]
+        grace = self.conn_vars["resume_grace"]
+        if token is None or not grace:
+            return False
+        self.logger.info("Connection lost, resuming the game")
+        self.display.set_player_info("Connection lost, resuming...")
+        deadline = time.monotonic() + grace
+        self.client_socket.close()
+        self.connect(encode_resume(token))
+        while not self.conn_vars["connected"]:
+            if time.monotonic() > deadline or not self.game_vars["window_open"]:
+                return False
+            # Retry from the Tk loop, the window keeps responding while it waits
+            self.display.wait_then_call(0.5, lambda: self.connect(encode_resume(token)))
+        reply = self.recv()
+        if reply is None or not reply.startswith("board,"):
+            self.logger.warning("Could not resume the game, got %s", reply)
+            return False
+        missed = missed_move(self.server_board(), expecting, reply)
+        if missed is None:
+            self.send(self.last_sent)
+        else:
+            self.frame_reader.feed(encode(missed))
+        return True
+
+    def server_board(self):
+        """The board the way the server has it, locations are played transposed here"""
+        cells = self.board.to_array()
+        return Board.from_array([cells[(cell % R_LEN)*R_LEN + cell // R_LEN]
+                                 for cell in range(0, CELLS)])
+
     def send(self, data):
         """Send data to the server"""
-        ic(f"sending data {data}")
-        self.client_socket.send(str(data).encode())
+        event(self.logger, logging.DEBUG, "Sending", data=data)
+        self.last_sent = data
+        self.client_socket.sendall(encode(data))
 
     def establish_connection(self):
         """Establish a connection between the server and the client"""
@@ -404,48 +449,31 @@ class OnlinePlay(LocalPlay):
         # self.display.call_after(5, lambda: self.display.set_player_info("Waiting for other "
         #                                                                 "players..."))
 
-    def connect(self):
-        """Connect to the host"""
+    def connect(self, hello=None):
+        """Connect to the host, saying hello as a new player unless given another hello"""
         self.client_socket = socket.socket()
         # self.client_socket.setblocking(False)
         host = self.conn_vars["host"]
         port = self.conn_vars["port"]
         try:
-            ic(host, port)
             self.client_socket.connect((host, port))
-            self.client_socket.send("client".encode())
-        except ConnectionRefusedError:
+            self.client_socket.sendall(hello or encode_hello())
+            self.frame_reader = FrameReader()
+        except OSError as error:
+            # Refused, reset, unreachable or timed out, the caller tries again later
+            self.client_socket.close()
             self.conn_vars["connected"] = False
-            print("Connection refused")
+            self.logger.info("Could not connect to %s:%s: %s", host, port, error)
         else:
             self.conn_vars["connected"] = True
             # Set timeout to a short time to allow for waiting
             self.client_socket.settimeout(0.1)
-            print("Sucessfully connected")
+            self.logger.info("Connected to %s:%s", host, port)
 
 
 def setup_logging():
-    """Logging for server"""
-    log = logging.getLogger('client')
-    log.setLevel(logging.INFO)
-
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-
-    file_handler = RotatingFileHandler("./logs/latest.log", mode='a', maxBytes=5*1024*1024,
-                                       backupCount=2)
-
-    dt_fmt = '%Y-%m-%d %H:%M:%S'
-    fmt = logging.Formatter('[{asctime}] [{levelname:<7}] {name}: {message}', dt_fmt, style='{')
-    file_handler.setFormatter(fmt)
-    log.addHandler(file_handler)
-
-    # Setup logging to the console aswell for quick live debugging
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(fmt)
-    log.addHandler(stream_handler)
-    # Also want to log to console so add a stream handler too
-    return log
+    """Logging for client, records are written by a background thread"""
+    return setup_queue_logging('client')
 
 
 if __name__ == '__main__':
@@ -1,7 +1,7 @@
 """For doing all the program's display"""
 import tkinter as tk
 
-from game_objects import Piece
+from game_objects import PIECES, PIECE_BINS
 
 
 class Display:
@@ -92,20 +92,20 @@ class Display:
         stepx = 40
         stepy = 40
         for i in range(0, 16):
-            piece = f'{i:0>4b}'
+            piece = PIECE_BINS[i]
             if piece[1] == "1":
-                if piece in self.board.unplayed_pieces:
+                if i in self.board.unplayed_pieces:
                     pos = (jl+width_offset, il+height_offset)
-                    Piece(piece).draw(self.canvas, pos, "avaliable")
+                    PIECES[i].draw(self.canvas, pos, "avaliable")
                     self.maps["avaliable_map"][piece] = pos
                 jl += stepx
                 if jl >= 2*stepx:
                     jl = 0
                     il += stepy
             else:
-                if piece in self.board.unplayed_pieces:
+                if i in self.board.unplayed_pieces:
                     pos = (canvas_width-(jr+width_offset), (ir+height_offset))
-                    Piece(piece).draw(self.canvas, pos, "avaliable")
+                    PIECES[i].draw(self.canvas, pos, "avaliable")
                     self.maps["avaliable_map"][piece] = pos
                 jr += stepx
                 if jr >= 2*stepx:
@@ -182,3 +182,17 @@ class Display:
     def call_after(self, delay, func):
         """Call then given function after some time using the .after function"""
         self.root.after(delay*1000, func)
+
+    def wait_then_call(self, delay, func):
+        """Handle the window's events for delay seconds, then call the function
+
+        For code that has to wait in a Tk callback, the window keeps responding where time.sleep
+        would freeze it. Returns early without calling it if the window is closed
+        """
+        called = []
+        after_id = self.root.after(int(delay*1000), lambda: called.append(func()))
+        while not called and self.get_game_vars()["window_open"]:
+            # Blocks until the next window event or the call is due
+            self.root.tk.dooneevent()
+        if not called:
+            self.root.after_cancel(after_id)
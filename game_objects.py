@@ -3,30 +3,113 @@
 ATTRS = ["tall", "black", "round", "hollow"]
 INVS_ATTRS = {"tall": "short", "black": "white", "round": "square", "hollow": "full"}
 
+# Bitboard layout, cell index is y*R_LEN + x and each cell holds the piece's 4 bit id
+# in bits 4*cell..4*cell+3. The id's most significant bit is the first attr in ATTRS
+R_LEN = 4
+CELLS = R_LEN*R_LEN
+# Id used for an empty cell in the array form of a board
+EMPTY = 16
+LINES = tuple([tuple(y*R_LEN + x for x in range(0, R_LEN)) for y in range(0, R_LEN)]
+              + [tuple(y*R_LEN + x for y in range(0, R_LEN)) for x in range(0, R_LEN)]
+              + [tuple(i*R_LEN + i for i in range(0, R_LEN))]
+              + [tuple(i*R_LEN + R_LEN-1-i for i in range(0, R_LEN))])
+# The lines that pass through each cell, 2 or 3 of them
+CELL_LINES = tuple(tuple(k for k, line in enumerate(LINES) if cell in line)
+                   for cell in range(0, CELLS))
+# Running attribute count for a line, one 4 bit counter for each attr and its inverse, as a piece
+# always adds to one of each pair a counter can only reach 4 once the line is full
+ATTR_TALLY = tuple(sum(1 << (4*bit) if piece_id >> bit & 1 else 1 << (4*(bit+4))
+                       for bit in range(0, 4))
+                   for piece_id in range(0, 16))
+WIN_TALLY = 0x44444444
+_winning_pieces = {}
+
+
+def winning_pieces(tally):
+    """Mask of the pieces that win when added to a line with the given tally"""
+    mask = _winning_pieces.get(tally)
+    if mask is None:
+        mask = 0
+        for piece in range(0, 16):
+            if (tally + ATTR_TALLY[piece]) & WIN_TALLY:
+                mask |= 1 << piece
+        _winning_pieces[tally] = mask
+    return mask
+
+
+def threatened(tallies):
+    """Mask of the pieces that would complete one of the lines with the given tallies"""
+    mask = 0
+    for tally in tallies:
+        # Only a line holding 3 pieces has a single empty cell to complete
+        if (tally & 0xF) + (tally >> 16 & 0xF) == 3:
+            mask |= winning_pieces(tally)
+    return mask
+
+
+def winning_cell(tallies, empty, piece_id):
+    """Get a cell set in the empty mask where the piece id completes a line, or None"""
+    tally = ATTR_TALLY[piece_id]
+    for cell in range(0, CELLS):
+        if empty >> cell & 1:
+            for line in CELL_LINES[cell]:
+                if (tallies[line] + tally) & WIN_TALLY:
+                    return cell
+    return None
+
+
+# Bit of the piece id that holds each attr
+ATTR_BITS = {attr: 3-i for i, attr in enumerate(ATTRS)}
+PIECE_BINS = tuple(f'{i:0>4b}' for i in range(0, 16))
+PIECE_IDS = {bin_rep: piece_id for piece_id, bin_rep in enumerate(PIECE_BINS)}
+
 
 class Piece:
-    """Represents a piece"""
-    def __init__(self, bin_rep):
-        self.attr_dict = {attr: (bool(bin_rep[i] == '1')) for i, attr in enumerate(ATTRS)}
-        self.size = 10
-        self.turn = 2
-        self.bin = bin_rep
-
-        if self.attr_dict["black"]:
-            self.fill = "black"
-            self.outline = "white"
+    """Represents a piece
+
+    There are only 16 pieces and they hold no board state, so Piece(bin_rep) hands back the one
+    shared instance for that piece from PIECES
+    """
+    __slots__ = ("id", "bin", "fill", "outline", "height")
+    # Drawing sizes shared by all pieces
+    size = 10
+    turn = 2
+
+    def __new__(cls, bin_rep):
+        return PIECES[PIECE_IDS[bin_rep]]
+
+    @classmethod
+    def create(cls, piece_id):
+        """Build the Piece for an id, only used to fill PIECES"""
+        piece = object.__new__(cls)
+        piece.id = piece_id
+        piece.bin = PIECE_BINS[piece_id]
+
+        if piece.has_attr("black"):
+            piece.fill = "black"
+            piece.outline = "white"
         else:
-            self.fill = "white"
-            self.outline = "black"
+            piece.fill = "white"
+            piece.outline = "black"
 
-        if self.attr_dict["tall"]:
-            self.height = 20
+        if piece.has_attr("tall"):
+            piece.height = 20
         else:
-            self.height = 10
+            piece.height = 10
+        return piece
+
+    def has_attr(self, attr):
+        """Check if the piece has the attr (from ATTRS)"""
+        return bool(self.id >> ATTR_BITS[attr] & 1)
+
+    @property
+    def attr_dict(self):
+        """Dict of each of the ATTRS to if the piece has it"""
+        return {attr: self.has_attr(attr) for attr in ATTRS}
 
     def draw(self, canvas, location, tag="player"):
         """Draw the piece on a given canvas"""
-        if self.attr_dict["round"]:
+        if self.has_attr("round"):
             self.draw_round(canvas, location, tag)
         else:
             self.draw_square(canvas, location, tag)
@@ -58,7 +141,7 @@ class Piece:
                            fill=self.fill,
                            outline=self.outline, tags=(tag, self.bin))
 
-        if self.attr_dict["hollow"]:
+        if self.has_attr("hollow"):
             canvas.create_oval(centerx-self.size/2, centery-self.size/2+self.turn/2-self.height,
                                centerx+self.size/2, centery+self.size/2-self.turn/2-self.height,
                                fill=self.fill,
@@ -84,7 +167,7 @@ class Piece:
                               outline=self.outline, tags=(tag, self.bin))
 
         # create cutout for hollow if hollow
-        if self.attr_dict["hollow"]:
+        if self.has_attr("hollow"):
             canvas.create_polygon(centerx, centery-self.height-self.size/2+self.turn/2,
                                   centerx-self.size/2, centery-self.height,
                                   centerx, centery-self.height+self.size/2-self.turn/2,
@@ -97,7 +180,7 @@ class Piece:
     def add_to_attr_count(self, attr_count):
         """Adds all the piece's attrs to the attr_count"""
         for attr in ATTRS:
-            if self.attr_dict[attr]:
+            if self.id >> ATTR_BITS[attr] & 1:
                 attr_count[attr] += 1
             else:
                 attr_count[INVS_ATTRS[attr]] += 1
@@ -105,49 +188,209 @@ class Piece:
         return attr_count
 
 
+PIECES = tuple(Piece.create(piece_id) for piece_id in range(0, 16))
+ALL_PIECES = 0xFFFF
+
+
+class PieceSet:
+    """A set of pieces kept as a 16 bit mask, bit i set means piece id i is in the set
+
+    Pieces can be given as ids or as the binary strings ('0101') that are sent to clients
+    """
+    __slots__ = ("mask",)
+
+    def __init__(self, mask=ALL_PIECES):
+        self.mask = mask
+
+    @staticmethod
+    def to_id(piece):
+        """Get the id of a piece given as an id or binary string, None if it is not a piece"""
+        if isinstance(piece, str):
+            return PIECE_IDS.get(piece)
+        if isinstance(piece, int) and 0 <= piece < 16:
+            return piece
+        return None
+
+    def __contains__(self, piece):
+        piece_id = self.to_id(piece)
+        return piece_id is not None and bool(self.mask >> piece_id & 1)
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+    def __iter__(self):
+        """Iterate over the piece ids in the set, lowest first"""
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __eq__(self, other):
+        if isinstance(other, PieceSet):
+            return self.mask == other.mask
+        return NotImplemented
+
+    def __repr__(self):
+        return f"PieceSet({self.mask:#06x})"
+
+    def bins(self):
+        """Iterate over the binary strings of the pieces in the set"""
+        return (PIECE_BINS[piece_id] for piece_id in self)
+
+    def add(self, piece):
+        """Add a piece to the set"""
+        self.mask |= 1 << self.to_id(piece)
+
+    def remove(self, piece):
+        """Remove a piece from the set, raises ValueError if it is not in it like list.remove"""
+        if piece not in self:
+            raise ValueError(f"{piece!r} is not in the set")
+        self.mask &= ~(1 << self.to_id(piece))
+
+    def copy(self):
+        """Get a new set holding the same pieces"""
+        return PieceSet(self.mask)
+
+
+class BitBoard:
+    """Packed board, the whole position is one int of 16 4 bit piece ids"""
+    def __init__(self):
+        self.bits = 0
+        # One bit per cell that has a piece in it, needed as piece 0000 is a valid id
+        self.occupied = 0
+        self.line_tallies = [0]*len(LINES)
+
+    def reset(self):
+        """Empty the board"""
+        self.bits = 0
+        self.occupied = 0
+        self.line_tallies = [0]*len(LINES)
+
+    def place(self, cell, piece_id):
+        """Put the piece with the given id into the cell, returns if it completed a winning line"""
+        self.bits |= piece_id << (4*cell)
+        self.occupied |= 1 << cell
+        tally = ATTR_TALLY[piece_id]
+        tallies = self.line_tallies
+        won = False
+        for line in CELL_LINES[cell]:
+            tallies[line] += tally
+            if tallies[line] & WIN_TALLY:
+                won = True
+        return won
+
+    def remove(self, cell, piece_id):
+        """Take the piece with the given id back out of the cell"""
+        self.bits &= ~(0xF << (4*cell))
+        self.occupied &= ~(1 << cell)
+        tally = ATTR_TALLY[piece_id]
+        tallies = self.line_tallies
+        for line in CELL_LINES[cell]:
+            tallies[line] -= tally
+
+    def get_piece(self, cell):
+        """Get the id of the piece in the cell, or None if it is empty"""
+        if not self.occupied >> cell & 1:
+            return None
+        return self.bits >> (4*cell) & 0xF
+
+    def threats(self):
+        """Mask of the pieces that would complete a line if placed now"""
+        return threatened(self.line_tallies)
+
+    def winning_cell(self, piece_id):
+        """Get a cell where the piece id completes a line, or None"""
+        return winning_cell(self.line_tallies, ~self.occupied & 0xFFFF, piece_id)
+
+
 class Board:
     """The main game board"""
     def __init__(self):
-        self.unplayed_pieces = [f'{i:0>4b}' for i in range(0, 16)]
+        self.unplayed_pieces = PieceSet()
         # Board it rotated 45 degrees clockwise
         # so the first index is the right diagonal and second left
-        self.r_len = 4
+        self.r_len = R_LEN
         self.game_board = [[0 for j in range(0, self.r_len)] for i in range(0, self.r_len)]
+        self.bit_board = BitBoard()
+        self.won = False
+        # (cell, piece id, won before) for every move made
+        self.undo_stack = []
 
     def reset(self):
         """Reset the game board"""
-        self.unplayed_pieces = [f'{i:0>4b}' for i in range(0, 16)]
+        self.unplayed_pieces = PieceSet()
         self.game_board = [[0 for j in range(0, self.r_len)] for i in range(0, self.r_len)]
+        self.bit_board.reset()
+        self.won = False
+        self.undo_stack = []
+
+    def to_array(self):
+        """Get the board as a list of the 16 cells' piece ids, EMPTY where there is no piece"""
+        bit_board = self.bit_board
+        return [EMPTY if piece is None else piece
+                for piece in map(bit_board.get_piece, range(0, CELLS))]
+
+    @classmethod
+    def from_array(cls, cells):
+        """Make a Board from the 16 piece ids of to_array, any sequence of ints works"""
+        board = cls()
+        for cell, piece in enumerate(cells):
+            if piece != EMPTY:
+                board.play_move(cell % R_LEN, cell // R_LEN, f'{int(piece):0>4b}')
+        return board
 
     def get_board(self):
         """Get the board array"""
         return self.game_board
 
     def play_move(self, x, y, bin_rep):
-        """Play a piece on the board"""
-        self.game_board[y][x] = Piece(bin_rep)
-        self.unplayed_pieces.remove(bin_rep)
+        """Play a piece on the board, returns if the move won the game
+
+        Only the lines through the filled cell are checked, using the running line tallies
+        """
+        return self.make_move(y*self.r_len + x, int(bin_rep, 2))
+
+    def make_move(self, cell, piece_id):
+        """Play the piece id in the cell (y*r_len + x) so it can be taken back by unmake_move
+
+        Returns if the move won the game
+        """
+        y, x = divmod(cell, self.r_len)
+        self.unplayed_pieces.remove(piece_id)
+        self.game_board[y][x] = PIECES[piece_id]
+        self.undo_stack.append((cell, piece_id, self.won))
+        if self.bit_board.place(cell, piece_id):
+            self.won = True
+        return self.won
+
+    def unmake_move(self):
+        """Take back the last move made, returns its (cell, piece id)"""
+        cell, piece_id, won = self.undo_stack.pop()
+        y, x = divmod(cell, self.r_len)
+        self.game_board[y][x] = 0
+        self.unplayed_pieces.add(piece_id)
+        self.bit_board.remove(cell, piece_id)
+        self.won = won
+        return cell, piece_id
+
+    def legal_moves(self, piece_id=None):
+        """Yield every (cell, piece id) that can be played
+
+        Only moves with piece_id are given if it is set, such as the piece a player was handed
+        """
+        if piece_id is None:
+            pieces = list(self.unplayed_pieces)
+        else:
+            pieces = [piece_id]
+        occupied = self.bit_board.occupied
+        for cell in range(0, CELLS):
+            if not occupied >> cell & 1:
+                for piece in pieces:
+                    yield cell, piece
 
     def check_win(self):
         """Check if a win condition has been met on the board
         i.e that 4 of the same attribute in row
         """
-        attr_count = {"tall": 0, "short": 0,
-                      "square": 0, "round": 0,
-                      "black": 0, "white": 0,
-                      "full": 0, "hollow": 0}
-        possible_list = []
-        possible_list.extend([[(i, j) for i in range(0, self.r_len)] for j in range(0, self.r_len)])
-        possible_list.extend([[(j, i) for i in range(0, self.r_len)] for j in range(0, self.r_len)])
-        possible_list.extend([[(i, i) for i in range(0, self.r_len)]])
-        possible_list.extend([[(i, self.r_len-1-i) for i in range(0, self.r_len)]])
-        for row in possible_list:
-            current_attr_count = attr_count.copy()
-            for pos in row:
-                piece = self.game_board[pos[0]][pos[1]]
-                if not isinstance(piece, int):
-                    current_attr_count = piece.add_to_attr_count(current_attr_count)
-            for _, value in current_attr_count.items():
-                if value >= 4:
-                    return True
-        return False
+        return self.won
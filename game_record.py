@@ -0,0 +1,144 @@
+"""Compact append-only record of played games
+
+A file starts with FILE_HEADER then holds one record per game, a GAME_HEADER of the number of
+moves, a flags byte and the unix time the game ended, followed by one byte per move with the cell
+(y*4 + x) in the high 4 bits and the piece id in the low 4 bits
+"""
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+
+from game_objects import Board
+
+try:
+    import fcntl
+except ImportError:
+    # Not on unix, where only one process writes a record file
+    fcntl = None
+
+FILE_HEADER = b"QREC\x01"
+GAME_HEADER = struct.Struct("<BBI")
+# flags byte, bits 0-1 are the winner (0 for none), bits 2-3 the player who picked first
+ABORTED = 0x10
+
+
+class GameRecord:
+    """A game read back from a record file"""
+    __slots__ = ("moves", "winner", "first", "aborted", "timestamp")
+
+    def __init__(self, moves, flags, timestamp):
+        self.moves = moves
+        self.winner = flags & 0x3
+        self.first = flags >> 2 & 0x3
+        self.aborted = bool(flags & ABORTED)
+        self.timestamp = timestamp
+
+    def iter_moves(self):
+        """Yield the (cell, piece id) of each move"""
+        for move in self.moves:
+            yield move >> 4, move & 0xF
+
+    def replay(self):
+        """Get a Board with every move played"""
+        board = Board()
+        for cell, piece in self.iter_moves():
+            board.make_move(cell, piece)
+        return board
+
+
+def encode_game(moves, winner, first, aborted=False, timestamp=None):
+    """Get the bytes of one game record, moves are (cell, piece id) pairs"""
+    flags = winner | first << 2 | (ABORTED if aborted else 0)
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    return GAME_HEADER.pack(len(moves), flags, timestamp) + bytes(cell << 4 | piece
+                                                                   for cell, piece in moves)
+
+
+class GameRecordWriter:
+    """Appends finished games to a record file, safe to share between game threads"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, "ab")
+        self.write_header()
+
+    def write_header(self):
+        """Write FILE_HEADER if the file is empty
+
+        The workers of a sharded server open the file at once, so the size is checked under a
+        file lock and only the first one writes the header
+        """
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                self.file.write(FILE_HEADER)
+                self.file.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def write_game(self, moves, winner, first, aborted=False):
+        """Append a game, each record goes out in a single write"""
+        data = encode_game(moves, winner, first, aborted)
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+
+    def close(self):
+        """Close the record file"""
+        with self.lock:
+            self.file.close()
+
+
+def read_games(path):
+    """Yield every GameRecord in a file without loading the whole file
+
+    The file is memory mapped and read one record at a time, a record cut short by a crash at the
+    end of the file is skipped
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:len(FILE_HEADER)] != FILE_HEADER:
+            raise ValueError(f"{path} is not a game record file")
+        offset = len(FILE_HEADER)
+        size = len(data)
+        while offset + GAME_HEADER.size <= size:
+            count, flags, timestamp = GAME_HEADER.unpack_from(data, offset)
+            offset += GAME_HEADER.size
+            if offset + count > size:
+                return
+            yield GameRecord(data[offset:offset+count], flags, timestamp)
+            offset += count
+
+
+def main():
+    """Print a summary of a record file"""
+    parser = argparse.ArgumentParser(description="Summarise a game record file")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    games = 0
+    moves = 0
+    results = [0, 0, 0]
+    aborted = 0
+    for record in read_games(args.path):
+        games += 1
+        moves += len(record.moves)
+        results[record.winner] += 1
+        aborted += record.aborted
+    elapsed = time.perf_counter() - start
+    print(f"{games} games, {moves} moves, player 1 won {results[1]}, player 2 won {results[2]}, "
+          f"{aborted} aborted, read at {games/elapsed if elapsed else 0:.0f} games/s")
+
+
+if __name__ == '__main__':
+    main()
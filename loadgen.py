@@ -0,0 +1,332 @@
+"""Load generator that plays games against a running server with headless bots
+
+Each bot speaks the same protocol as OnlinePlay: the client hello, then a piece or location when
+it is its turn and "waiting" when it is not. Bots play random moves after a think time and run as
+coroutines on one event loop, so thousands can be connected from one process. Pairing latency,
+move round trips, games per second and errors are reported when every bot is done
+
+With --drop-rate bots drop their connection at random during games and resume with their session
+token, as a player on a flaky network would, and the time to resume is reported too
+
+python loadgen.py --bots 1000 --games 5 --think 0.05 0.2 --ramp 2 --output load.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+from game_objects import Board, CELLS, R_LEN
+from protocol import (FrameReader, ProtocolError, encode, encode_hello, encode_resume,
+                      missed_move)
+from server import get_other, load_config
+
+try:
+    import resource
+except ImportError:
+    # Not on unix, the open file limit is left as it is
+    resource = None
+
+
+class BotError(Exception):
+    """Raised when a bot's game cannot go on, the message is the kind of error counted"""
+
+
+class Repaired(Exception):
+    """Raised when the server starts a new game because the opponent left, holds the START"""
+    def __init__(self, start):
+        super().__init__(start)
+        self.start = start
+
+
+class LoadStats:
+    """Timings and error counts from every bot, in seconds"""
+    def __init__(self):
+        self.pair_waits = []
+        self.round_trips = []
+        self.resume_waits = []
+        self.games = 0
+        self.moves = 0
+        self.errors = collections.Counter()
+        self.started = time.perf_counter()
+        self.finished = self.started
+
+    def game_over(self, moves):
+        """Count a game played to the end"""
+        self.games += 1
+        self.moves += moves
+        self.finished = time.perf_counter()
+
+    def report(self):
+        """Dict of the results, latencies in milliseconds"""
+        elapsed = max(self.finished - self.started, 1e-9)
+        return {"games": self.games, "moves": self.moves, "seconds": elapsed,
+                "games_per_second": self.games/elapsed,
+                "pair_wait_ms": percentiles(self.pair_waits),
+                "move_round_trip_ms": percentiles(self.round_trips),
+                "resume_ms": percentiles(self.resume_waits),
+                "errors": dict(self.errors)}
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    """Dict of the nearest rank percentiles of values in milliseconds, empty if there are none"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {f"p{point}": 1000*ordered[min(len(ordered)-1, len(ordered)*point//100)]
+            for point in points}
+
+
+class Bot:
+    """A headless client that plays games one after another"""
+    def __init__(self, host, port, stats, think, rng, timeout, pair_timeout, drop_rate=0):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.think = think
+        self.rng = rng
+        self.timeout = timeout
+        self.pair_timeout = pair_timeout
+        # Chance of dropping the connection at each message of a game
+        self.drop_rate = drop_rate
+        self.token = None
+        self.reader = None
+        self.writer = None
+        self.frames = FrameReader()
+
+    async def run(self, games):
+        """Play the games, counting any that fail as errors"""
+        for _ in range(0, games):
+            try:
+                await self.play_game()
+            except BotError as error:
+                self.stats.errors[str(error)] += 1
+            except (ConnectionError, OSError):
+                self.stats.errors["connection"] += 1
+            finally:
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+
+    async def play_game(self):
+        """Connect, wait to be paired and play until the server ends the game"""
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except asyncio.TimeoutError as error:
+            raise BotError("connect timeout") from error
+        self.frames = FrameReader()
+        self.token = None
+        self.writer.write(encode_hello())
+        message = await self.recv(self.pair_timeout, "unpaired")
+        if message is None:
+            raise BotError("disconnected")
+        self.stats.pair_waits.append(time.perf_counter() - start)
+        while True:
+            try:
+                moves = await self.play(message)
+            except Repaired as repaired:
+                # The opponent left and the server paired this bot with a new one
+                self.stats.errors["repaired"] += 1
+                message = repaired.start
+                continue
+            # The server closes the connection once the game is over
+            if await self.recv(self.timeout, "timeout") is not None:
+                raise BotError("message after game over")
+            # Both players of a game see it end, only player 1 counts it
+            if message.startswith("1,"):
+                self.stats.game_over(moves)
+            return
+
+    async def play(self, start):
+        """Play the game the START message began, returns the number of moves"""
+        player, first = start.split(",")
+        picker = first
+        board = Board()
+        while True:
+            placer = str(get_other(picker))
+            piece = await self.turn(picker == player,
+                                    lambda: self.rng.choice(list(board.unplayed_pieces.bins())),
+                                    board, "piece")
+            location = await self.turn(placer == player, lambda: self.pick_location(board), board,
+                                       "location")
+            x, y = map(int, location[1:-1].split(", "))
+            if board.play_move(x, y, piece) or not board.unplayed_pieces:
+                return len(board.undo_stack)
+            picker = placer
+
+    def pick_location(self, board):
+        """Text of a random empty location"""
+        occupied = board.bit_board.occupied
+        cell = self.rng.choice([cell for cell in range(0, CELLS) if not occupied >> cell & 1])
+        return str((cell % R_LEN, cell // R_LEN))
+
+    async def turn(self, mine, choose, board, expecting):
+        """Send this bot's move if it is its turn or "waiting" if not, returns the move relayed
+
+        expecting is "piece" or "location", what the step plays
+        """
+        if mine:
+            if self.think[1] > 0:
+                await asyncio.sleep(self.rng.uniform(*self.think))
+            message = choose()
+        else:
+            message = "waiting"
+        if self.dropping():
+            # Dropped before the message was sent
+            relayed = await self.resume(board, expecting, message)
+        else:
+            start = time.perf_counter()
+            self.writer.write(encode(message))
+            # Only a pick is dropped after sending, a placement can end the game while away
+            if expecting == "piece" and self.dropping():
+                relayed = await self.resume(board, expecting, message)
+            else:
+                relayed = await self.expect()
+                if mine:
+                    self.stats.round_trips.append(time.perf_counter() - start)
+        if mine and relayed != message:
+            raise BotError("wrong move relayed")
+        return relayed
+
+    def dropping(self):
+        """Check if the connection should be dropped now"""
+        return self.token is not None and self.rng.random() < self.drop_rate
+
+    async def resume(self, board, expecting, message):
+        """Drop the connection, then resume the game with the session token
+
+        Returns the move the step relayed, sending message again if the snapshot shows the step
+        was not played while the bot was away
+        """
+        self.writer.transport.abort()
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except asyncio.TimeoutError as error:
+            raise BotError("connect timeout") from error
+        self.frames = FrameReader()
+        self.writer.write(encode_resume(self.token))
+        reply = await self.recv(self.timeout, "timeout")
+        if reply is None or not reply.startswith("board,"):
+            raise BotError("resume refused")
+        self.stats.resume_waits.append(time.perf_counter() - start)
+        self.stats.errors["resumed"] += 1
+        missed = missed_move(board, expecting, reply)
+        if missed is not None:
+            return missed
+        self.writer.write(encode(message))
+        return await self.expect()
+
+    async def expect(self):
+        """Get the next message of the game, raises when the game cannot go on"""
+        message = await self.recv(self.timeout, "timeout")
+        while message is not None and message.startswith("token,"):
+            self.token = message[6:]
+            message = await self.recv(self.timeout, "timeout")
+        if message is None:
+            raise BotError("disconnected")
+        if message.startswith("error,"):
+            raise BotError(f"refused {message[6:]}")
+        if "," in message and not message.startswith("("):
+            raise Repaired(message)
+        return message
+
+    async def recv(self, timeout, kind):
+        """Get the next message, None when the server closed, raises kind if none comes in time"""
+        message = self.frames.pop()
+        while message is None:
+            try:
+                data = await asyncio.wait_for(self.reader.read(4096), timeout)
+            except asyncio.TimeoutError as error:
+                raise BotError(kind) from error
+            if not data:
+                return None
+            try:
+                self.frames.feed(data)
+            except ProtocolError as error:
+                raise BotError("bad data") from error
+            message = self.frames.pop()
+        return message
+
+
+def raise_file_limit(bots):
+    """Raise the soft limit on open files so every bot can have a socket"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = bots + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+async def run_load(host, port, bots, games, think=(0, 0), ramp=0, timeout=30, pair_timeout=10,
+                   seed=None, drop_rate=0):
+    """Run the bots against the server, returns the LoadStats
+
+    Bot starts are spread evenly over ramp seconds so the server's accept backlog is not flooded
+    """
+    stats = LoadStats()
+    rng = random.Random(seed)
+
+    async def start_bot(index):
+        await asyncio.sleep(ramp*index/bots)
+        bot = Bot(host, port, stats, think, random.Random(rng.random()), timeout, pair_timeout,
+                  drop_rate)
+        await bot.run(games)
+
+    await asyncio.gather(*(start_bot(index) for index in range(0, bots)))
+    return stats
+
+
+def print_report(report):
+    """Print the results for a person to read"""
+    print(f"{report['games']} games, {report['moves']} moves in {report['seconds']:.2f}s, "
+          f"{report['games_per_second']:.1f} games/s")
+    for name in ("pair_wait_ms", "move_round_trip_ms", "resume_ms"):
+        points = ", ".join(f"{point} {value:.2f}" for point, value in report[name].items())
+        print(f"{name:<20} {points or 'none'}")
+    errors = ", ".join(f"{kind}: {count}" for kind, count in sorted(report["errors"].items()))
+    print(f"{'errors':<20} {errors or 'none'}")
+
+
+def main():
+    """Run the load generator from the command line"""
+    config = load_config()
+    parser = argparse.ArgumentParser(description="Load a quatro server with headless bots")
+    parser.add_argument("--host", default=config["host"])
+    parser.add_argument("--port", type=int, default=int(config["port"]))
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--games", type=int, default=1, help="games each bot plays")
+    parser.add_argument("--think", type=float, nargs=2, default=[0, 0], metavar=("MIN", "MAX"),
+                        help="seconds a bot waits before each of its moves")
+    parser.add_argument("--ramp", type=float, default=0,
+                        help="seconds to spread the bots' first connections over")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to wait for the server during a game")
+    parser.add_argument("--pair-timeout", type=float, default=10,
+                        help="seconds to wait for an opponent before giving up")
+    parser.add_argument("--drop-rate", type=float, default=0,
+                        help="chance of a bot dropping its connection at each message and "
+                             "resuming, needs resume_grace set on the server")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="json file to save the results to")
+    args = parser.parse_args()
+
+    raise_file_limit(args.bots)
+    stats = asyncio.run(run_load(args.host, args.port, args.bots, args.games, tuple(args.think),
+                                 args.ramp, args.timeout, args.pair_timeout, args.seed,
+                                 args.drop_rate))
+    report = stats.report()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
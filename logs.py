@@ -0,0 +1,115 @@
+"""Logging for the server and client that writes from a background thread
+
+Loggers only put records on a queue, a QueueListener thread formats them and writes them to the
+console and the rotating log file, so game threads, event loops and the client's Tk loop never
+wait on those writes. QUATRO_LOG_LEVEL (DEBUG, INFO, WARNING...) sets the level, INFO by default
+or when it is not a level. Forked workers call use_own_log_files so each one rotates a file of its
+own
+
+event() logs a message with key=value fields and checks the level before doing anything else, so
+a debug event that is turned off costs a call and a cached level check
+"""
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_FORMAT = '[{asctime}] [{levelname:<7}] {name}: {message}{fields_text}'
+
+# (QueueHandler, QueueListener) of every logger set up in this process
+_LISTENERS = []
+
+
+class FieldsFormatter(logging.Formatter):
+    """Formatter that adds the fields given to event() after the message"""
+    def format(self, record):
+        fields = getattr(record, "fields", None)
+        record.fields_text = "".join(f" {key}={value}" for key, value in fields.items()) \
+            if fields else ""
+        return super().format(record)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues records as they are, the listener thread does all the formatting"""
+    def prepare(self, record):
+        return record
+
+
+def setup_queue_logging(name, log_file="./logs/latest.log"):
+    """Get the named logger writing to the console and log_file through a listener thread"""
+    log = logging.getLogger(name)
+    if log.handlers:
+        # Already set up, by this process or the one it was forked from
+        return log
+    level = os.environ.get("QUATRO_LOG_LEVEL", "INFO").upper()
+    bad_level = not isinstance(logging.getLevelName(level), int)
+    log.setLevel("INFO" if bad_level else level)
+
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    fmt = FieldsFormatter(LOG_FORMAT, DATE_FORMAT, style='{')
+    file_handler = RotatingFileHandler(log_file, mode='a', maxBytes=5*1024*1024, backupCount=2)
+    file_handler.setFormatter(fmt)
+    # Log to the console as well for quick live debugging
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(fmt)
+
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    listener = QueueListener(records, file_handler, stream_handler)
+    listener.start()
+    _LISTENERS.append((queue_handler, listener))
+    log.addHandler(queue_handler)
+    if bad_level:
+        log.warning("QUATRO_LOG_LEVEL %r is not a level, logging at INFO", level)
+    return log
+
+
+def event(logger, level, message, **fields):
+    """Log the message with key=value fields, nothing is built if the level is disabled"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+
+def stop_logging():
+    """Write out every queued record and stop the listener threads"""
+    while _LISTENERS:
+        _, listener = _LISTENERS.pop()
+        listener.stop()
+
+
+def use_own_log_files(suffix):
+    """Write this process's logs to files of its own, named after the shared ones with suffix
+
+    Forked processes share their parent's log files, where each one would rotate the file out
+    from under the others
+    """
+    for _, listener in _LISTENERS:
+        handlers = []
+        for handler in listener.handlers:
+            if isinstance(handler, RotatingFileHandler):
+                root, ext = os.path.splitext(handler.baseFilename)
+                own = RotatingFileHandler(f"{root}-{suffix}{ext}", mode='a',
+                                          maxBytes=handler.maxBytes,
+                                          backupCount=handler.backupCount)
+                own.setFormatter(handler.formatter)
+                # Only closes this process's copy of the file
+                handler.close()
+                handler = own
+            handlers.append(handler)
+        listener.handlers = tuple(handlers)
+
+
+def _restart_after_fork():
+    """A forked child has no listener thread, give each logger a new queue and listener"""
+    for i, (queue_handler, listener) in enumerate(_LISTENERS):
+        records = queue.SimpleQueue()
+        queue_handler.queue = records
+        listener = QueueListener(records, *listener.handlers)
+        listener.start()
+        _LISTENERS[i] = (queue_handler, listener)
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
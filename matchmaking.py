@@ -0,0 +1,120 @@
+"""Matchmaking lobby that pairs waiting players in the order they arrived
+
+Players wait in a FIFO per rating bucket. Joining, pairing and cancelling are O(1) under one lock,
+so the accept loop, game threads and event loop callbacks can all call them at once. Players with
+no rating, or every player when there is no bucket size, share one queue
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class Lobby:
+    """Players waiting for an opponent
+
+    bucket_size groups ratings into buckets, a player is paired with the longest waiting player
+    in its own bucket, then in the buckets up to spread either side of it. The seconds each paired
+    player waited are given to pair_wait.observe if it is set
+    """
+    def __init__(self, bucket_size=None, spread=1, pair_wait=None):
+        self.bucket_size = bucket_size
+        self.pair_wait = pair_wait
+        self.offsets = [0]
+        for i in range(1, spread+1):
+            self.offsets += [-i, i]
+        # bucket -> the connections waiting in it, oldest first
+        self.buckets = {}
+        # connection -> (bucket, time it joined) for every waiting connection, oldest first
+        self.joined = OrderedDict()
+        self.lock = threading.Lock()
+        self.paired = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.joined)
+
+    def __contains__(self, connection):
+        return connection in self.joined
+
+    def bucket(self, rating):
+        """Get the bucket a rating waits in"""
+        if self.bucket_size is None or rating is None:
+            return None
+        return int(rating // self.bucket_size)
+
+    def join(self, connection, rating=None):
+        """Pair the connection with the longest waiting player near its rating
+
+        Returns the opponent, or None when the connection was queued to wait. Waiting players
+        that disconnected without being cancelled are dropped as they are reached
+        """
+        bucket = self.bucket(rating)
+        with self.lock:
+            opponent = self._pop_opponent(bucket)
+            if opponent is None:
+                self.buckets.setdefault(bucket, OrderedDict())[connection] = None
+                self.joined[connection] = (bucket, time.monotonic())
+            else:
+                self.paired += 1
+            return opponent
+
+    def _pop_opponent(self, bucket):
+        """Take the longest waiting connected player near the bucket, needs the lock"""
+        offsets = self.offsets if bucket is not None else [0]
+        for offset in offsets:
+            near = bucket + offset if bucket is not None else None
+            queue = self.buckets.get(near)
+            while queue:
+                opponent, _ = queue.popitem(last=False)
+                _, joined = self.joined.pop(opponent)
+                if not queue:
+                    del self.buckets[near]
+                if opponent.connected:
+                    if self.pair_wait is not None:
+                        self.pair_wait.observe(time.monotonic() - joined)
+                    return opponent
+                self.cancelled += 1
+        return None
+
+    def _remove(self, connection):
+        """Take a connection out of its bucket, needs the lock"""
+        bucket, _ = self.joined.pop(connection)
+        queue = self.buckets[bucket]
+        del queue[connection]
+        if not queue:
+            del self.buckets[bucket]
+
+    def cancel(self, connection):
+        """Stop a connection waiting, returns False if it was not waiting"""
+        with self.lock:
+            if connection not in self.joined:
+                return False
+            self._remove(connection)
+            self.cancelled += 1
+            return True
+
+    def oldest(self):
+        """Time the longest waiting player joined, None if no one is waiting"""
+        with self.lock:
+            if not self.joined:
+                return None
+            return next(iter(self.joined.values()))[1]
+
+    def pop_stale(self, max_wait):
+        """Take every player that has waited longer than max_wait seconds"""
+        cutoff = time.monotonic() - max_wait
+        stale = []
+        with self.lock:
+            while self.joined:
+                connection, (_, joined) = next(iter(self.joined.items()))
+                if joined > cutoff:
+                    break
+                self._remove(connection)
+                stale.append(connection)
+        return stale
+
+    def clear(self):
+        """Forget every waiting player"""
+        with self.lock:
+            self.buckets.clear()
+            self.joined.clear()
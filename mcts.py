@@ -0,0 +1,295 @@
+"""Monte Carlo tree search player
+
+Each half of a turn is its own node, a place node picks the cell for the piece in hand and a give
+node picks the piece for the opponent. Leaves are played out with greedy random rollouts, which
+can be spread over a pool of worker processes. The tree is kept between moves and walked down
+the moves that were played since
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import time
+
+from game_objects import Board, CELLS
+
+PLACE = 0
+GIVE = 1
+
+
+class Node:
+    """A decision in the tree
+
+    mover is who decides here (0 is the player the tree was built for), wins are counted for the
+    player who made the move into this node
+    """
+    __slots__ = ("parent", "move", "kind", "mover", "hand", "children", "untried", "visits",
+                 "wins", "terminal", "winner")
+
+    def __init__(self, parent, move, kind, mover, hand):
+        self.parent = parent
+        self.move = move
+        self.kind = kind
+        self.mover = mover
+        self.hand = hand
+        self.children = {}
+        self.untried = None
+        self.visits = 0
+        self.wins = 0.0
+        self.terminal = False
+        self.winner = None
+
+    def moves(self, board):
+        """The moves that can be made from this node on the board at this node"""
+        if self.kind == PLACE:
+            occupied = board.bit_board.occupied
+            return [cell for cell in range(0, CELLS) if not occupied >> cell & 1]
+        return list(board.unplayed_pieces)
+
+    def best_child(self, exploration):
+        """Pick the child with the highest UCT score"""
+        log_visits = math.log(self.visits)
+        best = None
+        best_score = -1.0
+        for child in self.children.values():
+            score = child.wins/child.visits + exploration*math.sqrt(log_visits/child.visits)
+            if score > best_score:
+                best = child
+                best_score = score
+        return best
+
+    def most_visited(self):
+        """Get the (move, child) that was explored the most"""
+        return max(self.children.items(), key=lambda item: item[1].visits)
+
+
+def rollout(board, kind, mover, hand, rng):
+    """Play the game out from a position, returns the winner (0 or 1) or None for a draw
+
+    Wins are taken when possible and pieces that let the opponent win are not given unless there
+    is nothing else, the board is left as it was found
+    """
+    bit_board = board.bit_board
+    made = 0
+    try:
+        while True:
+            if kind == PLACE:
+                if bit_board.winning_cell(hand) is not None:
+                    return mover
+                occupied = bit_board.occupied
+                cell = rng.choice([cell for cell in range(0, CELLS) if not occupied >> cell & 1])
+                board.make_move(cell, hand)
+                made += 1
+                if not board.unplayed_pieces:
+                    return None
+            pieces = list(board.unplayed_pieces)
+            threats = bit_board.threats()
+            safe = [piece for piece in pieces if not threats >> piece & 1]
+            hand = rng.choice(safe or pieces)
+            mover = 1 - mover
+            kind = PLACE
+    finally:
+        for _ in range(0, made):
+            board.unmake_move()
+
+
+def rollout_task(task):
+    """Run rollouts in a worker, task is (cells, kind, mover, hand, count, seed)
+
+    Returns the number of (player 0 wins, player 1 wins, draws)
+    """
+    cells, kind, mover, hand, count, seed = task
+    board = Board.from_array(cells)
+    rng = random.Random(seed)
+    results = [0, 0, 0]
+    for _ in range(0, count):
+        winner = rollout(board, kind, mover, hand, rng)
+        results[2 if winner is None else winner] += 1
+    return results
+
+
+class MCTSPlayer:
+    """Plays the most visited move after searching for budget seconds
+
+    With more than one worker leaves are picked in batches (each adding a virtual loss along its
+    path so the batch spreads out) and their rollouts run on a process pool
+    """
+    def __init__(self, rng=None, budget=1.0, workers=1, batch_size=None, rollouts=4,
+                 exploration=1.0):
+        self.rng = rng or random.Random()
+        self.budget = budget
+        self.workers = workers
+        self.batch_size = batch_size or 2*workers
+        self.rollouts = rollouts
+        self.exploration = exploration
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+        self.root = None
+        self.root_moves = ()
+        self.playouts = 0
+        self.elapsed = 0.0
+
+    @property
+    def playouts_per_second(self):
+        """Rollouts run per second during the last move"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.playouts/self.elapsed
+
+    def close(self):
+        """Stop the worker pool"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def play_turn(self, board, hand):
+        """Get the (cell, piece id to give) for the piece id in hand, see simulate.RandomPlayer"""
+        root = self.advance(board, hand)
+        start = time.perf_counter()
+        deadline = start + self.budget
+        self.playouts = 0
+        while time.perf_counter() < deadline:
+            self.iterate(board, root)
+        self.elapsed = time.perf_counter() - start
+        return self.choose(board, root)
+
+    def advance(self, board, hand):
+        """Find the node for the position in the kept tree, or start a new tree"""
+        moves = tuple((cell, piece) for cell, piece, _ in board.undo_stack)
+        node = None
+        if self.root is not None and moves[:len(self.root_moves)] == self.root_moves:
+            node = self.root
+            for cell, piece in moves[len(self.root_moves):]:
+                if node is not None and node.kind == GIVE:
+                    node = node.children.get(piece)
+                if node is not None:
+                    node = node.children.get(cell)
+            if node is not None and node.kind == GIVE and hand is not None:
+                node = node.children.get(hand)
+            if node is not None and (node.kind != PLACE or node.hand != hand):
+                node = None
+        if node is None:
+            node = Node(None, None, GIVE if hand is None else PLACE, 0, hand)
+        node.parent = None
+        self.root = node
+        self.root_moves = moves
+        return node
+
+    def select(self, board, root):
+        """Walk down to a leaf, expanding one new child, returns the path
+
+        The moves are made on the board and have to be taken back by the caller
+        """
+        node = root
+        path = [node]
+        while not node.terminal:
+            if node.untried is None:
+                node.untried = node.moves(board)
+                self.rng.shuffle(node.untried)
+            if node.untried:
+                move = node.untried.pop()
+                node = self.expand(board, node, move)
+                path.append(node)
+                break
+            node = node.best_child(self.exploration)
+            self.make(board, path[-1], node)
+            path.append(node)
+        return path
+
+    def expand(self, board, node, move):
+        """Add the child for the move and make it on the board"""
+        if node.kind == PLACE:
+            child = Node(node, move, GIVE, node.mover, None)
+            if board.make_move(move, node.hand):
+                child.terminal = True
+                child.winner = node.mover
+            elif not board.unplayed_pieces:
+                child.terminal = True
+        else:
+            child = Node(node, move, PLACE, 1 - node.mover, move)
+        node.children[move] = child
+        return child
+
+    @staticmethod
+    def make(board, node, child):
+        """Make the move from node to child on the board"""
+        if node.kind == PLACE:
+            board.make_move(child.move, node.hand)
+
+    @staticmethod
+    def backpropagate(path, results):
+        """Add the rollout results to every node in the path, visits were already added"""
+        for node in path[1:]:
+            player = node.parent.mover
+            node.wins += results[player] + results[2]/2
+
+    def iterate(self, board, root):
+        """Run one batch of selection, rollouts and backpropagation"""
+        depth = len(board.undo_stack)
+        batch = []
+        for _ in range(0, self.batch_size if self.pool else 1):
+            path = self.select(board, root)
+            leaf = path[-1]
+            # Visits go in straight away as a virtual loss for the rest of the batch
+            for node in path:
+                node.visits += self.rollouts
+            if leaf.terminal:
+                results = [0, 0, 0]
+                results[2 if leaf.winner is None else leaf.winner] = self.rollouts
+                self.backpropagate(path, results)
+            elif self.pool is None:
+                results = [0, 0, 0]
+                for _ in range(0, self.rollouts):
+                    winner = rollout(board, leaf.kind, leaf.mover, leaf.hand, self.rng)
+                    results[2 if winner is None else winner] += 1
+                self.backpropagate(path, results)
+            else:
+                batch.append((path, (board.to_array(), leaf.kind, leaf.mover, leaf.hand,
+                                     self.rollouts, self.rng.getrandbits(32))))
+            while len(board.undo_stack) > depth:
+                board.unmake_move()
+            self.playouts += self.rollouts
+
+        if batch:
+            for (path, _), results in zip(batch, self.pool.map(rollout_task,
+                                                               [task for _, task in batch])):
+                self.backpropagate(path, results)
+
+    def choose(self, board, root):
+        """Pick the most visited cell then the most visited piece to give after it"""
+        cell = None
+        node = root
+        if root.kind == PLACE:
+            if not root.children:
+                return None, None
+            cell, node = root.most_visited()
+            if node.terminal:
+                return cell, None
+        if node.children:
+            return cell, node.most_visited()[0]
+        pieces = [piece for piece in board.unplayed_pieces if piece != root.hand]
+        return cell, self.rng.choice(pieces) if pieces else None
+
+
+def main():
+    """Report playouts per second from the empty board for 1, 2, 4... worker processes"""
+    parser = argparse.ArgumentParser(description="Measure MCTS playout speed")
+    parser.add_argument("--budget", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    worker_counts = [2**i for i in range(0, args.workers.bit_length()) if 2**i < args.workers]
+    worker_counts.append(args.workers)
+    for workers in worker_counts:
+        player = MCTSPlayer(random.Random(1), budget=args.budget, workers=workers)
+        board = Board()
+        board.make_move(0, 0)
+        cell, piece = player.play_turn(board, 1)
+        player.close()
+        print(f"{workers} workers: {player.playouts} playouts in {player.elapsed:.2f}s, "
+              f"{player.playouts_per_second:.0f} playouts/s, plays {cell} gives {piece}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""In-process metrics for the game server, served over HTTP in the Prometheus text format
+
+Set metrics_port in config.json and scrape http://127.0.0.1:<metrics_port>/metrics. Counters and
+histograms take a lock for a few operations when updated, gauges are only read when scraped
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+
+
+class Counter:
+    """A count that only goes up"""
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add to the count"""
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        """Lines of the counter in the text format"""
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter",
+                f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """A value read from a function when the metrics are scraped
+
+    kind is 'counter' for a count kept elsewhere, such as the registry's reaped counts
+    """
+    def __init__(self, name, help_text, read, kind="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+
+    def render(self):
+        """Lines of the gauge in the text format"""
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {self.read()}"]
+
+
+class Histogram:
+    """Counts of observed values in buckets, with their count and sum"""
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # One more count for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Add a value"""
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self):
+        """Lines of the histogram in the text format, the buckets are cumulative"""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class ServerMetrics:
+    """The metrics of one server, gauges read its registry and lobby"""
+    def __init__(self, server):
+        self.moves = Counter("quatro_moves_total", "Pieces placed")
+        self.refused = Counter("quatro_refused_moves_total", "Illegal moves refused")
+        self.resumes = Counter("quatro_resumes_total", "Players that reconnected to their game")
+        self.pair_wait = Histogram("quatro_pair_wait_seconds",
+                                   "Time a player waited in the lobby before being paired")
+        self.turn_wait = Histogram("quatro_turn_wait_seconds",
+                                   "Time from a turn starting to both players responding")
+        self.send_time = Histogram("quatro_send_seconds",
+                                   "Time to send a move to both players of a game")
+        def counts(key):
+            return lambda: server.registry.counts()[key]
+        self.metrics = [
+            Gauge("quatro_connections", "Open player connections", counts("connections")),
+            Gauge("quatro_waiting_players", "Players waiting in the lobby",
+                  lambda: len(server.lobby)),
+            Gauge("quatro_games", "Games being played", counts("games")),
+            Gauge("quatro_games_reaped_total", "Games finished or aborted",
+                  counts("games_reaped"), "counter"),
+            Gauge("quatro_connections_reaped_total", "Connections closed",
+                  counts("connections_reaped"), "counter"),
+            Gauge("quatro_spectators", "Spectators watching games",
+                  lambda: len(server.spectators)),
+            Gauge("quatro_spectators_dropped_total", "Spectators disconnected for falling behind",
+                  lambda: server.spectators.dropped, "counter"),
+            Gauge("quatro_sessions", "Session tokens that can resume a game",
+                  lambda: len(server.sessions)),
+            self.moves, self.refused, self.resumes, self.pair_wait, self.turn_wait, self.send_time]
+
+    def render(self):
+        """All the metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, config, offset=0):
+    """Start the endpoint if config sets metrics_port, returns the HTTP server or None
+
+    offset is added to the port, so each process of a sharded server has its own
+    """
+    port = config.get("metrics_port")
+    if not port:
+        return None
+    return start_http_server(metrics, config.get("metrics_host", "127.0.0.1"), int(port) + offset)
+
+
+def start_http_server(metrics, host, port):
+    """Serve /metrics from a daemon thread, returns the HTTP server to shut it down with"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Answers scrapes of /metrics"""
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            """Scrapes are not logged"""
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,287 @@
+"""Framed binary protocol between the clients and the server
+
+Every message is a frame of one length byte followed by that many bytes. The first byte of a
+message has its type in the high 4 bits and a small value in the low 4 bits, so picking a piece
+or a location is a single byte (2 on the wire with the length)
+
+    HELLO     0x00, version, role text ("client", "spectator,<game id>", "resume,<token>", or
+              "testing" to stop the server and "testing2" to reset its games)
+    START     0x10 | player << 2 | first player
+    PIECE     0x20 | piece id
+    LOCATION  0x30 | y*4 + x
+    WAITING   0x40
+    ERROR     0x50 | error code
+    SNAPSHOT  0x60 | player << 1 | placing, the board's piece bits (8 bytes), occupied cells
+              (2 bytes) and the piece in hand, all little endian
+    TOKEN     0x70, a player's session token (8 bytes)
+
+The game code still works with the strings the protocol used to send ('0101', '(1, 2)', 'waiting'
+and '1,2', plus 'error,code', 'board,...' for a snapshot and 'token,<hex>'), encode and
+FrameReader convert between those and frames at the socket
+
+For the tools from before the protocol a connection that does not start with a HELLO frame is
+read as plain text instead, the whole text is the role ("testing", "testing2" or "client") and it
+has to arrive in the connection's first read
+
+A spectator says hello with the role 'spectator,<game id>', it is sent a SNAPSHOT of the game and
+then every piece and location the players are sent
+
+Each player is sent its session token after START. A player that loses its connection can say
+hello with the role 'resume,<token>' within the server's resume_grace, it is sent a SNAPSHOT and
+then sends its message for the step the snapshot is at, see missed_move
+"""
+from collections import deque
+
+from game_objects import Board, CELLS, EMPTY, PIECE_BINS, PIECE_IDS, R_LEN
+from sessions import TOKEN_LEN
+
+VERSION = 1
+MAX_FRAME = 255
+
+HELLO = 0x00
+START = 0x10
+PIECE = 0x20
+LOCATION = 0x30
+WAITING = 0x40
+ERROR = 0x50
+SNAPSHOT = 0x60
+TOKEN = 0x70
+
+# Error codes sent in the low bits of an ERROR message
+BAD_MESSAGE = 1
+PIECE_PLAYED = 2
+CELL_TAKEN = 3
+NO_GAME = 4
+NO_SESSION = 5
+
+
+class ProtocolError(Exception):
+    """Raised for data that does not follow the protocol"""
+
+
+def frame(message):
+    """Put the length in front of a message"""
+    if len(message) > MAX_FRAME:
+        raise ProtocolError(f"message of {len(message)} bytes is too long for a frame")
+    return bytes((len(message),)) + message
+
+
+def encode_hello(role="client"):
+    """Frame for the first message a connection sends"""
+    return frame(bytes((HELLO, VERSION)) + role.encode())
+
+
+def encode_watch(game_id):
+    """Frame for the first message of a spectator of the game"""
+    return encode_hello(f"spectator,{game_id}")
+
+
+def spectated_game(role):
+    """Get the game id a HELLO role asks to watch, None if it is not a spectator's role"""
+    kind, _, game_id = role.partition(",")
+    if kind != "spectator" or not game_id.isdigit():
+        return None
+    return int(game_id)
+
+
+def encode_resume(token):
+    """Frame for the first message of a player resuming its game with its session token"""
+    return encode_hello(f"resume,{token}")
+
+
+def resumed_session(role):
+    """Get the session token a HELLO role resumes, None if it is not a resuming player's role"""
+    kind, _, token = role.partition(",")
+    if kind != "resume" or len(token) != TOKEN_LEN:
+        return None
+    try:
+        bytes.fromhex(token)
+    except ValueError:
+        return None
+    return token
+
+
+def snapshot(board, play_state, hand=None):
+    """Text of a snapshot of the board, play_state is like '1c' and hand the piece to place"""
+    bit_board = board.bit_board
+    return f"board,{play_state},{hand or '-'},{bit_board.bits:016x},{bit_board.occupied:04x}"
+
+
+def read_snapshot(text):
+    """Get the (board, play_state, hand) from the text of a snapshot
+
+    hand is None when no piece is waiting to be placed
+    """
+    _, play_state, hand, bits, occupied = text.split(",")
+    bits = int(bits, 16)
+    occupied = int(occupied, 16)
+    board = Board.from_array([bits >> (4*cell) & 0xF if occupied >> cell & 1 else EMPTY
+                              for cell in range(0, CELLS)])
+    return board, play_state, None if hand == "-" else hand
+
+
+def missed_move(board, expecting, text):
+    """Get the piece or location a resumed player missed while it was away
+
+    board is the player's own board and expecting is "piece" or "location", what it was waiting
+    to be sent when it lost its connection. None means that step was not played yet, so the
+    player must send its message for it again
+    """
+    snapshot_board, _, hand = read_snapshot(text)
+    if expecting == "piece":
+        return hand
+    new_cells = snapshot_board.bit_board.occupied & ~board.bit_board.occupied
+    if not new_cells:
+        return None
+    cell = new_cells.bit_length() - 1
+    return str((cell % R_LEN, cell // R_LEN))
+
+
+def encode_error(code):
+    """Frame telling the other side its last message was refused"""
+    return frame(bytes((ERROR | code,)))
+
+
+def encode(text):
+    """Frame for one of the game's text messages"""
+    text = str(text)
+    if text in PIECE_IDS:
+        return frame(bytes((PIECE | PIECE_IDS[text],)))
+    if text == "waiting":
+        return frame(bytes((WAITING,)))
+    if text.startswith("("):
+        x, y = map(int, text[1:-1].split(","))
+        if not (0 <= x < R_LEN and 0 <= y < R_LEN):
+            raise ProtocolError(f"location {text} is off the board")
+        return frame(bytes((LOCATION | (y*R_LEN + x),)))
+    if text.startswith("error,"):
+        return encode_error(int(text[6:]))
+    if text.startswith("token,"):
+        return frame(bytes((TOKEN,)) + bytes.fromhex(text[6:]))
+    if text.startswith("board,"):
+        _, play_state, hand, bits, occupied = text.split(",")
+        value = int(play_state[0]) << 1 | (play_state[1] == "p")
+        hand_id = EMPTY if hand == "-" else PIECE_IDS[hand]
+        return frame(bytes((SNAPSHOT | value,)) + int(bits, 16).to_bytes(8, "little")
+                     + int(occupied, 16).to_bytes(2, "little") + bytes((hand_id,)))
+    if "," in text:
+        player, first = map(int, text.split(","))
+        return frame(bytes((START | player << 2 | first,)))
+    raise ProtocolError(f"no encoding for message {text!r}")
+
+
+def encode_many(texts):
+    """Frames for several messages, to be sent in one write"""
+    return b"".join(encode(text) for text in texts)
+
+
+def decode(message):
+    """Get the game's text form of a message (without its length byte)
+
+    Anything wrong with the message raises ProtocolError, so readers only have one error to handle
+    """
+    try:
+        return decode_message(message)
+    except ProtocolError:
+        raise
+    except Exception as error:  # pylint: disable=broad-except
+        raise ProtocolError(f"bad message {bytes(message[:1]).hex()}: {error!r}") from error
+
+
+def decode_message(message):
+    """Decode a message for decode, which turns any error into ProtocolError"""
+    if not message:
+        raise ProtocolError("empty message")
+    kind = message[0] & 0xF0
+    value = message[0] & 0x0F
+    if kind == PIECE:
+        return PIECE_BINS[value]
+    if kind == LOCATION:
+        return str((value % R_LEN, value // R_LEN))
+    if kind == WAITING:
+        return "waiting"
+    if kind == START:
+        return f"{value >> 2},{value & 0x3}"
+    if kind == ERROR:
+        return f"error,{value}"
+    if kind == TOKEN and len(message) == 9:
+        return f"token,{message[1:].hex()}"
+    if kind == SNAPSHOT and len(message) == 12:
+        play_state = f"{value >> 1}{'p' if value & 1 else 'c'}"
+        bits = int.from_bytes(message[1:9], "little")
+        occupied = int.from_bytes(message[9:11], "little")
+        hand = "-" if message[11] == EMPTY else PIECE_BINS[message[11]]
+        return f"board,{play_state},{hand},{bits:016x},{occupied:04x}"
+    if kind == HELLO and len(message) >= 2:
+        try:
+            role = message[2:].decode()
+        except UnicodeDecodeError as error:
+            raise ProtocolError("bad hello role") from error
+        return f"hello,{message[1]},{role}"
+    raise ProtocolError(f"unknown message type {kind:#x}")
+
+
+def decode_hello(text):
+    """Get the (version, role) from the decoded HELLO, None if it is not a HELLO"""
+    if not text.startswith("hello,"):
+        return None
+    _, version, role = text.split(",", 2)
+    return int(version), role
+
+
+class FrameReader:
+    """Buffers the bytes read from a socket and splits them into messages
+
+    A read can hold part of a frame or several frames, complete messages are queued until asked
+    for with pop
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.messages = deque()
+
+    def feed(self, data):
+        """Add bytes read from the socket, returns how many messages are waiting"""
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        while start < len(buffer):
+            length = buffer[start]
+            end = start + 1 + length
+            if end > len(buffer):
+                break
+            self.messages.append(decode(bytes(buffer[start+1:end])))
+            start = end
+        del buffer[:start]
+        return len(self.messages)
+
+    def pop(self):
+        """Get the oldest waiting message, or None"""
+        if not self.messages:
+            return None
+        return self.messages.popleft()
+
+
+def read_hello(data, reader):
+    """Get the role from the data a connection sent so far, None until its HELLO is complete
+
+    A HELLO can be split over several reads, the caller keeps reading and passes all the data so
+    far until this returns a role. Data whose second byte is not HELLO is plain text from before
+    the protocol, it is returned as soon as 2 bytes are in and taken as the role whatever it says,
+    so a plain "client" joins the lobby like a framed one. A HELLO frame is fed to the reader so
+    any messages sent straight after it are kept. Raises ProtocolError for a version this server
+    does not speak
+    """
+    if len(data) < 2:
+        return None
+    if data[1] != HELLO:
+        return bytes(data).decode(errors="replace")
+    if len(data) < 1 + data[0]:
+        return None
+    reader.feed(data)
+    hello = decode_hello(reader.pop() or "")
+    if hello is None:
+        raise ProtocolError("connection did not start with a complete HELLO")
+    version, role = hello
+    if version != VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    return role
@@ -0,0 +1,86 @@
+"""Registry of a server's live games and connections
+
+Game ids come from a free list so allocating one is O(1) and ids stay small. Games are reaped when
+they end or abort and connections when they close, so nothing finished is kept on a long running
+server. The counts of live and reaped objects are kept for monitoring
+"""
+import threading
+
+
+class Registry:
+    """Live games by id and live connections, safe to use from any thread"""
+    def __init__(self):
+        self.games = {}
+        self.connections = set()
+        # Ids freed by reaped games, reused before new ids are handed out
+        self.free_ids = []
+        self.next_id = 1
+        self.games_reaped = 0
+        self.connections_reaped = 0
+        self.lock = threading.Lock()
+
+    def add_game(self, game):
+        """Register a game, returns its id"""
+        with self.lock:
+            if self.free_ids:
+                game_id = self.free_ids.pop()
+            else:
+                game_id = self.next_id
+                self.next_id += 1
+            self.games[game_id] = game
+            return game_id
+
+    def reap_game(self, game_id, game):
+        """Remove a finished or aborted game, its id can be reused
+
+        Nothing is done unless the id is still the game's, after a clear a game that ends late
+        must not take out a new game that was given its id
+        """
+        with self.lock:
+            if game_id not in self.games or self.games[game_id] is not game:
+                return
+            del self.games[game_id]
+            self.free_ids.append(game_id)
+            self.games_reaped += 1
+
+    def get_game(self, game_id):
+        """Get the live game with the id, None if there is none"""
+        with self.lock:
+            return self.games.get(game_id)
+
+    def add_connection(self, connection):
+        """Register a connection"""
+        with self.lock:
+            self.connections.add(connection)
+
+    def reap_connection(self, connection):
+        """Remove a closed connection"""
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+                self.connections_reaped += 1
+
+    def live_games(self):
+        """List of the live games"""
+        with self.lock:
+            return list(self.games.values())
+
+    def live_connections(self):
+        """List of the live connections"""
+        with self.lock:
+            return list(self.connections)
+
+    def clear(self):
+        """Forget every game and connection, the counters are kept"""
+        with self.lock:
+            self.games.clear()
+            self.connections.clear()
+            self.free_ids.clear()
+            self.next_id = 1
+
+    def counts(self):
+        """Dict of the live and reaped games and connections"""
+        with self.lock:
+            return {"games": len(self.games), "connections": len(self.connections),
+                    "games_reaped": self.games_reaped,
+                    "connections_reaped": self.connections_reaped}
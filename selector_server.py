@@ -0,0 +1,603 @@
+"""Game server running every connection on one thread with the selectors module (epoll on Linux)
+
+Sockets are non-blocking and each game is a small state machine moved on by the messages that
+arrive, so a connection costs a socket, a FrameReader and an output buffer instead of threads
+
+python server.py --mode selectors
+python selector_server.py --footprint 5000
+"""
+import argparse
+import functools
+import logging
+import selectors
+import socket
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from game_objects import Board
+from game_record import GameRecordWriter
+from matchmaking import Lobby
+from metrics import ServerMetrics, serve_metrics
+from registry import Registry
+from sessions import Sessions
+from validation import IllegalMove, check_pick, check_place
+from protocol import (NO_GAME, NO_SESSION, FrameReader, ProtocolError, encode, encode_error,
+                      encode_many, read_hello, resumed_session, snapshot, spectated_game)
+from spectators import SpectatorHub
+from server import (ConnectionState, load_config, setup_logging, pick_starter, parse_loc,
+                    get_other)
+
+PICK = 0
+PLACE = 1
+
+
+class SelectorConnection:
+    """Non-blocking connection to a client, see server.Connection"""
+    __slots__ = ("server", "logger", "conn", "address", "state", "connected", "rating", "reader",
+                 "out", "events", "game", "index")
+
+    def __init__(self, server, conn, address, state, reader=None):
+        self.server = server
+        self.logger = server.logger
+        self.conn = conn
+        self.address = address
+        self.state = ConnectionState(state)
+        self.connected = True
+        self.rating = None
+        self.reader = reader or FrameReader()
+        # Output the socket has not taken yet, written when the selector says it is writable
+        self.out = bytearray()
+        self.events = 0
+        self.game = None
+        self.index = 0
+
+    def initialize(self):
+        """If a connection was waiting then this is called to tell it that an opponent was found"""
+        self.state = ConnectionState(2)
+
+    def send(self, *data):
+        """Queue the given messages and write as much of them as the socket takes now"""
+        self.send_frames(encode_many(data))
+
+    def send_frames(self, data):
+        """Queue messages that are already framed and write as much as the socket takes now"""
+        if not self.connected:
+            return
+        self.out += data
+        self.flush()
+
+    def flush(self):
+        """Write queued output"""
+        try:
+            sent = self.conn.send(self.out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.connected = False
+            self.out.clear()
+            sent = 0
+        del self.out[:sent]
+        self.server.watch(self)
+
+    def read(self):
+        """Read what the socket has, a closed socket or bad data disconnects"""
+        try:
+            data = self.conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data:
+            try:
+                self.reader.feed(data)
+            except ProtocolError as error:
+                self.logger.warning("Bad data from %s: %s", self.address, error)
+                data = b""
+        if not data:
+            self.connected = False
+            self.out.clear()
+            self.server.watch(self)
+            if self.game is None:
+                self.server.lobby.cancel(self)
+
+    def on_event(self, mask):
+        """Handle the selector reporting the socket readable or writable"""
+        if mask & selectors.EVENT_WRITE and self.out:
+            self.flush()
+        if mask & selectors.EVENT_READ and self.connected:
+            self.read()
+        if self.game is not None:
+            self.game.advance()
+
+    def abort(self):
+        """Abort the connected client connection"""
+        self.logger.warning("A player disconnected, finding the other player a new game")
+        # Pick up a hang up that arrived but was not read yet, so it is not put in a new game
+        if self.connected:
+            self.read()
+        if self.connected:
+            self.server.connection_game_sort(self)
+
+    def close(self):
+        """close connection, the socket is closed once any queued output is written"""
+        self.connected = False
+        self.game = None
+        self.logger.info("Closing connection from %s", self.address)
+        self.server.watch(self)
+
+
+class SelectorGame:
+    """Hosts the game elements as a state machine, see server.Game
+
+    Every step waits for a message from both players, the stage is PICK while the piece is being
+    chosen and PLACE while it is being placed
+    """
+    def __init__(self, server, player1, player2):
+        self.server = server
+        self.board = Board()
+        self.play_state = pick_starter()
+        self.first = int(self.play_state[0])
+        self.players = [player1, player2]
+        self.game_id = server.registry.add_game(self)
+        self.stage = PICK
+        self.responses = [None, None]
+        # When the current step started, for the turn wait metric
+        self.step_started = time.perf_counter()
+        self.picked_piece = None
+        self.finished = False
+        self.tokens = [server.sessions.issue(self, i) for i in range(0, 2)]
+        for i, player in enumerate(self.players):
+            player.game = self
+            player.index = i
+            player.send(f"{i+1},{self.play_state[0]}", f"token,{self.tokens[i]}")
+        server.start_turn(self)
+        # Players moved here from an aborted game may already have sent their next message
+        self.advance()
+
+    def advance(self):
+        """Play every step the players have sent both messages for"""
+        while not self.finished:
+            if not self.check_connections():
+                # A player that disconnected has the server's resume_grace to resume
+                if not self.server.stop and not self.server.wait_for_resume(self):
+                    self.abort_game()
+                return
+            for i, player in enumerate(self.players):
+                if self.responses[i] is None:
+                    self.responses[i] = player.reader.pop()
+            if None in self.responses:
+                return
+            mover = self.players[int(self.play_state[0])-1]
+            response = self.responses[mover.index]
+            check = check_pick if self.stage == PICK else check_place
+            try:
+                check(self.board, response)
+            except IllegalMove as error:
+                # Refuse the move and wait for the mover to send another
+                self.server.metrics.refused.inc()
+                self.server.logger.warning("Refused move from %s: %s", mover.address, error)
+                mover.send(f"error,{error.code}")
+                self.responses[mover.index] = None
+                continue
+            self.responses = [None, None]
+            self.server.metrics.turn_wait.observe(time.perf_counter() - self.step_started)
+            self.play_step(response)
+
+    def play_step(self, response):
+        """Send both players the chosen piece or location and move to the next stage"""
+        data = self.send_to_players(response)
+        if self.stage == PICK:
+            self.picked_piece = response
+            self.play_state = f"{get_other(self.play_state[0])}p"
+            self.stage = PLACE
+            self.server.spectators.publish(self.game_id, data)
+        else:
+            i, j = parse_loc(response)
+            won = self.board.play_move(i, j, self.picked_piece)
+            self.server.metrics.moves.inc()
+            self.play_state = f"{self.play_state[0]}c"
+            self.stage = PICK
+            self.server.spectators.publish(self.game_id, data)
+            if won or not self.board.unplayed_pieces:
+                self.end_game(draw=not won)
+                return
+        self.step_started = time.perf_counter()
+        self.server.start_turn(self)
+
+    def timed_out(self):
+        """Close the players that took longer than the server's turn_timeout"""
+        for i, player in enumerate(self.players):
+            if self.responses[i] is None:
+                self.server.logger.warning("%s took too long to respond", player.address)
+                player.close()
+        self.abort_game()
+
+    def resume(self, index, connection):
+        """Swap a reconnected player in for its old connection
+
+        It is sent a snapshot of the game and its message for this step is waited for again, so
+        whether it sent one before it disconnected does not matter
+        """
+        old = self.players[index]
+        if old.connected:
+            old.close()
+        self.players[index] = connection
+        connection.game = self
+        connection.index = index
+        self.responses[index] = None
+        connection.send_frames(self.snapshot_frame())
+        self.server.metrics.resumes.inc()
+        self.server.logger.info("%s resumed game %s", connection.address, self.game_id)
+        if self.check_connections():
+            self.server.end_resume_wait(self)
+            self.server.start_turn(self)
+        self.advance()
+
+    def finish(self):
+        """Stop the game taking any more messages, spectators or resumes"""
+        self.finished = True
+        self.server.end_turn(self)
+        self.server.end_resume_wait(self)
+        self.server.sessions.end(self.tokens)
+        self.server.spectators.end(self.game_id)
+        self.server.registry.reap_game(self.game_id, self)
+        for player in self.players:
+            player.game = None
+
+    def end_game(self, draw=False):
+        """End the connections between the server and players"""
+        self.finish()
+        self.record_game(0 if draw else int(self.play_state[0]))
+        for player in self.players:
+            player.close()
+
+    def record_game(self, winner, aborted=False):
+        """Write the game's moves to the server's game records if it keeps them"""
+        if self.server.recorder is None or not self.board.undo_stack:
+            return
+        moves = [(cell, piece) for cell, piece, _ in self.board.undo_stack]
+        self.server.recorder.write_game(moves, winner, self.first, aborted)
+
+    def send_to_players(self, data):
+        """Send the data to both players in the game, returns it framed for the spectators"""
+        start = time.perf_counter()
+        data = encode(data)
+        for player in self.players:
+            player.send_frames(data)
+        self.server.metrics.send_time.observe(time.perf_counter() - start)
+        return data
+
+    def add_spectator(self, conn, address):
+        """Start sending the game to a spectator, returns False if the game is over"""
+        if self.finished:
+            return False
+        self.server.spectators.watch(conn, address, self.game_id, self.snapshot_frame())
+        return True
+
+    def snapshot_frame(self):
+        """Framed snapshot of the game for spectators and resumed players"""
+        # The piece in hand is only waiting to be placed in the PLACE stage
+        hand = self.picked_piece if self.stage == PLACE else None
+        return encode(snapshot(self.board, self.play_state, hand))
+
+    def check_connections(self):
+        """tests if all players are connectd"""
+        return all(player.connected for player in self.players)
+
+    def abort_game(self):
+        """aborts all connected players"""
+        self.finish()
+        self.record_game(0, aborted=True)
+        for player in self.players:
+            if player.connected:
+                player.abort()
+
+
+class SelectorServerProgram:
+    """Server program on a selectors event loop, see server.ServerProgram"""
+    def __init__(self):
+        self.logger = setup_logging()
+        config = load_config()
+        self.host = config["host"]
+        self.port = int(config["port"])
+        record_file = config.get("record_file")
+        self.turn_timeout = config.get("turn_timeout")
+        self.resume_grace = config.get("resume_grace")
+        # Seconds a new connection has to send all of its HELLO
+        self.hello_timeout = config.get("hello_timeout", 10)
+        self.config = config
+        self.registry = Registry()
+        self.sessions = Sessions()
+        self.metrics = ServerMetrics(self)
+        self.lobby = Lobby(config.get("rating_bucket"), pair_wait=self.metrics.pair_wait)
+        self.spectators = SpectatorHub(self.logger, config.get("spectator_buffer", 65536))
+        # Added to metrics_port, each worker of a sharded server serves its own metrics
+        self.metrics_offset = 0
+        self.stop = False
+        self.recorder = GameRecordWriter(record_file) if record_file else None
+        self.selector = selectors.DefaultSelector()
+        self.server_socket = None
+        # Game -> deadline of its current step, every step gets the same timeout so moving a game
+        # to the end keeps this in deadline order
+        self.deadlines = OrderedDict()
+        # Game -> when its disconnected player's resume_grace runs out, in deadline order too
+        self.resume_deadlines = OrderedDict()
+        # New socket -> (address, data it sent so far, deadline for its HELLO), in deadline order
+        self.hellos = OrderedDict()
+
+    def serve(self):
+        """Accept connections and play games until a stop command is recieved"""
+        self.server_socket = self.listen()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept)
+        metrics_server = serve_metrics(self.metrics, self.config, self.metrics_offset)
+        self.logger.info("Started listening")
+        while not self.stop:
+            for key, mask in self.selector.select(self.next_timeout()):
+                key.data(mask)
+            self.expire_turns()
+
+        for conn in self.registry.live_connections():
+            if conn.connected:
+                conn.close()
+        self.server_socket.close()
+        self.selector.close()
+        self.spectators.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    def listen(self):
+        """Make the non-blocking listening socket"""
+        server_socket = socket.socket()
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(128)
+        server_socket.setblocking(False)
+        return server_socket
+
+    def watch(self, connection):
+        """Set what the selector waits for on a connection, closing the socket when it is done"""
+        events = 0
+        if connection.connected:
+            events |= selectors.EVENT_READ
+        if connection.out:
+            events |= selectors.EVENT_WRITE
+        if events == connection.events:
+            return
+        if events == 0:
+            self.selector.unregister(connection.conn)
+            try:
+                connection.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.conn.close()
+            self.registry.reap_connection(connection)
+        elif connection.events == 0:
+            self.selector.register(connection.conn, events, connection.on_event)
+        else:
+            self.selector.modify(connection.conn, events, connection.on_event)
+        connection.events = events
+
+    def start_turn(self, game):
+        """Start timing a game's step"""
+        if self.turn_timeout is None:
+            return
+        self.deadlines[game] = time.monotonic() + self.turn_timeout
+        self.deadlines.move_to_end(game)
+
+    def end_turn(self, game):
+        """Stop timing a game"""
+        self.deadlines.pop(game, None)
+
+    def wait_for_resume(self, game):
+        """Start the resume_grace of a game that lost a player, False if there is none
+
+        Its step is not timed while it waits
+        """
+        if not self.resume_grace:
+            return False
+        if game not in self.resume_deadlines:
+            self.logger.info("Waiting %ss for a player of game %s to resume", self.resume_grace,
+                             game.game_id)
+            self.end_turn(game)
+            self.resume_deadlines[game] = time.monotonic() + self.resume_grace
+        return True
+
+    def end_resume_wait(self, game):
+        """Stop a game's resume_grace"""
+        self.resume_deadlines.pop(game, None)
+
+    def next_timeout(self):
+        """Seconds until the first step or resume_grace runs out, None when nothing is timed"""
+        deadlines = [next(iter(waits.values()))
+                     for waits in (self.deadlines, self.resume_deadlines) if waits]
+        if self.hellos:
+            deadlines.append(next(iter(self.hellos.values()))[2])
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def expire_turns(self):
+        """Time out every game whose step or resume_grace ran past its deadline"""
+        now = time.monotonic()
+        while self.deadlines:
+            game, deadline = next(iter(self.deadlines.items()))
+            if deadline > now:
+                break
+            del self.deadlines[game]
+            game.timed_out()
+        while self.resume_deadlines:
+            game, deadline = next(iter(self.resume_deadlines.items()))
+            if deadline > now:
+                break
+            del self.resume_deadlines[game]
+            self.logger.warning("No player resumed game %s in time", game.game_id)
+            game.abort_game()
+        while self.hellos:
+            conn, (address, _, deadline) = next(iter(self.hellos.items()))
+            if deadline > now:
+                break
+            self.logger.warning("Refused %s: no HELLO in time", str(address))
+            self.drop_hello(conn)
+
+    def accept(self, _mask):
+        """Accept waiting connections, each sends its HELLO before it joins a game"""
+        while True:
+            try:
+                conn, address = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            self.logger.info("Connection from: %s", str(address))
+            self.hellos[conn] = (address, bytearray(), time.monotonic() + self.hello_timeout)
+            self.selector.register(conn, selectors.EVENT_READ,
+                                   functools.partial(self.accept_conn, conn, address))
+
+    def drop_hello(self, conn):
+        """Close a new connection that did not send a HELLO it could be let in with"""
+        del self.hellos[conn]
+        self.selector.unregister(conn)
+        conn.close()
+
+    def accept_conn(self, conn, address, _mask):
+        """Handle data from a new connection, once its HELLO is complete act on it"""
+        data = self.hellos[conn][1]
+        frames = FrameReader()
+        try:
+            recieved = conn.recv(1024)
+            if not recieved:
+                raise ProtocolError("connection closed before its HELLO")
+            data += recieved
+            conn_type = read_hello(data, frames)
+        except BlockingIOError:
+            return
+        except (ProtocolError, OSError) as error:
+            self.logger.warning("Refused %s: %s", str(address), error)
+            self.drop_hello(conn)
+            return
+        if conn_type is None:
+            return
+        del self.hellos[conn]
+        self.selector.unregister(conn)
+        if conn_type == "testing":
+            self.logger.warning("STOP COMMAND RECIEVED")
+            self.stop = True
+            conn.close()
+            return
+        if conn_type == "testing2":
+            self.logger.warning("RESETING SERVER GAMES")
+            for connection in self.registry.live_connections():
+                if connection.connected:
+                    connection.close()
+            self.registry.clear()
+            self.sessions.clear()
+            self.deadlines.clear()
+            self.resume_deadlines.clear()
+            self.lobby.clear()
+            conn.close()
+            return
+        token = resumed_session(conn_type)
+        if token is not None:
+            self.resume(conn, address, frames, token)
+            return
+        game_id = spectated_game(conn_type)
+        if game_id is not None:
+            self.add_spectator(conn, address, game_id)
+            return
+        if conn_type != "client":
+            self.logger.warning("Refused %s, unknown connection type %r", str(address), conn_type)
+            conn.close()
+            return
+        self.add_connection(conn, address, frames)
+
+    def add_connection(self, conn, address, frames):
+        """Start watching a client's non-blocking socket and find it a game"""
+        new_connection = SelectorConnection(self, conn, address, 1, frames)
+        self.watch(new_connection)
+        self.registry.add_connection(new_connection)
+        self.connection_game_sort(new_connection)
+        return new_connection
+
+    def resume(self, conn, address, frames, token):
+        """Put a reconnected player back in its game, it is refused if the game is over"""
+        connection = SelectorConnection(self, conn, address, 3, frames)
+        self.watch(connection)
+        self.registry.add_connection(connection)
+        game, index = self.sessions.find(token)
+        if game is None or game.finished:
+            self.logger.warning("Refused resume from %s, its game is over", str(address))
+            connection.send(f"error,{NO_SESSION}")
+            connection.close()
+            return
+        game.resume(index, connection)
+
+    def connection_game_sort(self, connection):
+        """Sort connections into games, pairing with a waiting player or joining the lobby"""
+        opponent = self.lobby.join(connection, connection.rating)
+        if opponent is not None:
+            opponent.initialize()
+            self.logger.info("Creating new game")
+            SelectorGame(self, opponent, connection)
+
+    def add_spectator(self, conn, address, game_id):
+        """Let a connection watch a game, it is refused if the game is not being played"""
+        game = self.registry.get_game(game_id)
+        if game is None or not game.add_spectator(conn, address):
+            self.logger.warning("Refused spectator %s, no game %s", str(address), game_id)
+            try:
+                conn.send(encode_error(NO_GAME))
+            except OSError:
+                pass
+            conn.close()
+
+
+def run_selector_server():
+    """Run the selectors server until it is told to stop"""
+    SelectorServerProgram().serve()
+
+
+def measure_footprint(count):
+    """Python memory used per connection with count clients in games, returns bytes
+
+    The clients are socketpairs so no port is needed. Kernel socket buffers are not counted,
+    they are the same in every server mode
+    """
+    program = SelectorServerProgram()
+    program.logger.setLevel(logging.WARNING)
+    pairs = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(0, count):
+        client, server_end = socket.socketpair()
+        server_end.setblocking(False)
+        pairs.append((client, server_end))
+        program.add_connection(server_end, f"pair-{i}", FrameReader())
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    for client, server_end in pairs:
+        client.close()
+        server_end.close()
+    program.selector.close()
+    program.spectators.stop()
+    if program.recorder is not None:
+        program.recorder.close()
+    return used / count
+
+
+def main():
+    """Run the server, or measure the memory each connection takes"""
+    parser = argparse.ArgumentParser(description="Quatro game server on a selectors event loop")
+    parser.add_argument("--footprint", type=int, metavar="CONNECTIONS",
+                        help="measure the memory per connection instead of serving")
+    args = parser.parse_args()
+    if args.footprint:
+        per_connection = measure_footprint(args.footprint)
+        print(f"{per_connection:.0f} bytes per connection, "
+              f"{2**30/per_connection:,.0f} connections per GB")
+    else:
+        run_selector_server()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,30 @@
 """Simple server program that works"""
-import os
+import argparse
 import socket
 import enum
+import time
 import random
+import select
 import threading
 import logging
 import json
-from logging.handlers import RotatingFileHandler
-from icecream import ic
 
 from game_objects import Board
+from game_record import GameRecordWriter
+from logs import event, setup_queue_logging
+from matchmaking import Lobby
+from metrics import ServerMetrics, serve_metrics
+from registry import Registry
+from sessions import MAX_SHARDS, Sessions
+from validation import IllegalMove, check_pick, check_place
+from protocol import (NO_GAME, NO_SESSION, FrameReader, ProtocolError, encode, encode_error,
+                      encode_many, read_hello, resumed_session, snapshot, spectated_game)
+from spectators import SpectatorHub
+
+# Poll event for a peer that hung up, even with data it sent still unread, None if not supported
+POLLRDHUP = getattr(select, "POLLRDHUP", None)
+# Milliseconds between checks that a player watched for hanging up is still in the lobby
+LOBBY_POLL = 500
 
 
 class ConnectionState(enum.Enum):
@@ -24,13 +39,26 @@ class Game:
     """Hosts the game elements"""
     def __init__(self, server, player1, player2):
         self.server = server
-        server.remove_waiting()
         self.board = Board()
         self.play_state = pick_starter()
+        self.first = int(self.play_state[0])
         self.players = [player1, player2]
+        # The piece picked and not placed yet, sent in snapshots
+        self.hand = None
+        self.finished = False
+        # Held while the board changes and the move is published, so a spectator's snapshot
+        # and the moves it is sent after it always line up
+        self.watch_lock = threading.Lock()
+        self.game_id = server.registry.add_game(self)
+        self.tokens = [server.sessions.issue(self, i) for i in range(0, 2)]
+        # (index, connection) of players that reconnected, put back in by the game thread
+        self.resumes = []
+        self.recv_dict = {}
+        # Recieve threads and the server notify this when a response comes in, a player
+        # disconnects or resumes or the server stops, so waiting for a turn uses no CPU
+        self.recv_condition = threading.Condition()
         self.game_thread = threading.Thread(target=self.start)
         self.game_thread.start()
-        self.recv_dict = {}
 
     def start_wait_to_recieve(self, player, i):
         """Start a thread that waits for the player's client to respond"""
@@ -39,89 +67,235 @@ class Game:
 
     def recieve(self, player, out_index):
         """request to reiceve from the players connection"""
-        self.recv_dict[out_index] = player.recieve()
-
-    def wait_for_responses(self):
-        """Waits for responses from both clients """
-        for i, player in enumerate(self.players):
-            ic(f"attempt to recieve from {player.address}")
+        data = player.recieve()
+        with self.recv_condition:
+            # Data from a connection that was replaced by a resume is not part of the game
+            if data is not None and self.players[out_index] is player:
+                self.recv_dict[out_index] = data
+            self.recv_condition.notify_all()
+
+    def wake(self):
+        """Wake the game thread so it checks for the server stopping"""
+        with self.recv_condition:
+            self.recv_condition.notify_all()
+
+    def responses_ready(self, indexes):
+        """Check if waiting for responses can finish or something needs handling"""
+        return (all(i in self.recv_dict for i in indexes) or self.server.stop or self.resumes
+                or not self.check_connections())
+
+    def wait_for_responses(self, indexes=(0, 1)):
+        """Waits for responses from the players at the indexes, both by default
+
+        Gives up after the server's turn_timeout, closing the players that did not respond. A
+        player that disconnects has the server's resume_grace to resume, it is then waited on
+        for this step again
+        """
+        indexes = set(indexes)
+        start = time.perf_counter()
+        timeout = self.server.turn_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for i in indexes:
             # adds responses to recv_dict
-            self.start_wait_to_recieve(player, i)
-
-        while len(self.recv_dict) < 2:
-            if self.server.stop or not self.check_connections():
-                return None
-        ic(self.recv_dict)
-        ret = self.recv_dict[int(self.play_state[0])-1]
-        self.recv_dict = {}
-        return ret
+            self.start_wait_to_recieve(self.players[i], i)
+
+        with self.recv_condition:
+            while True:
+                self.apply_resumes(indexes)
+                if self.server.stop:
+                    return None
+                if all(i in self.recv_dict for i in indexes):
+                    break
+                if not self.check_connections():
+                    if not self.wait_for_resume():
+                        return None
+                    continue
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                if not self.recv_condition.wait_for(lambda: self.responses_ready(indexes),
+                                                    remaining):
+                    for i in indexes:
+                        if i not in self.recv_dict:
+                            self.server.logger.warning("%s took too long to respond",
+                                                       self.players[i].address)
+                            self.players[i].close()
+                    return None
+            responses = self.recv_dict
+            self.recv_dict = {}
+        self.server.metrics.turn_wait.observe(time.perf_counter() - start)
+        event(self.server.logger, logging.DEBUG, "Responses", game=self.game_id,
+              responses=responses)
+        return responses[int(self.play_state[0])-1]
+
+    def wait_for_resume(self):
+        """Wait for a player that disconnected to resume, returns False if none did in time
+
+        Needs recv_condition
+        """
+        grace = self.server.resume_grace
+        if not grace:
+            return False
+        self.server.logger.info("Waiting %ss for a player of game %s to resume", grace,
+                                self.game_id)
+        return self.recv_condition.wait_for(lambda: self.resumes or self.server.stop, grace)
+
+    def request_resume(self, index, connection):
+        """Queue a reconnected player to be put back in the game, False if the game is over"""
+        with self.recv_condition:
+            if self.finished:
+                return False
+            self.resumes.append((index, connection))
+            self.recv_condition.notify_all()
+            return True
+
+    def apply_resumes(self, indexes):
+        """Swap reconnected players in for their old connections, needs recv_condition
+
+        Each is sent a snapshot of the game and its response for this step is waited for again,
+        so whether it sent one before it disconnected does not matter
+        """
+        while self.resumes:
+            index, connection = self.resumes.pop(0)
+            old = self.players[index]
+            self.players[index] = connection
+            old.close()
+            self.recv_dict.pop(index, None)
+            with self.watch_lock:
+                data = snapshot(self.board, self.play_state, self.hand)
+            connection.send(data)
+            self.server.metrics.resumes.inc()
+            self.server.logger.info("%s resumed game %s", connection.address, self.game_id)
+            indexes.add(index)
+            self.start_wait_to_recieve(connection, index)
+
+    def wait_for_move(self, check):
+        """Wait for the pick or placement of the player whose turn it is
+
+        Moves the board does not allow are answered with a protocol error and the player is
+        waited on again, returns None if the game cannot go on
+        """
+        mover = int(self.play_state[0])-1
+        response = self.wait_for_responses()
+        while response is not None:
+            try:
+                check(self.board, response)
+                return response
+            except IllegalMove as error:
+                self.server.metrics.refused.inc()
+                self.server.logger.warning("Refused move from %s: %s",
+                                           self.players[mover].address, error)
+                self.players[mover].send(f"error,{error.code}")
+                response = self.wait_for_responses((mover,))
+        return None
 
     def start(self):
         """Start the game running"""
         # Send player's number and starting player
         for i, player in enumerate(self.players):
-            data = f"{i+1},{self.play_state[0]}"
-            ic(player.address, data)
-            player.send(data)
+            player.send(f"{i+1},{self.play_state[0]}", f"token,{self.tokens[i]}")
+        event(self.server.logger, logging.DEBUG, "Game started", game=self.game_id,
+              starter=self.play_state[0])
 
-        check_connection = self.check_connections()
-        print(f"check_connections {check_connection}")
-        if not check_connection:
+        if not self.check_connections():
             self.abort_game()
             return
 
-        # Now do the game loop
-        while not self.server.stop and self.check_connections():
+        # Now do the game loop, a player that disconnects is waited for at the next step
+        while not self.server.stop and not self.finished:
             self.play_round()
 
     def play_round(self):
         """Play a round between the two connected clients"""
-        picked_piece = self.wait_for_responses()
+        picked_piece = self.wait_for_move(check_pick)
         if picked_piece is None:
+            if not self.server.stop:
+                self.abort_game()
             return
 
-        check_connection = self.check_connections()
-        for player in self.players:
-            print("player connected?" + str(player.connected))
-        print(f"check_connections {check_connection}")
-        if not check_connection:
-            self.abort_game()
-            return
-
-        print("End of func", picked_piece)
+        event(self.server.logger, logging.DEBUG, "Piece picked", game=self.game_id,
+              piece=picked_piece)
         # initially player only picks a piece
         # Send both players confirmation of the piece chosen
-        self.send_to_players(picked_piece)
-        # Change state to be that the other chooses
-        self.play_state = f"{get_other(self.play_state[0])}p"
-
-        picked_location = self.wait_for_responses()
-
-        check_connection = self.check_connections()
-        print(f"check_connections {check_connection}")
-        if not check_connection:
-            self.abort_game()
+        data = self.send_to_players(picked_piece)
+        with self.watch_lock:
+            self.hand = picked_piece
+            # Change state to be that the other chooses
+            self.play_state = f"{get_other(self.play_state[0])}p"
+            self.server.spectators.publish(self.game_id, data)
+
+        picked_location = self.wait_for_move(check_place)
+        if picked_location is None:
+            if not self.server.stop:
+                self.abort_game()
             return
 
-        ic(picked_location)
-        self.send_to_players(picked_location)
+        event(self.server.logger, logging.DEBUG, "Piece placed", game=self.game_id,
+              location=picked_location)
+        data = self.send_to_players(picked_location)
         i, j = parse_loc(picked_location)
-        self.board.play_move(i, j, picked_piece)
-
-        self.play_state = f"{self.play_state[0]}c"
-        if self.board.check_win():
+        with self.watch_lock:
+            won = self.board.play_move(i, j, picked_piece)
+            self.hand = None
+            self.play_state = f"{self.play_state[0]}c"
+            self.server.spectators.publish(self.game_id, data)
+        self.server.metrics.moves.inc()
+
+        if won:
             self.end_game()
+        elif not self.board.unplayed_pieces:
+            # Board full without a win, no piece is left to pick
+            self.end_game(draw=True)
 
-    def end_game(self):
+    def end_game(self, draw=False):
         """End the connections between the server and players"""
+        self.finish()
+        # The player who placed the last piece won
+        self.record_game(0 if draw else int(self.play_state[0]))
         for player in self.players:
             player.close()
+        self.server.registry.reap_game(self.game_id, self)
+
+    def record_game(self, winner, aborted=False):
+        """Write the game's moves to the server's game records if it keeps them"""
+        if self.server.recorder is None or not self.board.undo_stack:
+            return
+        moves = [(cell, piece) for cell, piece, _ in self.board.undo_stack]
+        self.server.recorder.write_game(moves, winner, self.first, aborted)
 
     def send_to_players(self, data):
-        """Send the data to both players in the game"""
+        """Send the data to both players in the game, returns it framed for the spectators"""
+        start = time.perf_counter()
+        data = encode(data)
         for player in self.players:
-            ic(f"sent to {player.address}")
-            player.send(data)
+            player.send_frames(data)
+        self.server.metrics.send_time.observe(time.perf_counter() - start)
+        return data
+
+    def add_spectator(self, conn, address):
+        """Start sending the game to a spectator, returns False if the game is over"""
+        with self.watch_lock:
+            if self.finished:
+                return False
+            self.server.spectators.watch(conn, address, self.game_id,
+                                         encode(snapshot(self.board, self.play_state, self.hand)))
+            return True
+
+    def finish(self):
+        """Stop the game taking spectators and resumes
+
+        Its spectators are closed once they have been sent every move and its tokens stop working
+        """
+        with self.recv_condition:
+            with self.watch_lock:
+                if self.finished:
+                    return
+                self.finished = True
+            resumes = self.resumes
+            self.resumes = []
+        self.server.spectators.end(self.game_id)
+        self.server.sessions.end(self.tokens)
+        for _, connection in resumes:
+            connection.send(f"error,{NO_SESSION}")
+            connection.close()
 
     def check_connections(self):
         """tests if all players are connectd"""
@@ -129,10 +303,14 @@ class Game:
 
     def abort_game(self):
         """aborts all connected players"""
+        self.finish()
+        self.record_game(0, aborted=True)
         for player in self.players:
-            print(player.connected)
             if player.connected:
                 player.abort()
+            else:
+                player.close()
+        self.server.registry.reap_game(self.game_id, self)
 
 
 def pick_starter():
@@ -142,7 +320,7 @@ def pick_starter():
 
 class Connection:
     """Represents a connection to the server"""
-    def __init__(self, server, conn, address, state):
+    def __init__(self, server, conn, address, state, reader=None):
         """Connection to the server"""
         self.server = server
         self.logger = server.logger
@@ -150,6 +328,10 @@ class Connection:
         self.address = address
         self.state = ConnectionState(state)
         self.connected = True
+        # Used by the lobby to pick an opponent, None when the player's rating is not known
+        self.rating = None
+        # Holds any part frame and messages recieved before they are asked for
+        self.reader = reader or FrameReader()
 
     def getConn(self):
         """Gret the connections conn"""
@@ -163,31 +345,65 @@ class Connection:
         """If a connection was waiting then this is called to tell it that an opponent was found"""
         self.state = ConnectionState(2)
 
-    def send(self, data):
-        """Send the given data to the client"""
+    def send(self, *data):
+        """Send the given messages to the client, several are framed into one write"""
+        self.send_frames(encode_many(data))
+
+    def send_frames(self, data):
+        """Send messages that are already framed"""
         try:
-            self.conn.send(data.encode())
-        except (ConnectionAbortedError, ConnectionResetError):
+            self.conn.sendall(data)
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
             self.connected = False
         else:
             self.connected = True
 
     def recieve(self):
-        """Recieve data from the connection"""
+        """Recieve the next message from the connection"""
         if not self.connected:
             return None
-        try:
-            data = self.conn.recv(1024).decode()
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.connected = False
-            return None
-        ic(data)
-        if data == "":
-            self.connected = False
-            return None
+        data = self.reader.pop()
+        while data is None:
+            try:
+                recieved = self.conn.recv(4096)
+                if recieved:
+                    self.reader.feed(recieved)
+            except (ConnectionResetError, ConnectionAbortedError, OSError):
+                recieved = b""
+            except ProtocolError as error:
+                self.logger.warning("Bad data from %s: %s", self.address, error)
+                recieved = b""
+            if recieved == b"":
+                self.connected = False
+                return None
+            data = self.reader.pop()
+        event(self.logger, logging.DEBUG, "Recieved", address=self.address, data=data)
         self.connected = True
         return data
 
+    def watch_lobby(self):
+        """Wait for the player to hang up while it is in the lobby, then take it out
+
+        Only a hang up is polled for, so anything the player sends stays for recieve. Without
+        POLLRDHUP (outside Linux) the socket is peeked at instead, and a player that sent
+        something before hanging up is not noticed
+        """
+        if POLLRDHUP:
+            poller = select.poll()
+            poller.register(self.conn, POLLRDHUP | select.POLLHUP | select.POLLERR)
+            while not poller.poll(LOBBY_POLL):
+                if self not in self.server.lobby:
+                    return
+        else:
+            try:
+                if self.conn.recv(1, socket.MSG_PEEK):
+                    return
+            except OSError:
+                pass
+        if self.server.lobby.cancel(self):
+            self.logger.info("%s left the lobby", self.address)
+            self.close()
+
     def abort(self):
         """Abort the connected client connection"""
         self.logger.warning("A player disconnected, finding the other player a new game")
@@ -198,7 +414,13 @@ class Connection:
         """close connection"""
         self.connected = False
         self.logger.info("Closing connection from %s", self.address)
+        try:
+            # Shutdown first so a thread blocked in recieve wakes up
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.conn.close()
+        self.server.registry.reap_connection(self)
 
 
 class ServerProgram:
@@ -211,65 +433,134 @@ class ServerProgram:
         # host = socket.gethostname()
         # host = "localhost"
         # port = 5000  # initiate port no above 1024
-        with open("config.json", "r") as f:
-            config = json.load(f)
-            host = config["host"]
-            port = int(config["port"])
-        conn_list = []
-        self.game_dict = {}
+        config = load_config()
+        host = config["host"]
+        port = int(config["port"])
+        record_file = config.get("record_file")
+        # Seconds a player has to respond each turn, None waits forever
+        self.turn_timeout = config.get("turn_timeout")
+        # Seconds a player that disconnects has to resume its game, None aborts the game at once
+        self.resume_grace = config.get("resume_grace")
+        # Seconds a new connection has to send all of its HELLO
+        self.hello_timeout = config.get("hello_timeout", 10)
+        self.registry = Registry()
+        self.sessions = Sessions()
         self.data = ""
-        self.waiting_connection = None
+        self.metrics = ServerMetrics(self)
+        self.lobby = Lobby(config.get("rating_bucket"), pair_wait=self.metrics.pair_wait)
+        self.spectators = SpectatorHub(self.logger, config.get("spectator_buffer", 65536))
         self.stop = False
+        self.recorder = GameRecordWriter(record_file) if record_file else None
 
         self.server_socket = socket.socket()  # get instance
         # look closely. The bind() function takes tuple as argument
         self.server_socket.bind((host, port))  # bind host address and port together
 
+        metrics_server = serve_metrics(self.metrics, config)
         # configure how many client the server can listen simultaneously
-        self.logger.info("Started listening")
         self.server_socket.listen(3)
+        self.logger.info("Started listening")
         while not self.stop:
             self.logger.info("attempting to accept a connection")
-            conn_list = self.accept_conn(conn_list)
+            self.accept_conn()
 
-        for conn in conn_list:
+        for game in self.registry.live_games():
+            game.wake()
+        for conn in self.registry.live_connections():
             conn.close()
-
-    def remove_waiting(self):
-        """Set the waiting connection to None to remove it"""
-        print("removed waiting")
-        self.waiting_connection = None
-
-    def accept_conn(self, conn_list):
-        """Accept a connection to the server"""
+        self.spectators.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    def accept_conn(self):
+        """Accept a connection to the server, its HELLO is read on a thread of its own"""
         conn, address = self.server_socket.accept()  # accept new connection
+        if self.stop:
+            # Woken up by wake_accept
+            conn.close()
+            return
         self.logger.info("Connection from: %s", str(address))
-        conn_type = conn.recv(1024).decode()
+        threading.Thread(target=self.handle_conn, args=(conn, address), daemon=True).start()
+
+    def wake_accept(self):
+        """Connect to the server so the accept loop sees that it has to stop"""
+        try:
+            socket.create_connection(self.server_socket.getsockname(), timeout=1).close()
+        except OSError:
+            pass
+
+    def handle_conn(self, conn, address):
+        """Read a new connection's HELLO and put it in a game, watch one or resume one"""
+        reader = FrameReader()
+        try:
+            conn_type = recv_hello(conn, reader, self.hello_timeout)
+        except (ProtocolError, OSError) as error:
+            self.logger.warning("Refused %s: %s", str(address), error)
+            conn.close()
+            return
         if conn_type == "testing":
             self.logger.warning("STOP COMMAND RECIEVED")
             self.stop = True
-        elif conn_type == "testing2":
+            conn.close()
+            self.wake_accept()
+            return
+        if conn_type == "testing2":
             self.logger.warning("RESETING SERVER GAMES")
-            for conn in conn_list:
-                conn.close()
-            self.game_dict = {}
-            return []
-        new_connection = Connection(self, conn, address, 1)
-        conn_list.append(new_connection)
+            for connection in self.registry.live_connections():
+                connection.close()
+            self.registry.clear()
+            self.sessions.clear()
+            self.lobby.clear()
+            conn.close()
+            return
+        token = resumed_session(conn_type)
+        if token is not None:
+            self.resume(conn, address, reader, token)
+            return
+        game_id = spectated_game(conn_type)
+        if game_id is not None:
+            self.add_spectator(conn, address, game_id)
+            return
+        if conn_type != "client":
+            self.logger.warning("Refused %s, unknown connection type %r", str(address), conn_type)
+            conn.close()
+            return
+        new_connection = Connection(self, conn, address, 1, reader)
+        self.registry.add_connection(new_connection)
         self.connection_game_sort(new_connection)
-        return conn_list
 
     def connection_game_sort(self, connection):
-        """Sort connections into games"""
-        if self.waiting_connection is None:
-            # put player into waiting position
-            self.waiting_connection = connection
-        else:
-            # Create a new game with the new connection and player
-            self.waiting_connection.initialize()
+        """Sort connections into games, pairing with a waiting player or joining the lobby"""
+        opponent = self.lobby.join(connection, connection.rating)
+        if opponent is not None:
+            opponent.initialize()
             self.logger.info("Creating new game")
-            self.game_dict[get_new_id(self.game_dict)] = Game(self, self.waiting_connection,
-                                                              connection)
+            Game(self, opponent, connection)
+        else:
+            threading.Thread(target=connection.watch_lobby, daemon=True).start()
+
+    def resume(self, conn, address, reader, token):
+        """Put a reconnected player back in its game, it is refused if the game is over"""
+        connection = Connection(self, conn, address, 3, reader)
+        self.registry.add_connection(connection)
+        game, index = self.sessions.find(token)
+        if game is None or not game.request_resume(index, connection):
+            self.logger.warning("Refused resume from %s, its game is over", str(address))
+            connection.send(f"error,{NO_SESSION}")
+            connection.close()
+
+    def add_spectator(self, conn, address, game_id):
+        """Let a connection watch a game, it is refused if the game is not being played"""
+        game = self.registry.get_game(game_id)
+        if game is None or not game.add_spectator(conn, address):
+            self.logger.warning("Refused spectator %s, no game %s", str(address), game_id)
+            try:
+                conn.sendall(encode_error(NO_GAME))
+            except OSError:
+                pass
+            conn.close()
 
     def append_to_data(self, data):
         """Append the given data to the server's data"""
@@ -277,39 +568,37 @@ class ServerProgram:
         return self.data
 
 
-def get_new_id(id_dictionary):
-    """Get an id that is not in use in the dicitionary"""
-    if id_dictionary == {}:
-        return 1
-    keys = id_dictionary.keys()
-    for i in range(1, max(keys)):
-        if i not in keys:
-            return i
-    return max(keys)+1
-
+def recv_hello(conn, reader, timeout):
+    """Read a blocking socket until its HELLO is complete, returns the role
 
-def setup_logging():
-    """Logging for server"""
-    log = logging.getLogger('server')
-    log.setLevel(logging.INFO)
+    Raises ProtocolError if the connection closes or timeout seconds pass before that
+    """
+    deadline = time.monotonic() + timeout
+    data = b""
+    role = None
+    while role is None:
+        conn.settimeout(max(0.001, deadline - time.monotonic()))
+        try:
+            recieved = conn.recv(1024)
+        except socket.timeout as error:
+            raise ProtocolError("no HELLO in time") from error
+        if not recieved:
+            raise ProtocolError("connection closed before its HELLO")
+        data += recieved
+        role = read_hello(data, reader)
+    conn.settimeout(None)
+    return role
 
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
 
-    file_handler = RotatingFileHandler("./logs/latest.log", mode='a', maxBytes=5*1024*1024,
-                                       backupCount=2)
+def load_config():
+    """Load the server settings from config.json"""
+    with open("config.json", "r") as f:
+        return json.load(f)
 
-    dt_fmt = '%Y-%m-%d %H:%M:%S'
-    fmt = logging.Formatter('[{asctime}] [{levelname:<7}] {name}: {message}', dt_fmt, style='{')
-    file_handler.setFormatter(fmt)
-    log.addHandler(file_handler)
 
-    # Setup logging to the console aswell for quick live debugging
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(fmt)
-    log.addHandler(stream_handler)
-    # Also want to log to console so add a stream handler too
-    return log
+def setup_logging():
+    """Logging for server, records are written by a background thread"""
+    return setup_queue_logging('server')
 
 
 def parse_loc(loc):
@@ -324,5 +613,28 @@ def get_other(player):
     return 1
 
 
+def main():
+    """Start the server in the chosen mode"""
+    parser = argparse.ArgumentParser(description="Quatro game server")
+    parser.add_argument("--mode", choices=["threaded", "asyncio", "selectors", "sharded"],
+                        default="threaded")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes in sharded mode, one per CPU by default")
+    args = parser.parse_args()
+    if args.workers is not None and not 1 <= args.workers <= MAX_SHARDS:
+        parser.error(f"--workers must be from 1 to {MAX_SHARDS}, each has a byte of the tokens")
+    if args.mode == "asyncio":
+        from async_server import run_async_server
+        run_async_server()
+    elif args.mode == "selectors":
+        from selector_server import run_selector_server
+        run_selector_server()
+    elif args.mode == "sharded":
+        from sharded_server import run_sharded_server
+        run_sharded_server(args.workers)
+    else:
+        ServerProgram()
+
+
 if __name__ == '__main__':
-    server_object = ServerProgram()
+    main()
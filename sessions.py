@@ -0,0 +1,63 @@
+"""Session tokens that let a player who lost its connection carry on with its game
+
+Each player is given a random token when its game starts, the tokens stop working when the game
+ends. A client that reconnects with its token within the server's resume_grace seconds is put
+back in its game from a snapshot, instead of the game being aborted and both players re-paired
+
+On a sharded server the first byte of a token is the index of the worker that issued it, so there
+can be at most MAX_SHARDS workers
+"""
+import secrets
+import threading
+
+# Hex digits in a session token, it is 8 bytes in a TOKEN message
+TOKEN_LEN = 16
+# Hex digits at the start of a sharded server's token that hold the worker index
+SHARD_LEN = 2
+MAX_SHARDS = 1 << 4*SHARD_LEN
+
+
+class Sessions:
+    """The tokens of the players in live games, safe to use from any thread"""
+    def __init__(self, shard=None):
+        if shard is not None and not 0 <= shard < MAX_SHARDS:
+            raise ValueError(f"shard {shard} does not fit in a token, at most {MAX_SHARDS}")
+        # token -> (game, index of the player in the game)
+        self.tokens = {}
+        # Index of the worker of a sharded server these are the sessions of
+        self.shard = shard
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def issue(self, game, index):
+        """Make a token for the player at the index of the game"""
+        if self.shard is None:
+            token = secrets.token_hex(TOKEN_LEN // 2)
+        else:
+            token = f"{self.shard:0{SHARD_LEN}x}{secrets.token_hex((TOKEN_LEN - SHARD_LEN) // 2)}"
+        with self.lock:
+            self.tokens[token] = (game, index)
+        return token
+
+    def find(self, token):
+        """Get the (game, index) a token was issued for, (None, None) if it does not work"""
+        with self.lock:
+            return self.tokens.get(token, (None, None))
+
+    def end(self, tokens):
+        """Stop the tokens of a game that is over working"""
+        with self.lock:
+            for token in tokens:
+                self.tokens.pop(token, None)
+
+    def clear(self):
+        """Forget every token"""
+        with self.lock:
+            self.tokens.clear()
+
+
+def token_shard(token):
+    """Index of the worker of a sharded server that issued a token"""
+    return int(token[:SHARD_LEN], 16)
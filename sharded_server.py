@@ -0,0 +1,279 @@
+"""Launcher for several selectors server processes that share the port with SO_REUSEPORT
+
+The kernel spreads new connections over the worker processes and each pairs its own players. A
+player still alone after match_delay seconds is handed to the launcher over a Unix socket, with
+its socket's file descriptor and any data it already sent. The launcher pairs it with the next
+player handed over by any worker and sends both to that worker
+
+A resuming player can reach any worker, one that did not issue its token hands it to the launcher,
+which sends it on to the worker that did
+
+A stop command sent to any worker stops them all, a reset only resets the worker it reaches.
+Worker i serves its metrics on metrics_port + i
+
+python server.py --mode sharded --workers 4
+"""
+import multiprocessing
+import os
+import selectors
+import socket
+import time
+
+from logs import stop_logging, use_own_log_files
+from protocol import FrameReader, encode_many
+from selector_server import SelectorServerProgram
+from server import load_config, setup_logging
+from sessions import MAX_SHARDS, TOKEN_LEN, Sessions, token_shard
+
+PLAYER = b"P"
+RESUME = b"R"
+STOP = b"S"
+# Largest handoff message, a player with more unread data than this stays on its worker
+MAX_HANDOFF = 65536
+
+
+class ShardWorker(SelectorServerProgram):
+    """One worker process, a selectors server that can trade waiting players with the launcher"""
+    def __init__(self, channel, match_delay, index):
+        super().__init__()
+        self.channel = channel
+        self.metrics_offset = index
+        self.index = index
+        self.sessions = Sessions(index)
+        # Seconds a player waits in this worker's lobby before it is handed to the launcher
+        self.match_delay = match_delay
+
+    def listen(self):
+        """Make the listening socket, shared with the other workers"""
+        server_socket = socket.socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(128)
+        server_socket.setblocking(False)
+        self.selector.register(self.channel, selectors.EVENT_READ, self.from_launcher)
+        return server_socket
+
+    def serve(self):
+        """Serve until stopped, then tell the launcher to stop the other workers"""
+        super().serve()
+        try:
+            self.channel.send(STOP)
+        except OSError:
+            pass
+        self.channel.close()
+
+    def next_timeout(self):
+        """Seconds until the next step timeout or handoff"""
+        timeout = super().next_timeout()
+        oldest = self.lobby.oldest()
+        if oldest is None:
+            return timeout
+        handoff = max(0, oldest + self.match_delay - time.monotonic())
+        return handoff if timeout is None else min(timeout, handoff)
+
+    def expire_turns(self):
+        """Time out games and hand off the players that waited too long"""
+        super().expire_turns()
+        for connection in self.lobby.pop_stale(self.match_delay):
+            self.hand_off(connection)
+
+    def hand_off(self, connection):
+        """Send a waiting player to the launcher to be paired on another worker"""
+        if not connection.connected:
+            return
+        reader = connection.reader
+        pending = encode_many(reader.messages) + bytes(reader.buffer)
+        if len(pending) >= MAX_HANDOFF:
+            self.connection_game_sort(connection)
+            return
+        self.logger.info("Handing %s to the launcher to find an opponent", connection.address)
+        socket.send_fds(self.channel, [PLAYER + pending], [connection.conn.fileno()])
+        # The launcher has its own copy now, so close this one without shutting the socket down
+        self.selector.unregister(connection.conn)
+        connection.conn.close()
+        connection.connected = False
+        connection.events = 0
+        self.registry.reap_connection(connection)
+
+    def resume(self, conn, address, frames, token):
+        """Resume a player's game, sending the player to the launcher if another worker has it"""
+        if token_shard(token) == self.index:
+            super().resume(conn, address, frames, token)
+            return
+        pending = encode_many(frames.messages) + bytes(frames.buffer)
+        if len(pending) >= MAX_HANDOFF:
+            conn.close()
+            return
+        self.logger.info("Handing %s to the launcher to resume", str(address))
+        socket.send_fds(self.channel, [RESUME + token.encode() + pending], [conn.fileno()])
+        conn.close()
+
+    def from_launcher(self, _mask):
+        """Take a player paired by the launcher or resuming a game here, or stop"""
+        try:
+            data, fds, _, _ = socket.recv_fds(self.channel, MAX_HANDOFF, 1)
+        except OSError:
+            data, fds = b"", []
+        if data[:1] not in (PLAYER, RESUME) or not fds:
+            self.stop = True
+            return
+        conn = socket.socket(fileno=fds[0])
+        conn.setblocking(False)
+        token = None
+        pending = data[1:]
+        if data[:1] == RESUME:
+            token = data[1:1+TOKEN_LEN].decode()
+            pending = data[1+TOKEN_LEN:]
+        frames = FrameReader()
+        frames.feed(pending)
+        try:
+            address = conn.getpeername()
+        except OSError:
+            conn.close()
+            return
+        if token is None:
+            self.add_connection(conn, address, frames)
+        else:
+            super().resume(conn, address, frames, token)
+
+
+class Matchmaker:
+    """Runs in the launcher, pairs players that were left alone on different workers"""
+    def __init__(self, channels, logger):
+        self.logger = logger
+        self.selector = selectors.DefaultSelector()
+        self.channels = channels
+        for channel in channels:
+            self.selector.register(channel, selectors.EVENT_READ, self.from_worker)
+        self.open_channels = len(channels)
+        # (socket, data it already sent) of the player waiting for an opponent
+        self.waiting = None
+
+    def run(self):
+        """Pair players until every worker has stopped"""
+        while self.open_channels:
+            for key, _ in self.selector.select():
+                key.data(key.fileobj)
+        self.drop_waiting()
+        self.selector.close()
+
+    def from_worker(self, channel):
+        """Handle a message from a worker"""
+        try:
+            data, fds, _, _ = socket.recv_fds(channel, MAX_HANDOFF, 1)
+        except OSError:
+            data, fds = b"", []
+        if not data:
+            self.selector.unregister(channel)
+            channel.close()
+            self.open_channels -= 1
+            return
+        if data[:1] == STOP:
+            self.stop_workers()
+            return
+        if data[:1] == RESUME:
+            self.send_resume(data, fds[0])
+            return
+        player = (socket.socket(fileno=fds[0]), bytearray(data[1:]))
+        if self.waiting is None:
+            self.waiting = player
+            # Only readable while waiting if the client sent more or hung up
+            self.selector.register(player[0], selectors.EVENT_READ, self.check_waiting)
+            return
+        waiting = self.waiting
+        self.drop_waiting(close=False)
+        for conn, pending in (waiting, player):
+            try:
+                socket.send_fds(channel, [PLAYER + pending], [conn.fileno()])
+            except OSError as error:
+                self.logger.warning("Could not hand a player to a worker: %s", error)
+            conn.close()
+
+    def send_resume(self, data, fd):
+        """Send a resuming player to the worker that issued its token"""
+        conn = socket.socket(fileno=fd)
+        shard = token_shard(data[1:1+TOKEN_LEN].decode())
+        if shard < len(self.channels):
+            try:
+                socket.send_fds(self.channels[shard], [data], [fd])
+            except OSError as error:
+                self.logger.warning("Could not hand a player to a worker: %s", error)
+        conn.close()
+
+    def check_waiting(self, conn):
+        """Drop the waiting player if it hung up
+
+        Anything it sent is read into its pending data, so it is watched until it is paired
+        """
+        try:
+            data = conn.recv(MAX_HANDOFF)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop_waiting()
+            return
+        pending = self.waiting[1]
+        pending += data
+        if len(PLAYER) + len(pending) > MAX_HANDOFF:
+            self.logger.warning("Dropping a waiting player that sent too much")
+            self.drop_waiting()
+
+    def drop_waiting(self, close=True):
+        """Stop holding the waiting player"""
+        if self.waiting is None:
+            return
+        conn = self.waiting[0]
+        if conn in self.selector.get_map():
+            self.selector.unregister(conn)
+        if close:
+            conn.close()
+        self.waiting = None
+
+    def stop_workers(self):
+        """Tell every worker to stop"""
+        for key in list(self.selector.get_map().values()):
+            if key.data == self.from_worker:
+                try:
+                    key.fileobj.send(STOP)
+                except OSError:
+                    pass
+
+
+def run_worker(channel, match_delay, index):
+    """Entry point of a worker process"""
+    use_own_log_files(f"worker{index}")
+    try:
+        ShardWorker(channel, match_delay, index).serve()
+    finally:
+        # Worker processes exit without running atexit, write out the queued log records
+        stop_logging()
+
+
+def run_sharded_server(workers=None):
+    """Start the worker processes and pair players between them until they stop"""
+    logger = setup_logging()
+    config = load_config()
+    match_delay = config.get("match_delay", 0.05)
+    workers = workers or min(os.cpu_count(), MAX_SHARDS)
+    if not 1 <= workers <= MAX_SHARDS:
+        raise ValueError(f"a sharded server has 1 to {MAX_SHARDS} workers, not {workers}")
+    context = multiprocessing.get_context("fork")
+    channels = []
+    processes = []
+    for index in range(0, workers):
+        parent_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = context.Process(target=run_worker, args=(worker_end, match_delay, index))
+        process.start()
+        worker_end.close()
+        channels.append(parent_end)
+        processes.append(process)
+    logger.info("Started %d workers", workers)
+    Matchmaker(channels, logger).run()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    run_sharded_server()
@@ -0,0 +1,201 @@
+"""Play lots of games between bots without the GUI
+
+Games are split into batches that run on a process pool, each finished game is written to the
+output as a line of json with the winner, length and moves
+
+python simulate.py --games 1000 --players random greedy --workers 4 --output games.jsonl
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from game_objects import Board, CELLS
+from mcts import MCTSPlayer
+from solver import Solver
+
+
+class RandomPlayer:
+    """Places and gives pieces at random"""
+    def __init__(self, rng):
+        self.rng = rng
+
+    def play_turn(self, board, hand):
+        """Get the (cell, piece to give) for this turn
+
+        hand is the id of the piece to place, None on the first turn when there is only a piece to
+        give. The piece to give is None when none are left
+        """
+        cell = None
+        if hand is not None:
+            cell = self.pick_cell(board, hand)
+        return cell, self.pick_piece(board, hand, cell)
+
+    def pick_cell(self, board, hand):
+        """Choose where to place hand"""
+        occupied = board.bit_board.occupied
+        return self.rng.choice([cell for cell in range(0, CELLS) if not occupied >> cell & 1])
+
+    def pick_piece(self, board, hand, cell):
+        """Choose which piece to give once hand is in cell"""
+        pieces = [piece for piece in board.unplayed_pieces if piece != hand]
+        if not pieces:
+            return None
+        return self.rng.choice(pieces)
+
+
+class GreedyPlayer(RandomPlayer):
+    """Wins when it can and avoids giving pieces that let the opponent win straight away"""
+    def pick_cell(self, board, hand):
+        cell = board.bit_board.winning_cell(hand)
+        if cell is not None:
+            return cell
+        return super().pick_cell(board, hand)
+
+    def pick_piece(self, board, hand, cell):
+        pieces = [piece for piece in board.unplayed_pieces if piece != hand]
+        if not pieces:
+            return None
+        if cell is not None:
+            board.make_move(cell, hand)
+        threats = board.bit_board.threats()
+        if cell is not None:
+            board.unmake_move()
+        safe = [piece for piece in pieces if not threats >> piece & 1]
+        return self.rng.choice(safe or pieces)
+
+
+class SolverPlayer(RandomPlayer):
+    """Plays the move found by the alpha-beta Solver within a node budget"""
+    def __init__(self, rng, max_nodes=5000, table_bits=16):
+        super().__init__(rng)
+        self.solver = Solver(table_bits)
+        self.max_nodes = max_nodes
+
+    def play_turn(self, board, hand):
+        if hand is None:
+            # Every first piece is the same by symmetry so save the search
+            return super().play_turn(board, hand)
+        result = self.solver.search(board, f'{hand:0>4b}', max_nodes=self.max_nodes)
+        if result.cell is None:
+            return super().play_turn(board, hand)
+        return result.cell, result.piece if result.give is not None else None
+
+
+PLAYERS = {"random": RandomPlayer, "greedy": GreedyPlayer, "solver": SolverPlayer,
+           "mcts": functools.partial(MCTSPlayer, budget=0.05)}
+
+
+def play_game(players, rng):
+    """Play one game between two players, returns the result dict"""
+    board = Board()
+    first = rng.randrange(0, 2)
+    turn = first
+    hand = None
+    moves = []
+    winner = 0
+    while True:
+        cell, give = players[turn].play_turn(board, hand)
+        if hand is not None:
+            moves.append([cell, hand])
+            if board.make_move(cell, hand):
+                winner = turn + 1
+                break
+            if give is None:
+                break
+        hand = give
+        turn = 1 - turn
+    return {"first": first + 1, "winner": winner, "length": len(moves), "moves": moves}
+
+
+def play_batch(task):
+    """Play a batch of games in a worker process, task is (player names, count, seed)"""
+    names, count, seed = task
+    rng = random.Random(seed)
+    players = [PLAYERS[name](random.Random(rng.getrandbits(32))) for name in names]
+    results = []
+    for _ in range(0, count):
+        result = play_game(players, rng)
+        result["players"] = names
+        results.append(result)
+    return results
+
+
+def run(names, games, workers, output=None, batch_size=50, seed=None):
+    """Play games over a pool of workers, writing each result to output as it comes in
+
+    Returns (games played, seconds taken, [player 1 wins, player 2 wins, draws])
+    """
+    seed = random.randrange(0, 1 << 32) if seed is None else seed
+    tasks = []
+    for index, start in enumerate(range(0, games, batch_size)):
+        tasks.append((list(names), min(batch_size, games - start), seed + index))
+    totals = [0, 0, 0]
+    played = 0
+    out = open(output, "a") if output else None
+    start_time = time.perf_counter()
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for results in pool.imap_unordered(play_batch, tasks):
+                for result in results:
+                    # A winner of 0 is a draw and counts in the last total
+                    totals[result["winner"] - 1] += 1
+                    if out:
+                        out.write(json.dumps(result) + "\n")
+                played += len(results)
+    finally:
+        if out:
+            out.close()
+    return played, time.perf_counter() - start_time, totals
+
+
+def run_output(output, workers):
+    """Get the file a scaling run with this many workers writes its games to
+
+    Each run has a file of its own next to output, so the runs do not pile up in one file
+    """
+    root, ext = os.path.splitext(output)
+    return f"{root}-{workers}-workers{ext}"
+
+
+def main():
+    """Run the simulation from the command line"""
+    parser = argparse.ArgumentParser(description="Play bot games headless")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", nargs=2, choices=sorted(PLAYERS),
+                        default=["random", "random"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="jsonl file to append the games to")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--scaling", action="store_true",
+                        help="repeat with 1, 2, 4... workers up to --workers and compare, "
+                        "each run writes its games to its own file named after --output")
+    args = parser.parse_args()
+
+    worker_counts = [args.workers]
+    if args.scaling:
+        worker_counts = [2**i for i in range(0, args.workers.bit_length()) if 2**i < args.workers]
+        worker_counts.append(args.workers)
+
+    # One seed for every run, so each worker count plays the same games
+    seed = random.randrange(0, 1 << 32) if args.seed is None else args.seed
+    base_rate = None
+    for workers in worker_counts:
+        output = args.output
+        if args.scaling and output:
+            output = run_output(output, workers)
+        played, elapsed, totals = run(args.players, args.games, workers, output,
+                                      args.batch_size, seed)
+        rate = played/elapsed
+        base_rate = base_rate or rate
+        print(f"{workers} workers: {played} games in {elapsed:.2f}s, {rate:.0f} games/s "
+              f"({rate/base_rate:.2f}x), {args.players[0]} wins {totals[0]}, "
+              f"{args.players[1]} wins {totals[1]}, draws {totals[2]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+"""Search for the best move in a quatro position
+
+A turn has two parts, place the piece you were given then give your opponent a piece. Both are
+decided by the player to move so the search treats a (cell, piece) pair as one move and runs
+negamax with alpha-beta pruning, a zobrist hashed transposition table and iterative deepening
+"""
+import random
+import time
+
+from game_objects import CELLS, CELL_LINES, ATTR_TALLY, R_LEN, Board, threatened, winning_cell
+
+WIN = 100
+# Scores above this are a forced win, the distance to the win is taken off WIN
+WIN_BOUND = WIN - CELLS - 1
+INF = WIN + 1
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Move encoding is cell*17 + piece, NO_PIECE is used when the board is full after placing
+NO_PIECE = 16
+NO_MOVE = -1
+
+_zobrist_random = random.Random(20221203)
+ZOBRIST_CELL = tuple(tuple(_zobrist_random.getrandbits(64) for _ in range(0, 16))
+                     for _ in range(0, CELLS))
+ZOBRIST_HAND = tuple(_zobrist_random.getrandbits(64) for _ in range(0, 17))
+
+
+class SearchAborted(Exception):
+    """Raised inside the search when the time or node budget runs out"""
+
+
+class TranspositionTable:
+    """Fixed size table of search results keyed by zobrist hash
+
+    Slots are chosen by the low bits of the key, a slot is replaced when it is empty, holds the
+    same position, was written by an older search or was searched to no greater depth. An entry is
+    (key, depth, flag, value, move, generation, proven), proven when its search did not stop at a
+    depth limit anywhere below it
+    """
+    def __init__(self, size_bits=20):
+        self.size = 1 << size_bits
+        self.mask = self.size - 1
+        self.slots = [None]*self.size
+        self.generation = 0
+        self.stored = 0
+
+    def new_search(self):
+        """Mark entries stored so far as old so they are replaced first"""
+        self.generation += 1
+
+    def clear(self):
+        """Remove all the entries"""
+        self.slots = [None]*self.size
+        self.stored = 0
+
+    def probe(self, key):
+        """Get the entry for the key, or None"""
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, flag, value, move, proven):
+        """Store a search result, following the replacement policy"""
+        index = key & self.mask
+        entry = self.slots[index]
+        if entry is None:
+            self.stored += 1
+        elif entry[0] != key and entry[5] == self.generation and entry[1] > depth:
+            return
+        self.slots[index] = (key, depth, flag, value, move, self.generation, proven)
+
+
+class SearchResult:
+    """The outcome of a search"""
+    def __init__(self, move, score, depth, nodes, elapsed, solved):
+        self.cell, self.piece = divmod(move, 17) if move != NO_MOVE else (None, None)
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.elapsed = elapsed
+        self.solved = solved
+
+    @property
+    def location(self):
+        """The (x, y) location to place the piece, None if only a piece is being given"""
+        if self.cell is None or self.cell == NO_PIECE:
+            return None
+        return self.cell % R_LEN, self.cell // R_LEN
+
+    @property
+    def give(self):
+        """The binary string of the piece to give, None if the board is full"""
+        if self.piece is None or self.piece == NO_PIECE:
+            return None
+        return f'{self.piece:0>4b}'
+
+    @property
+    def nps(self):
+        """Nodes searched per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.nodes/self.elapsed
+
+    def outcome(self):
+        """Describe the score as a result for the player to move"""
+        if self.score > WIN_BOUND:
+            return "win"
+        if self.score < -WIN_BOUND:
+            return "loss"
+        if self.solved:
+            return "draw"
+        return "unknown"
+
+
+class Solver:
+    """Negamax alpha-beta searcher"""
+    def __init__(self, table_bits=20):
+        self.table = TranspositionTable(table_bits)
+        self.nodes = 0
+        self.deadline = None
+        self.max_nodes = None
+        self.horizon_hit = False
+        self.tallies = None
+
+    def search(self, board, hand, max_time=None, max_nodes=None, max_depth=None):
+        """Find the best move for the player holding piece hand on the Board
+
+        hand is the binary string of the piece that has to be placed, or None at the start of the
+        game when only a piece is given. Deepens until the position is solved or the budget runs
+        out and returns the result of the deepest completed iteration
+        """
+        bit_board = board.bit_board
+        hand_id = NO_PIECE if hand is None else int(hand, 2)
+        available = board.unplayed_pieces.mask
+        if hand_id != NO_PIECE:
+            available &= ~(1 << hand_id)
+        empty = ~bit_board.occupied & 0xFFFF
+        key = ZOBRIST_HAND[hand_id]
+        for cell in range(0, CELLS):
+            if not empty >> cell & 1:
+                key ^= ZOBRIST_CELL[cell][bit_board.bits >> (4*cell) & 0xF]
+        self.tallies = list(bit_board.line_tallies)
+
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        start = time.perf_counter()
+        self.deadline = None if max_time is None else start + max_time
+        self.table.new_search()
+
+        remaining = bin(empty).count("1")
+        if max_depth is None:
+            max_depth = remaining + (hand_id == NO_PIECE)
+        result = SearchResult(NO_MOVE, 0, 0, 0, 0.0, False)
+        for depth in range(1, max_depth+1):
+            self.horizon_hit = False
+            try:
+                if hand_id == NO_PIECE:
+                    move, score = self.give_root(key, empty, available, depth)
+                else:
+                    move, score = self.root(key, hand_id, empty, available, depth)
+            except SearchAborted:
+                break
+            solved = not self.horizon_hit or abs(score) > WIN_BOUND
+            result = SearchResult(move, score, depth, self.nodes,
+                                  time.perf_counter() - start, solved)
+            if solved:
+                break
+        result.nodes = self.nodes
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def root(self, key, hand, empty, available, depth):
+        """Search the root when a piece has to be placed"""
+        if threatened(self.tallies) >> hand & 1:
+            return winning_cell(self.tallies, empty, hand)*17 + NO_PIECE, WIN
+        best_move = NO_MOVE
+        alpha = -INF
+        for move, score in self.moves_with_scores(key, hand, empty, available, depth, -INF, INF, 0):
+            if score > alpha:
+                alpha = score
+                best_move = move
+        return best_move, alpha
+
+    def give_root(self, key, empty, available, depth):
+        """Search the root at the start of the game where only a piece is given"""
+        best_move = NO_MOVE
+        alpha = -INF
+        for piece in range(0, 16):
+            if not available >> piece & 1:
+                continue
+            score = -self.negamax(key ^ ZOBRIST_HAND[NO_PIECE] ^ ZOBRIST_HAND[piece], piece,
+                                  empty, available & ~(1 << piece), depth-1, -INF, -alpha, 1)
+            if score > alpha:
+                alpha = score
+                best_move = NO_PIECE*17 + piece
+        return best_move, alpha
+
+    def check_budget(self):
+        """Stop the search if it has run out of time or nodes"""
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            raise SearchAborted
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchAborted
+
+    def negamax(self, key, hand, empty, available, depth, alpha, beta, ply):
+        """Score of the position for the player who has to place hand"""
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_budget()
+
+        if threatened(self.tallies) >> hand & 1:
+            return WIN - ply
+        if depth <= 0:
+            self.horizon_hit = True
+            return 0
+
+        # horizon_hit is tracked for this node alone, so the table knows if its result is proven
+        outer_horizon = self.horizon_hit
+        self.horizon_hit = False
+        alpha_start = alpha
+        entry = self.table.probe(key)
+        tt_move = NO_MOVE
+        if entry is not None:
+            tt_move = entry[4]
+            value = entry[3]
+            if value > WIN_BOUND:
+                value -= ply
+            elif value < -WIN_BOUND:
+                value += ply
+            if entry[1] >= depth or abs(value) > WIN_BOUND:
+                if not entry[6] and abs(value) <= WIN_BOUND:
+                    # The entry may be from an earlier, depth limited search
+                    self.horizon_hit = True
+                flag = entry[2]
+                if flag == LOWER and value > alpha:
+                    alpha = value
+                elif flag == UPPER and value < beta:
+                    beta = value
+                if flag == EXACT or alpha >= beta:
+                    self.horizon_hit = self.horizon_hit or outer_horizon
+                    return value
+
+        best = -INF
+        best_move = NO_MOVE
+        for move, score in self.moves_with_scores(key, hand, empty, available, depth,
+                                                  alpha, beta, ply, tt_move):
+            if score > best:
+                best = score
+                best_move = move
+
+        if best <= alpha_start:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        stored = best
+        if best > WIN_BOUND:
+            stored += ply
+        elif best < -WIN_BOUND:
+            stored -= ply
+        self.table.store(key, depth, flag, stored, best_move, not self.horizon_hit)
+        self.horizon_hit = self.horizon_hit or outer_horizon
+        return best
+
+    def moves_with_scores(self, key, hand, empty, available, depth, alpha, beta, ply,
+                          first_move=NO_MOVE):
+        """Yield every (move, score) for placing hand then giving a piece, up to a beta cutoff
+
+        Giving a piece the opponent can win with straight away loses, those pieces are only
+        scored when no other piece is left to give. The generator stops by itself at the cutoff
+        and puts the tallies back before it ends, so callers must run it to the end
+        """
+        tallies = self.tallies
+        tally = ATTR_TALLY[hand]
+        hand_key = key ^ ZOBRIST_HAND[hand]
+        cells = [cell for cell in range(0, CELLS) if empty >> cell & 1]
+        pieces = [piece for piece in range(0, 16) if available >> piece & 1]
+        if first_move != NO_MOVE and first_move // 17 in cells:
+            cells.remove(first_move // 17)
+            cells.insert(0, first_move // 17)
+            if first_move % 17 in pieces:
+                pieces.remove(first_move % 17)
+                pieces.insert(0, first_move % 17)
+
+        for cell in cells:
+            if not pieces:
+                # Board is full and nobody won
+                yield cell*17 + NO_PIECE, 0
+                continue
+            lines = CELL_LINES[cell]
+            for line in lines:
+                tallies[line] += tally
+            next_empty = empty & ~(1 << cell)
+            placed_key = hand_key ^ ZOBRIST_CELL[cell][hand]
+            threats = threatened(tallies)
+            losing_piece = None
+            for piece in pieces:
+                if threats >> piece & 1:
+                    losing_piece = piece
+                    continue
+                score = -self.negamax(placed_key ^ ZOBRIST_HAND[piece], piece, next_empty,
+                                      available & ~(1 << piece), depth-1, -beta, -alpha, ply+1)
+                yield cell*17 + piece, score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+            for line in lines:
+                tallies[line] -= tally
+            if alpha >= beta:
+                return
+            if losing_piece is not None:
+                self.nodes += 1
+                score = -(WIN - ply - 1)
+                yield cell*17 + losing_piece, score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        return
+
+
+def random_endgame(empties, rng=random):
+    """Build a Board with the given number of empty cells that has not been won yet
+
+    Returns the board and the piece in hand
+    """
+    while True:
+        board = Board()
+        cells = rng.sample(range(0, CELLS), CELLS - empties)
+        pieces = rng.sample(range(0, 16), CELLS - empties + 1)
+        won = False
+        for cell, piece in zip(cells, pieces):
+            won = board.play_move(cell % R_LEN, cell // R_LEN, f'{piece:0>4b}')
+            if won:
+                break
+        if not won:
+            return board, f'{pieces[-1]:0>4b}'
+
+
+def main():
+    """Solve some random endgames and report the search speed"""
+    rng = random.Random(1)
+    solver = Solver()
+    for empties in range(4, 10):
+        nodes = 0
+        elapsed = 0.0
+        positions = 20
+        for _ in range(0, positions):
+            board, hand = random_endgame(empties, rng)
+            result = solver.search(board, hand)
+            nodes += result.nodes
+            elapsed += result.elapsed
+        print(f"{empties} empty: {1000*elapsed/positions:.2f} ms/position, "
+              f"{nodes/positions:.0f} nodes/position, {nodes/elapsed:.0f} nodes/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Sends the moves of games to read-only spectators from one thread
+
+A game encodes each move once and hands the frame to the hub, the hub's thread writes it to every
+spectator of that game on non-blocking sockets. Output a spectator has not taken yet is buffered
+up to max_buffer bytes, a spectator that falls further behind is disconnected. Publishing is a
+queue put, so however many spectators a game has its players are never held up by them
+"""
+import queue
+import selectors
+import socket
+import threading
+
+WATCH = 0
+PUBLISH = 1
+END = 2
+STOP = 3
+
+
+class Spectator:
+    """A spectator's socket and the output it has not taken yet"""
+    __slots__ = ("conn", "address", "game_id", "out", "events", "closing")
+
+    def __init__(self, conn, address, game_id):
+        self.conn = conn
+        self.address = address
+        self.game_id = game_id
+        self.out = bytearray()
+        self.events = 0
+        # Set when the game is over, the socket is closed once out is written
+        self.closing = False
+
+
+class SpectatorHub:
+    """Spectators of every game of a server, safe to call from any thread
+
+    Commands are carried out by the hub's thread in the order they are given, so a game's
+    spectators see its snapshot and moves in order as long as one thread publishes for each game
+    """
+    def __init__(self, logger, max_buffer=65536):
+        self.logger = logger
+        self.max_buffer = max_buffer
+        self.commands = queue.SimpleQueue()
+        self.selector = selectors.DefaultSelector()
+        # A byte written to waker wakes the hub's thread to take the queued commands
+        self.waker, self.wake_end = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_end.setblocking(False)
+        self.selector.register(self.wake_end, selectors.EVENT_READ, None)
+        # game id -> its spectators
+        self.games = {}
+        self.count = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return self.count
+
+    def watch(self, conn, address, game_id, snapshot):
+        """Add a spectator of the game, it is sent the framed snapshot first"""
+        self.put(WATCH, (conn, address, game_id, snapshot))
+
+    def publish(self, game_id, data):
+        """Send framed data to every spectator of the game"""
+        self.put(PUBLISH, (game_id, data))
+
+    def end(self, game_id):
+        """Close the game's spectators once they have been sent everything published"""
+        self.put(END, game_id)
+
+    def stop(self):
+        """Close every spectator and stop the hub's thread"""
+        self.put(STOP, None)
+        self.thread.join()
+
+    def put(self, kind, args):
+        """Queue a command for the hub's thread and wake it"""
+        self.commands.put((kind, args))
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            # The wake buffer is full, the thread already has wake ups waiting
+            pass
+
+    def run(self):
+        """Carry out commands and write to spectators until stopped"""
+        while True:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    drain(key.fileobj)
+                else:
+                    self.on_event(key.data, mask)
+            while True:
+                try:
+                    kind, args = self.commands.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == STOP:
+                    self.close_all()
+                    return
+                if kind == WATCH:
+                    self.add(*args)
+                elif kind == PUBLISH:
+                    game_id, data = args
+                    for spectator in list(self.games.get(game_id, ())):
+                        self.write(spectator, data)
+                else:
+                    for spectator in self.games.pop(args, ()):
+                        spectator.closing = True
+                        self.update(spectator)
+
+    def add(self, conn, address, game_id, snapshot):
+        """Start sending a game to a new spectator"""
+        conn.setblocking(False)
+        spectator = Spectator(conn, address, game_id)
+        self.games.setdefault(game_id, set()).add(spectator)
+        self.count += 1
+        self.logger.info("%s is watching game %s", address, game_id)
+        self.write(spectator, snapshot)
+
+    def write(self, spectator, data):
+        """Send data to a spectator, buffering what the socket does not take"""
+        if spectator.out:
+            spectator.out += data
+        else:
+            try:
+                sent = spectator.conn.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.remove(spectator)
+                return
+            if sent < len(data):
+                spectator.out += data[sent:]
+        if len(spectator.out) > self.max_buffer:
+            self.dropped += 1
+            self.logger.warning("Dropped spectator %s, it fell %d bytes behind",
+                                spectator.address, len(spectator.out))
+            self.remove(spectator)
+            return
+        self.update(spectator)
+
+    def on_event(self, spectator, mask):
+        """Write buffered output, or notice a spectator that hung up"""
+        try:
+            if mask & selectors.EVENT_WRITE:
+                sent = spectator.conn.send(spectator.out)
+                del spectator.out[:sent]
+            # Spectators have nothing to say, anything read other than a hang up is ignored
+            if mask & selectors.EVENT_READ and not spectator.conn.recv(4096):
+                self.remove(spectator)
+                return
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.remove(spectator)
+            return
+        self.update(spectator)
+
+    def update(self, spectator):
+        """Set what the selector waits for on a spectator, closing it once a game has ended"""
+        if spectator.closing and not spectator.out:
+            self.remove(spectator)
+            return
+        events = selectors.EVENT_READ
+        if spectator.out:
+            events |= selectors.EVENT_WRITE
+        if events == spectator.events:
+            return
+        if spectator.events == 0:
+            self.selector.register(spectator.conn, events, spectator)
+        else:
+            self.selector.modify(spectator.conn, events, spectator)
+        spectator.events = events
+
+    def remove(self, spectator):
+        """Close a spectator's socket and forget it"""
+        if spectator.events:
+            self.selector.unregister(spectator.conn)
+            spectator.events = 0
+        watching = self.games.get(spectator.game_id)
+        if watching is not None:
+            watching.discard(spectator)
+            if not watching:
+                del self.games[spectator.game_id]
+        try:
+            spectator.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        spectator.conn.close()
+        self.count -= 1
+
+    def close_all(self):
+        """Close every spectator and the hub's sockets"""
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.remove(key.data)
+        for watching in list(self.games.values()):
+            for spectator in list(watching):
+                self.remove(spectator)
+        self.selector.close()
+        self.waker.close()
+        self.wake_end.close()
+
+
+def drain(conn):
+    """Read everything waiting on a non-blocking socket"""
+    try:
+        while conn.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
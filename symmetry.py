@@ -0,0 +1,128 @@
+"""Canonical forms of quatro positions
+
+Positions are equivalent under the 32 board symmetries that keep every line a line, the 24
+orders of the ATTRS and flipping any attr to its INVS_ATTRS pair (16 ways). canonical_key maps
+every equivalent position to the same int using tables built once at import, the piece mapping
+is worked out directly from the pieces instead of trying all 384 of them
+"""
+import random
+import time
+from itertools import permutations
+
+from game_objects import CELLS, LINES, R_LEN
+
+
+def find_board_symmetries():
+    """Find the cell permutations that map the set of lines onto itself
+
+    Every one of them permutes rows and columns, possibly after swapping x and y
+    """
+    lines = {frozenset(line) for line in LINES}
+    found = set()
+    for row_order in permutations(range(0, R_LEN)):
+        for col_order in permutations(range(0, R_LEN)):
+            for transpose in (False, True):
+                mapping = []
+                for cell in range(0, CELLS):
+                    y, x = divmod(cell, R_LEN)
+                    if transpose:
+                        x, y = y, x
+                    mapping.append(row_order[y]*R_LEN + col_order[x])
+                if {frozenset(mapping[cell] for cell in line) for line in lines} == lines:
+                    found.add(tuple(mapping))
+    return sorted(found)
+
+
+# BOARD_SYMMETRIES[g][cell] is where the cell moves to, SOURCE_CELLS[g][cell] where it came from
+BOARD_SYMMETRIES = tuple(find_board_symmetries())
+SOURCE_CELLS = tuple(tuple(sym.index(cell) for cell in range(0, CELLS))
+                     for sym in BOARD_SYMMETRIES)
+# Occupancy masks are moved a byte at a time
+OCCUPIED_LOW = tuple(tuple(sum(1 << sym[bit] for bit in range(0, 8) if byte >> bit & 1)
+                           for byte in range(0, 256)) for sym in BOARD_SYMMETRIES)
+OCCUPIED_HIGH = tuple(tuple(sum(1 << sym[bit+8] for bit in range(0, 8) if byte >> bit & 1)
+                            for byte in range(0, 256)) for sym in BOARD_SYMMETRIES)
+# Each attr bit of a piece moved to its own 20 bit field, so a sequence of pieces can be shifted
+# in to build one column per attr
+ATTR_COLUMNS = tuple(sum(((piece >> bit) & 1) << (20*bit) for bit in range(0, 4))
+                     for piece in range(0, 16))
+# ATTR_ORDERS[order][piece] moves the piece's attr bits into the given order
+ATTR_ORDERS = {order: tuple(sum(((piece >> src) & 1) << dst for dst, src in enumerate(order))
+                            for piece in range(0, 16))
+               for order in permutations(range(0, 4))}
+NO_HAND = 16
+
+
+def transform_occupied(sym_index, occupied):
+    """Move an occupancy mask with one of the board symmetries"""
+    return OCCUPIED_LOW[sym_index][occupied & 0xFF] | OCCUPIED_HIGH[sym_index][occupied >> 8]
+
+
+def canonical_position(bits, occupied, hand=NO_HAND):
+    """Get the canonical (bits, occupied, hand) of a packed position
+
+    The board symmetries giving the smallest occupancy mask are kept, then for each the pieces are
+    read in cell order (with the hand last), flipped so the first is 0000 and their attrs ordered
+    by the column of bits each attr has down the sequence. The smallest result is the canonical one
+    """
+    best_occupied = None
+    candidates = []
+    for sym_index in range(0, len(BOARD_SYMMETRIES)):
+        moved = transform_occupied(sym_index, occupied)
+        if best_occupied is None or moved < best_occupied:
+            best_occupied = moved
+            candidates = [sym_index]
+        elif moved == best_occupied:
+            candidates.append(sym_index)
+
+    cells = [cell for cell in range(0, CELLS) if best_occupied >> cell & 1]
+    best = None
+    for sym_index in candidates:
+        source = SOURCE_CELLS[sym_index]
+        sequence = [bits >> (4*source[cell]) & 0xF for cell in cells]
+        if hand != NO_HAND:
+            sequence.append(hand)
+        if not sequence:
+            return 0, 0, hand
+        flip = sequence[0]
+        columns = 0
+        for piece in sequence:
+            columns = columns << 1 | ATTR_COLUMNS[piece ^ flip]
+        order = tuple(sorted(range(0, 4), key=lambda bit, c=columns: c >> (20*bit) & 0xFFFFF))
+        mapping = ATTR_ORDERS[order]
+        moved_bits = 0
+        for cell, piece in zip(cells, sequence):
+            moved_bits |= mapping[piece ^ flip] << (4*cell)
+        moved_hand = hand if hand == NO_HAND else mapping[hand ^ flip]
+        if best is None or (moved_bits, moved_hand) < best:
+            best = (moved_bits, moved_hand)
+    return best[0], best_occupied, best[1]
+
+
+def canonical_key(board, hand=None):
+    """Get one int that is the same for every position equivalent to the Board and piece in hand
+
+    hand is the binary string of the piece to be placed next, the pieces still to play are the
+    ones not on the board or in hand so they are covered by the key too
+    """
+    hand_id = NO_HAND if hand is None else int(hand, 2)
+    bits, occupied, hand_id = canonical_position(board.bit_board.bits, board.bit_board.occupied,
+                                                 hand_id)
+    return (bits << 21) | (occupied << 5) | hand_id
+
+
+def main():
+    """Report how many positions can be canonicalised per second"""
+    from solver import random_endgame
+    rng = random.Random(1)
+    positions = [random_endgame(empties, rng) for empties in range(1, 16) for _ in range(0, 200)]
+    start = time.perf_counter()
+    for board, hand in positions:
+        canonical_key(board, hand)
+    elapsed = time.perf_counter() - start
+    print(f"{len(positions)} positions in {elapsed:.3f}s, "
+          f"{len(positions)/elapsed:.0f} canonicalisations/s")
+
+
+if __name__ == '__main__':
+    main()
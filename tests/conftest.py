@@ -0,0 +1,144 @@
+"""Fixtures shared by the tests, the modules are imported from the repository root
+
+The server fixture runs server.py in each mode as its own process, in a temporary directory with
+its own config.json and a free port, and stops it with the testing command afterwards
+"""
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from protocol import FrameReader, encode, encode_hello  # noqa: E402  pylint: disable=wrong-import-position
+
+MODES = ["threaded", "asyncio", "selectors", "sharded"]
+# Seconds to wait for anything from a server before a test fails
+TIMEOUT = 5
+
+
+def free_port():
+    """A port nothing is listening on"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class RawClient:
+    """A raw connection to a server that sends and receives the game's text messages"""
+    def __init__(self, port, hello=None):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=TIMEOUT)
+        self.reader = FrameReader()
+        # Session token sent after START
+        self.token = None
+        if hello is not None:
+            self.sock.sendall(hello)
+
+    def send(self, text):
+        """Send one of the game's messages"""
+        self.sock.sendall(encode(text))
+
+    def recv(self, timeout=TIMEOUT):
+        """Get the next message, None once the server has closed the connection"""
+        self.sock.settimeout(timeout)
+        message = self.reader.pop()
+        while message is None:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.reader.feed(data)
+            message = self.reader.pop()
+        return message
+
+    def start(self):
+        """Get the START of a game and the session token after it, returns the START"""
+        start = self.recv()
+        assert start is not None and "," in start and not start.startswith("error,")
+        token = self.recv()
+        assert token.startswith("token,")
+        self.token = token[6:]
+        return start
+
+    def close(self):
+        """Hang up"""
+        self.sock.close()
+
+
+class RunningServer:
+    """A server process listening on port"""
+    def __init__(self, mode, port, directory):
+        self.mode = mode
+        self.port = port
+        self.log = directory / "server.out"
+        args = [sys.executable, str(ROOT / "server.py"), "--mode", mode]
+        if mode == "sharded":
+            args += ["--workers", "2"]
+        with open(self.log, "w") as out:
+            self.process = subprocess.Popen(args, cwd=directory, stdout=out,
+                                            stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = time.monotonic() + 15
+        while "Started listening" not in self.output():
+            assert self.process.poll() is None, self.output()
+            assert time.monotonic() < deadline, "server did not start"
+            time.sleep(0.05)
+
+    def output(self):
+        """Everything the server printed so far"""
+        return self.log.read_text()
+
+    def client(self, hello=encode_hello()):
+        """Connect a client, saying hello as a player by default"""
+        return RawClient(self.port, hello)
+
+    def alive(self):
+        """Check if the server process is still running"""
+        return self.process.poll() is None
+
+    def stop(self):
+        """Stop the server with the testing command, killing it if that does not work"""
+        if self.alive():
+            try:
+                RawClient(self.port, encode_hello("testing")).close()
+                self.process.wait(10)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        if self.alive():
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+
+@pytest.fixture
+def make_server(tmp_path):
+    """Start a server in a mode with extra config settings, stopped after the test"""
+    servers = []
+
+    def start(mode, **settings):
+        port = free_port()
+        config = {"host": "127.0.0.1", "port": str(port), "turn_timeout": 30, **settings}
+        (tmp_path / "config.json").write_text(json.dumps(config))
+        server = RunningServer(mode, port, tmp_path)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture(params=MODES)
+def server(request, make_server):
+    """A running server in each mode"""
+    return make_server(request.param)
+
+
+@pytest.fixture(params=MODES)
+def mode(request):
+    """Each server mode, for tests that start the server with their own settings"""
+    return request.param
@@ -0,0 +1,95 @@
+"""Tests for the board, pieces and piece set of the game engine"""
+import random
+
+import pytest
+
+from game_objects import (ATTRS, ATTR_BITS, CELLS, LINES, PIECE_BINS, PIECES, R_LEN, Board, Piece,
+                          PieceSet)
+
+
+def scan_for_win(cells):
+    """Check every full line of the 16 cells (piece ids or None) for a shared attribute"""
+    for line in LINES:
+        pieces = [cells[cell] for cell in line]
+        if None in pieces:
+            continue
+        for attr in ATTRS:
+            bits = {piece >> ATTR_BITS[attr] & 1 for piece in pieces}
+            if len(bits) == 1:
+                return True
+    return False
+
+
+def test_play_move_finds_the_wins_a_scan_finds():
+    rng = random.Random(1)
+    for _ in range(0, 300):
+        board = Board()
+        cells = [None]*CELLS
+        for cell, piece in zip(rng.sample(range(0, CELLS), CELLS), rng.sample(range(0, 16), 16)):
+            cells[cell] = piece
+            won = board.play_move(cell % R_LEN, cell // R_LEN, PIECE_BINS[piece])
+            assert won == scan_for_win(cells) == board.check_win()
+            if won:
+                break
+
+
+def board_state(board):
+    """Everything a move changes on the board"""
+    bit_board = board.bit_board
+    return (bit_board.bits, bit_board.occupied, list(bit_board.line_tallies),
+            board.unplayed_pieces.mask, [list(row) for row in board.game_board], board.won,
+            list(board.undo_stack))
+
+
+def test_unmake_move_puts_the_board_back():
+    rng = random.Random(2)
+    for _ in range(0, 100):
+        board = Board()
+        states = []
+        for cell, piece in zip(rng.sample(range(0, CELLS), CELLS), rng.sample(range(0, 16), 16)):
+            states.append(board_state(board))
+            board.make_move(cell, piece)
+        # Moves after a win are made too, so won is put back from True as well
+        for cell, piece, _ in reversed(list(board.undo_stack)):
+            assert board.unmake_move() == (cell, piece)
+            assert board_state(board) == states.pop()
+        assert board_state(board) == board_state(Board())
+
+
+def test_piece_set_does_not_hold_things_that_are_not_pieces():
+    pieces = PieceSet()
+    # No piece is in hand on the first turn
+    assert None not in pieces
+    assert "hand" not in pieces
+    assert 16 not in pieces
+    assert -1 not in pieces
+
+
+def test_piece_set_takes_binary_strings_and_ids():
+    pieces = PieceSet()
+    assert len(pieces) == 16
+    assert "0101" in pieces and 5 in pieces
+    pieces.remove("0101")
+    assert "0101" not in pieces and 5 not in pieces
+    pieces.remove(6)
+    assert "0110" not in pieces
+    assert list(pieces.bins()) == [piece for piece in PIECE_BINS if piece not in ("0101", "0110")]
+    pieces.add("0110")
+    pieces.add(5)
+    assert pieces == PieceSet()
+    with pytest.raises(ValueError):
+        pieces.copy().remove("2")
+
+
+def test_pieces_are_shared():
+    for piece_id, bin_rep in enumerate(PIECE_BINS):
+        piece = Piece(bin_rep)
+        assert piece is Piece(bin_rep) is PIECES[piece_id]
+        assert (piece.id, piece.bin) == (piece_id, bin_rep)
+    # Every board holds the same pieces
+    first, second = Board(), Board()
+    first.play_move(0, 0, "1010")
+    second.play_move(3, 2, "1010")
+    assert first.get_board()[0][0] is second.get_board()[2][3]
+    assert Piece("1010").attr_dict == {"tall": True, "black": False, "round": True,
+                                       "hollow": False}
@@ -0,0 +1,38 @@
+"""Tests for the game record file"""
+import multiprocessing
+import os
+import time
+
+import game_record
+from game_record import FILE_HEADER, GameRecordWriter, read_games
+
+
+def open_and_record(path, barrier, index):
+    """Open a writer as a sharded server's worker would, then record one game"""
+    fstat = os.fstat
+
+    def slow_fstat(fd):
+        # Widen the gap between checking the file is empty and writing the header
+        result = fstat(fd)
+        time.sleep(0.05)
+        return result
+    game_record.os.fstat = slow_fstat
+    barrier.wait()
+    writer = GameRecordWriter(path)
+    writer.write_game([(index, index)], 1, 1)
+    writer.close()
+
+
+def test_processes_opening_a_new_file_write_one_header(tmp_path):
+    path = str(tmp_path / "games.qrec")
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(8)
+    processes = [context.Process(target=open_and_record, args=(path, barrier, i))
+                 for i in range(0, 8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(path, "rb") as f:
+        assert f.read().count(FILE_HEADER) == 1
+    assert sorted(game.moves[0] for game in read_games(path)) == [i << 4 | i for i in range(0, 8)]
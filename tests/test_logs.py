@@ -0,0 +1,21 @@
+"""Tests for the logging set up by the server and client"""
+import logging
+
+import logs
+
+
+def test_bad_log_level_falls_back_to_info(tmp_path, monkeypatch):
+    monkeypatch.setenv("QUATRO_LOG_LEVEL", "LOUD")
+    log = logs.setup_queue_logging("test_bad_level", str(tmp_path / "latest.log"))
+    assert log.level == logging.INFO
+    logs.stop_logging()
+    assert "is not a level" in (tmp_path / "latest.log").read_text()
+
+
+def test_own_log_files_take_the_file_records(tmp_path):
+    log = logs.setup_queue_logging("test_own_files", str(tmp_path / "latest.log"))
+    logs.use_own_log_files("worker0")
+    log.info("from the worker")
+    logs.stop_logging()
+    assert "from the worker" in (tmp_path / "latest-worker0.log").read_text()
+    assert "from the worker" not in (tmp_path / "latest.log").read_text()
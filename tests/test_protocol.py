@@ -0,0 +1,59 @@
+"""Tests for the framed protocol"""
+import pytest
+
+from protocol import FrameReader, ProtocolError, decode, encode, encode_hello, read_hello
+
+
+def test_hello_with_bad_role_bytes_is_a_protocol_error():
+    with pytest.raises(ProtocolError, match="bad hello role"):
+        decode(b"\x00\x01\xff")
+
+
+def test_read_hello_refuses_bad_role_bytes():
+    with pytest.raises(ProtocolError):
+        read_hello(b"\x03\x00\x01\xff", FrameReader())
+
+
+def test_read_hello_gets_the_role():
+    assert read_hello(encode_hello("client"), FrameReader()) == "client"
+
+
+@pytest.mark.parametrize("location", ["(0, 4)", "(5, 0)", "(-1, 2)"])
+def test_location_off_the_board_is_not_encoded(location):
+    with pytest.raises(ProtocolError):
+        encode(location)
+
+
+def test_every_location_round_trips():
+    reader = FrameReader()
+    for y in range(0, 4):
+        for x in range(0, 4):
+            reader.feed(encode(str((x, y))))
+            assert reader.pop() == str((x, y))
+
+
+def test_read_hello_waits_for_the_whole_frame():
+    hello = encode_hello("client") + b"\x01\x40"
+    reader = FrameReader()
+    for end in range(0, len(hello) - 2):
+        assert read_hello(hello[:end], FrameReader()) is None
+    assert read_hello(hello, reader) == "client"
+    assert reader.pop() == "waiting"
+
+
+def test_read_hello_passes_plain_text_through():
+    assert read_hello(b"testing", FrameReader()) == "testing"
+    assert read_hello(b"client", FrameReader()) == "client"
+
+
+@pytest.mark.parametrize("message", [
+    b"\x60" + bytes(10) + b"\x20",    # snapshot with a piece in hand that does not exist
+    b"\x00\x01\xff\xfe",              # hello whose role is not UTF-8
+    b"\x80",                          # unknown type
+    b"",
+])
+def test_any_bad_message_is_a_protocol_error(message):
+    with pytest.raises(ProtocolError):
+        decode(message)
+    with pytest.raises(ProtocolError):
+        FrameReader().feed(bytes((len(message),)) + message)
@@ -0,0 +1,27 @@
+"""Tests for the registry of games and connections"""
+from registry import Registry
+
+
+def test_game_reaped_after_a_clear_leaves_the_new_game_alone():
+    registry = Registry()
+    old = object()
+    old_id = registry.add_game(old)
+    registry.clear()
+    new = object()
+    new_id = registry.add_game(new)
+    assert new_id == old_id
+    registry.reap_game(old_id, old)
+    assert registry.get_game(new_id) is new
+    assert registry.free_ids == []
+    registry.reap_game(new_id, new)
+    assert registry.get_game(new_id) is None
+    assert registry.free_ids == [new_id]
+
+
+def test_game_reaped_twice_frees_its_id_once():
+    registry = Registry()
+    game = object()
+    game_id = registry.add_game(game)
+    registry.reap_game(game_id, game)
+    registry.reap_game(game_id, game)
+    assert registry.free_ids == [game_id]
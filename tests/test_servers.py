@@ -0,0 +1,201 @@
+"""Tests that run every server mode as its own process and talk to it over sockets"""
+import socket
+import time
+
+import pytest
+
+from game_objects import CELLS, EMPTY, R_LEN, Board
+from protocol import (CELL_TAKEN, NO_SESSION, PIECE_PLAYED, encode_hello, encode_resume,
+                      encode_watch, missed_move, read_snapshot)
+
+
+def assert_pairs(server):
+    """Check the server still pairs two new players into a game"""
+    first = server.client()
+    second = server.client()
+    assert_game(first, second)
+    first.close()
+    second.close()
+
+
+def assert_game(first, second):
+    """Check the two clients were started in the same game as players 1 and 2"""
+    starts = sorted([first.start(), second.start()])
+    assert starts[0].startswith("1,") and starts[1].startswith("2,")
+    assert starts[0][2] == starts[1][2]
+
+
+def test_hello_with_bad_role_bytes_is_refused(server):
+    bad = server.client(b"\x03\x00\x01\xff")
+    assert bad.recv() is None
+    assert server.alive()
+    assert_pairs(server)
+
+
+def test_stop_command_is_not_taken_for_a_connection(make_server):
+    server = make_server("threaded")
+    server.stop()
+    assert not server.alive()
+    assert "unknown connection type" not in server.output()
+
+
+def test_hello_split_over_several_reads(server):
+    hello = encode_hello()
+    first = server.client(None)
+    for byte in hello:
+        first.sock.sendall(bytes((byte,)))
+        time.sleep(0.05)
+    second = server.client()
+    assert_game(first, second)
+
+
+def test_silent_connection_does_not_hold_up_others(server):
+    silent = server.client(None)
+    assert_pairs(server)
+    silent.close()
+
+
+def test_connection_without_hello_is_closed(make_server, mode):
+    server = make_server(mode, hello_timeout=0.5)
+    silent = server.client(None)
+    assert silent.recv() is None
+
+
+def test_bad_data_during_a_game_ends_it_at_once(server):
+    first = server.client()
+    second = server.client()
+    assert_game(first, second)
+    # A snapshot holding a piece that does not exist
+    first.sock.sendall(b"\x0c\x60" + bytes(10) + b"\x20")
+    third = server.client()
+    assert_game(second, third)
+
+
+def test_player_that_hangs_up_in_the_lobby_is_not_paired(server):
+    gone = server.client()
+    time.sleep(0.2)
+    gone.close()
+    time.sleep(0.3)
+    waiting = server.client()
+    with pytest.raises(socket.timeout):
+        waiting.recv(timeout=0.5)
+    other = server.client()
+    assert_game(waiting, other)
+
+
+def test_player_that_sends_then_hangs_up_in_the_lobby_is_not_paired(server):
+    gone = server.client()
+    time.sleep(0.2)
+    gone.send("waiting")
+    time.sleep(0.2)
+    gone.close()
+    time.sleep(0.3)
+    waiting = server.client()
+    with pytest.raises(socket.timeout):
+        waiting.recv(timeout=0.5)
+    other = server.client()
+    assert_game(waiting, other)
+
+
+def start_game(first, second):
+    """Check the clients were started in the same game, returns them as (picker, placer)"""
+    starts = [first.start(), second.start()]
+    assert sorted(start[0] for start in starts) == ["1", "2"]
+    assert starts[0][2] == starts[1][2]
+    if starts[0][0] == starts[0][2]:
+        return first, second
+    return second, first
+
+
+def play_round(picker, placer, piece, location):
+    """Play a round that is not refused, returns the (picker, placer) of the next one"""
+    picker.send(piece)
+    placer.send("waiting")
+    assert picker.recv() == placer.recv() == piece
+    placer.send(location)
+    picker.send("waiting")
+    assert picker.recv() == placer.recv() == location
+    return placer, picker
+
+
+def play_out(picker, placer, board):
+    """Play the game to its end from the board, checks both players are then closed"""
+    while True:
+        piece = next(board.unplayed_pieces.bins())
+        cell = next(cell for cell in range(0, CELLS) if board.bit_board.get_piece(cell) is None)
+        x, y = cell % R_LEN, cell // R_LEN
+        picker, placer = play_round(picker, placer, piece, str((x, y)))
+        if board.play_move(x, y, piece) or not board.unplayed_pieces:
+            break
+    assert picker.recv() is None and placer.recv() is None
+
+
+def test_illegal_moves_are_refused_and_asked_for_again(server):
+    picker, placer = start_game(server.client(), server.client())
+    picker, placer = play_round(picker, placer, "0000", "(0, 0)")
+    # The piece was played last round
+    picker.send("0000")
+    placer.send("waiting")
+    assert picker.recv() == f"error,{PIECE_PLAYED}"
+    picker.send("0001")
+    assert picker.recv() == placer.recv() == "0001"
+    # The cell has the first piece in it
+    placer.send("(0, 0)")
+    picker.send("waiting")
+    assert placer.recv() == f"error,{CELL_TAKEN}"
+    placer.send("(1, 0)")
+    assert picker.recv() == placer.recv() == "(1, 0)"
+    board = Board()
+    board.play_move(0, 0, "0000")
+    board.play_move(1, 0, "0001")
+    play_out(placer, picker, board)
+
+
+@pytest.mark.parametrize("mode", ["threaded", "asyncio", "selectors"])
+def test_spectator_is_sent_a_snapshot_then_the_moves(make_server, mode):
+    server = make_server(mode)
+    picker, placer = start_game(server.client(), server.client())
+    picker, placer = play_round(picker, placer, "0000", "(0, 0)")
+    spectator = server.client(encode_watch(1))
+    board, play_state, hand = read_snapshot(spectator.recv())
+    if hand is not None:
+        # Taken as the players were sent the placement, the spectator is sent it next
+        assert (play_state[1], hand) == ("p", "0000")
+        assert spectator.recv() == "(0, 0)"
+        board.play_move(0, 0, hand)
+    assert board.to_array() == [0] + [EMPTY]*(CELLS-1)
+    play_round(picker, placer, "0001", "(1, 0)")
+    assert spectator.recv() == "0001"
+    assert spectator.recv() == "(1, 0)"
+
+
+def test_player_that_resumes_is_sent_what_it_missed_and_finishes(make_server, mode):
+    server = make_server(mode, resume_grace=5)
+    picker, placer = start_game(server.client(), server.client())
+    picker, placer = play_round(picker, placer, "0000", "(0, 0)")
+    board = Board()
+    board.play_move(0, 0, "0000")
+    placer.send("waiting")
+    placer.close()
+    picker.send("0001")
+    assert picker.recv() == "0001"
+    resumed = server.client(encode_resume(placer.token))
+    missed = missed_move(board, "piece", resumed.recv())
+    assert missed == "0001"
+    resumed.send("(1, 0)")
+    picker.send("waiting")
+    assert picker.recv() == resumed.recv() == "(1, 0)"
+    board.play_move(1, 0, "0001")
+    play_out(resumed, picker, board)
+
+
+def test_game_is_aborted_when_no_one_resumes_in_time(make_server, mode):
+    server = make_server(mode, resume_grace=0.5)
+    picker, placer = start_game(server.client(), server.client())
+    placer.close()
+    picker.send("0000")
+    time.sleep(1)
+    late = server.client(encode_resume(placer.token))
+    assert late.recv() == f"error,{NO_SESSION}"
+    # The player left in the game is paired again
+    assert_game(picker, server.client())
@@ -0,0 +1,19 @@
+"""Tests for the session tokens players resume their games with"""
+import pytest
+
+from protocol import FrameReader, encode_resume, read_hello
+from sessions import MAX_SHARDS, TOKEN_LEN, Sessions, token_shard
+
+
+@pytest.mark.parametrize("shard", [None, 0, 7, MAX_SHARDS - 1])
+def test_token_is_a_fixed_length_and_names_its_shard(shard):
+    token = Sessions(shard).issue(None, 0)
+    assert len(token) == TOKEN_LEN
+    if shard is not None:
+        assert token_shard(token) == shard
+    assert read_hello(encode_resume(token), FrameReader()) == f"resume,{token}"
+
+
+def test_shard_that_does_not_fit_in_a_token_is_refused():
+    with pytest.raises(ValueError):
+        Sessions(MAX_SHARDS)
@@ -0,0 +1,53 @@
+"""Tests for the launcher of the sharded server, driven with socket pairs in place of workers"""
+import logging
+import socket
+
+from protocol import FrameReader, encode
+from sharded_server import PLAYER, Matchmaker
+
+
+def step(matchmaker):
+    """Handle whatever the launcher has waiting"""
+    for key, _ in matchmaker.selector.select(1):
+        key.data(key.fileobj)
+
+
+def hand_over(matchmaker, worker):
+    """Hand the launcher a new player from the worker, returns the client end of it"""
+    client, server_end = socket.socketpair()
+    server_end.setblocking(False)
+    socket.send_fds(worker, [PLAYER], [server_end.fileno()])
+    server_end.close()
+    step(matchmaker)
+    return client
+
+
+def launcher():
+    """A launcher with one worker, returns (launcher, the worker's end of its channel)"""
+    worker, channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    return Matchmaker([channel], logging.getLogger("test_sharded")), worker
+
+
+def test_held_player_that_sends_then_hangs_up_is_dropped():
+    matchmaker, worker = launcher()
+    client = hand_over(matchmaker, worker)
+    client.sendall(encode("waiting"))
+    step(matchmaker)
+    assert matchmaker.waiting is not None
+    client.close()
+    step(matchmaker)
+    assert matchmaker.waiting is None
+
+
+def test_data_sent_while_held_is_handed_on_with_the_player():
+    matchmaker, worker = launcher()
+    first = hand_over(matchmaker, worker)
+    first.sendall(encode("waiting"))
+    step(matchmaker)
+    hand_over(matchmaker, worker)
+    data, fds, _, _ = socket.recv_fds(worker, 1024, 1)
+    for fd in fds + socket.recv_fds(worker, 1024, 1)[1]:
+        socket.close(fd)
+    frames = FrameReader()
+    frames.feed(data[1:])
+    assert data[:1] == PLAYER and frames.pop() == "waiting"
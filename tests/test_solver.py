@@ -0,0 +1,32 @@
+"""Tests for the alpha-beta solver"""
+import random
+
+import pytest
+
+from solver import Solver, random_endgame
+
+
+@pytest.mark.parametrize("seed", [6, 8, 9])
+def test_reused_solver_matches_a_fresh_one(seed):
+    board, hand = random_endgame(7, random.Random(seed))
+    fresh = Solver(16).search(board, hand)
+    reused = Solver(16)
+    # Leaves entries cut off at depth 2 in the table
+    reused.search(board, hand, max_depth=2)
+    again = reused.search(board, hand)
+    assert fresh.solved and again.solved
+    assert (again.score, again.outcome()) == (fresh.score, fresh.outcome())
+
+
+def test_moves_stop_at_a_cutoff_and_put_the_tallies_back():
+    board, hand = random_endgame(8, random.Random(3))
+    solver = Solver(16)
+    solver.search(board, hand, max_depth=1)
+    tallies = list(board.bit_board.line_tallies)
+    empty = ~board.bit_board.occupied & 0xFFFF
+    available = board.unplayed_pieces.mask & ~(1 << int(hand, 2))
+    every = list(solver.moves_with_scores(0, int(hand, 2), empty, available, 2, -200, 200, 0))
+    # A window nothing can fall inside cuts off after the first move
+    cut = list(solver.moves_with_scores(0, int(hand, 2), empty, available, 2, -200, -199, 0))
+    assert len(cut) == 1 < len(every)
+    assert solver.tallies == tallies
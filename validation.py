@@ -0,0 +1,37 @@
+"""Checks the picks and placements clients send against the game's board before they are relayed
+
+Each check is a dict lookup and a bit test on the board's masks, so validating a move costs the
+same at any point in the game
+"""
+from game_objects import CELLS, PIECE_IDS, R_LEN
+from protocol import BAD_MESSAGE, CELL_TAKEN, PIECE_PLAYED
+
+# The '(x, y)' text a client sends for each cell
+LOCATION_CELLS = {str((cell % R_LEN, cell // R_LEN)): cell for cell in range(0, CELLS)}
+
+
+class IllegalMove(ValueError):
+    """Raised for a pick or placement the board does not allow, code is the protocol error"""
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def check_pick(board, message):
+    """Get the id of the piece picked by the message, it must not have been played"""
+    piece_id = PIECE_IDS.get(message)
+    if piece_id is None:
+        raise IllegalMove(BAD_MESSAGE, f"{message!r} is not a piece")
+    if not board.unplayed_pieces.mask >> piece_id & 1:
+        raise IllegalMove(PIECE_PLAYED, f"piece {message} has already been played")
+    return piece_id
+
+
+def check_place(board, message):
+    """Get the cell the message places the piece in, it must be empty"""
+    cell = LOCATION_CELLS.get(message)
+    if cell is None:
+        raise IllegalMove(BAD_MESSAGE, f"{message!r} is not a location")
+    if board.bit_board.occupied >> cell & 1:
+        raise IllegalMove(CELL_TAKEN, f"location {message} is taken")
+    return cell